@@ -0,0 +1,60 @@
+from typing import Iterable, Sequence
+
+from apiutils import API
+
+
+class StandardAPIResolver:
+
+    def __init__(self, standard_apis: Sequence[API]):
+        """
+        Maps recommended API names to standard APIs with dict lookups instead of scans of the standard APIs
+
+        Same result as API.is_standard and API.get_possible_standard_apis(first=True): the first standard API
+        with the same fullname, otherwise the first one with the same class and method name
+
+        Args:
+            standard_apis (Sequence[API]): Standard APIs, usually API.get_standard_apis()
+        """
+        self.by_fullname: dict[str, API] = {}
+        self.by_method: dict[tuple[str, ...], API] = {}
+        for api in standard_apis:
+            self.by_fullname.setdefault(api.fullname, api)
+            self.by_method.setdefault(tuple(api.parts[-2:]), api)
+        self.resolved: dict[str, API | None] = {}
+
+    def standard(self, fullname: str) -> API | None:
+        """
+        Standard API with exactly this fullname, None if there is none
+
+        Args:
+            fullname (str): API fullname
+        """
+        return self.by_fullname.get(fullname)
+
+    def resolve(self, api_str: str) -> API | None:
+        """
+        Standard API of a recommended API, None if it has no standard counterpart
+
+        Args:
+            api_str (str): API string, e.g. java.lang.Integer.parseInt
+
+        Raises:
+            ValueError: If api_str holds no API
+        """
+        if api_str not in self.resolved:
+            api = API(api_str)
+            self.resolved[api_str] = self.by_fullname.get(api.fullname) or self.by_method.get(tuple(api.parts[-2:]))
+        return self.resolved[api_str]
+
+    def precompute(self, api_strs: Iterable[str]) -> None:
+        """
+        Resolve API strings ahead of time, e.g. every method of the javadoc knowledge base
+
+        Args:
+            api_strs (Iterable[str]): API strings, those without an API are skipped
+        """
+        for api_str in api_strs:
+            try:
+                self.resolve(api_str)
+            except ValueError:
+                continue
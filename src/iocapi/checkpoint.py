@@ -0,0 +1,87 @@
+import os
+import json
+import pathlib
+from typing import Any
+
+from loguru import logger
+
+# Stages of one query in rq.py, redoing a stage invalidates the stages after it
+STAGES = ("clarify", "retrieve", "code")
+
+
+class CheckpointLog:
+
+    def __init__(self, path: pathlib.Path, dataset: str, resume: bool = False):
+        """
+        Append-only JSONL log of finished pipeline stages, one record per dataset, query index and stage
+
+        Args:
+            path (pathlib.Path): Path to the log file
+            dataset (str): Dataset name, records of other datasets in the file are ignored
+            resume (bool): Keep the records of an earlier run, otherwise the log starts empty
+        """
+        self.path: pathlib.Path = pathlib.Path(path)
+        self.dataset: str = dataset
+        self.records: dict[int, dict[str, dict[str, Any]]] = {}
+
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        if resume and self.path.exists():
+            self._replay()
+            logger.info(f"Resuming {dataset} from {self.path}: "
+                        + ", ".join(f"{stage} {self.count(stage)}" for stage in STAGES))
+        self._file = open(self.path, "a" if resume else "w", encoding="utf-8")
+
+    def _replay(self) -> None:
+        with open(self.path, "r", encoding="utf-8") as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:  # The last line of a crashed run may be cut off
+                    continue
+                if record.get("dataset") == self.dataset:
+                    self._apply(record["idx"], record["stage"], record["data"], record["ok"])
+
+    def _apply(self, idx: int, stage: str, data: dict[str, Any], ok: bool) -> None:
+        stages = self.records.setdefault(idx, {})
+        for later in STAGES[STAGES.index(stage):]:
+            stages.pop(later, None)
+        if ok:
+            stages[stage] = data
+
+    def get(self, idx: int, stage: str) -> dict[str, Any] | None:
+        """
+        Data of a successfully finished stage, None if it has to be (re)done
+
+        Args:
+            idx (int): Query index
+            stage (str): One of STAGES
+        """
+        return self.records.get(idx, {}).get(stage)
+
+    def count(self, stage: str) -> int:
+        return sum(stage in stages for stages in self.records.values())
+
+    def record(self, idx: int, stage: str, data: dict[str, Any], ok: bool = True) -> None:
+        """
+        Durably append the result of a stage
+
+        Args:
+            idx (int): Query index
+            stage (str): One of STAGES
+            data (dict[str, Any]): JSON serializable result
+            ok (bool): Whether the stage succeeded, failed stages are redone when resuming
+        """
+        record = {"dataset": self.dataset, "idx": idx, "stage": stage, "ok": ok, "data": data}
+        self._file.write(json.dumps(record, ensure_ascii=False) + "\n")
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._apply(idx, stage, data, ok)
+
+    def close(self) -> None:
+        self._file.close()
+
+    def __enter__(self) -> "CheckpointLog":
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
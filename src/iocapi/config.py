@@ -1,15 +1,22 @@
 import os
+import atexit
 import pathlib
 import json
 import asyncio
-from concurrent.futures import ProcessPoolExecutor
 from collections import namedtuple
-from typing import Sequence
+from typing import Callable, Sequence
 
 from dotenv import load_dotenv
 from loguru import logger
 from apiutils import LLMService, API
-from get_top_k_q.get_top_k import get_top_k_apis
+from api_resolver import StandardAPIResolver
+from get_top_k_q import get_top_k
+from get_top_k_q.get_top_k import get_top_k_apis, get_top_k_apis_batch, sweep_top_k_apis
+from llm_cache import LLMCache, CachedLLMService
+from llm_hedge import HedgePolicy
+from llm_limits import LimitedLLMService, TokenBucketLimiter, RetryPolicy
+from retrieval import RetrievalPool
+from tracing import TRACER, traced
 from utils import PromptUtils
 
 load_dotenv(override=True)
@@ -32,6 +39,69 @@ class LLMConfig:
         "base_url": os.getenv("BASE_URL"),
         "api_key": os.getenv("API_KEY"),
     }
+    CACHE: LLMCache | None = None
+    # Shared by every config, so that all requests count against the same provider quota
+    LIMITER: TokenBucketLimiter | None = None
+    RETRY: RetryPolicy | None = RetryPolicy()
+    HEDGE: HedgePolicy | None = None
+
+    @classmethod
+    def enable_cache(cls,
+                     path: pathlib.Path | None = None,
+                     max_entries: int = 100_000,
+                     max_age_days: float = 30.0,
+                     bypass: bool = False) -> LLMCache:
+        """
+        Answer repeated LLM requests of every config from an on-disk cache
+
+        Args:
+            path (pathlib.Path | None): SQLite database, defaults to data/cache/llm_responses.sqlite
+            max_entries (int): Maximum number of cached answers
+            max_age_days (float): Maximum age of a cached answer
+            bypass (bool): Always ask the LLM, but still refresh the cache
+        """
+        if LLMConfig.CACHE is not None:
+            LLMConfig.CACHE.close()
+        LLMConfig.CACHE = LLMCache(path or PathConfig.DATA_DIR / "cache" / "llm_responses.sqlite",
+                                   max_entries, max_age_days, bypass)
+        return LLMConfig.CACHE
+
+    @classmethod
+    def enable_rate_limit(cls,
+                          rpm: int | None = None,
+                          tpm: int | None = None) -> TokenBucketLimiter:
+        """
+        Pace the LLM requests of every config to the quota of the provider
+
+        Args:
+            rpm (int | None): Requests per minute, None for no limit
+            tpm (int | None): Tokens per minute, None for no limit
+        """
+        LLMConfig.LIMITER = TokenBucketLimiter(rpm, tpm)
+        return LLMConfig.LIMITER
+
+    @classmethod
+    def enable_hedging(cls,
+                       percentile: float = 95.0,
+                       timeout: float | None = 120.0) -> HedgePolicy:
+        """
+        Send a duplicate of every LLM request slower than the given latency percentile, and give up after timeout
+
+        Args:
+            percentile (float): Latency percentile of recent requests after which a request is hedged
+            timeout (float | None): Deadline of a request including its duplicate, in seconds
+        """
+        LLMConfig.HEDGE = HedgePolicy(percentile, timeout)
+        return LLMConfig.HEDGE
+
+    @classmethod
+    def llm_service(cls, system_prompt: str) -> LLMService:
+        # Latencies are tracked per config, clarifying and coding take very different times
+        if LLMConfig.CACHE is None:
+            return LimitedLLMService(cls.MODEL_NAME, system_prompt, cls.BASE_CONFIG,
+                                     LLMConfig.LIMITER, LLMConfig.RETRY, LLMConfig.HEDGE, cls.__name__)
+        return CachedLLMService(cls.MODEL_NAME, system_prompt, cls.BASE_CONFIG, LLMConfig.CACHE,
+                                LLMConfig.LIMITER, LLMConfig.RETRY, LLMConfig.HEDGE, cls.__name__)
 
 
 class ClarifyConfig(LLMConfig):
@@ -43,19 +113,47 @@ class ClarifyConfig(LLMConfig):
     }
     ClarifyResponse = namedtuple("ClarifyResponse",
                                  ["demo_input", "demo_output", "statement", "tokens"])
+    _retrieval_pool: RetrievalPool | None = None
+    _api_resolver: StandardAPIResolver | None = None
+    _api_resolver_kb: bool = False
 
     @classmethod
+    @traced()
     async def clarifies(cls,
                         queries: Sequence[str],
                         tqdm_title='Clarifying') -> list["ClarifyConfig.ClarifyResponse"]:
         prompt_path = PathConfig.PROMPT_DIR / "clarifier.md"
         prompt = PromptUtils(prompt_path)
-        clarifier = LLMService(cls.MODEL_NAME,
-                               prompt.sys_prompt,
-                               cls.BASE_CONFIG)
+        clarifier = cls.llm_service(prompt.sys_prompt)
         qs = [prompt.get_prompt(query=q) for q in queries]
         results = await clarifier.queries(qs, tqdm_title=tqdm_title)
-        return await asyncio.gather(*[cls.parse_answer(r.answer, r.tokens) for r in results])
+        responses = await asyncio.gather(*[cls.parse_answer(r.answer, r.tokens) for r in results])
+        spent = [r.tokens for r in results]
+
+        # Malformed answers are asked again with backoff, like the retries of dialog.clarify
+        max_retries = LLMConfig.RETRY.max_retries if LLMConfig.RETRY is not None else 0
+        for retry in range(1, max_retries + 1):
+            failed = [i for i, res in enumerate(responses) if res.statement is None]
+            if not failed:
+                break
+            logger.warning(f"{len(failed)} clarifier responses are not valid JSON, retry {retry}/{max_retries}")
+            if isinstance(clarifier, CachedLLMService):
+                for i in failed:
+                    clarifier.invalidate(qs[i])  # Do not replay the answers that failed
+            await LLMConfig.RETRY.backoff(retry)
+            retried = await clarifier.queries([qs[i] for i in failed], tqdm_title=None)
+            for i, r in zip(failed, retried):
+                spent[i] += r.tokens
+                responses[i] = await cls.parse_answer(r.answer, r.tokens)
+                if responses[i].statement is not None:
+                    responses[i] = responses[i]._replace(tokens=spent[i])
+
+        if isinstance(clarifier, CachedLLMService):
+            # Unparsable answers are asked again next time instead of being replayed
+            for q, res in zip(qs, responses):
+                if res.statement is None:
+                    clarifier.invalidate(q)
+        return list(responses)
 
     @classmethod
     async def parse_answer(cls, response: str, tokens: int) -> "ClarifyConfig.ClarifyResponse":
@@ -76,43 +174,84 @@ class ClarifyConfig(LLMConfig):
         return cls.ClarifyResponse(None, None, None, 0)
 
     @classmethod
+    @traced()
     def get_similar_apis(cls,
                          statement: str,
                          top_k: int) -> list[API]:
-        raw_apis = get_top_k_apis(statement, top_k)
-        similar_apis = [API(api) for api in raw_apis]
-
-        standard_apis = API.get_standard_apis()
-        for i in range(len(similar_apis)-1, -1, -1):
-            api = similar_apis[i]
-            if api.is_standard:
-                for standard_api in standard_apis:
-                    if api.fullname == standard_api.fullname:
-                        similar_apis[i] = standard_api
-                        break
-            else:
-                doc_apis = api.get_possible_standard_apis(first=True)
-                if doc_apis:
-                    similar_apis[i] = doc_apis[0]
-                else:
-                    similar_apis.pop(i)
-
-        return similar_apis
+        return cls.standardize_apis(get_top_k_apis(statement, top_k))
+
+    @classmethod
+    @traced()
+    def get_similar_apis_batch(cls,
+                               statements: Sequence[str],
+                               top_k: int) -> list[list[API]]:
+        return [cls.standardize_apis(raw_apis) for raw_apis in get_top_k_apis_batch(statements, top_k)]
+
+    @classmethod
+    @traced()
+    def get_similar_apis_sweep(cls,
+                               statement: str,
+                               top_ks: Sequence[int],
+                               question_cutoffs: Sequence[int]) -> dict[tuple[int, int], list[API]]:
+        """
+        get_similar_apis for every (question cutoff, top_k) pair, from one retrieval of the statement
+
+        Args:
+            statement (str): Query statement
+            top_ks (Sequence[int]): Numbers of APIs to retrieve
+            question_cutoffs (Sequence[int]): Numbers of most similar questions the APIs are aggregated from
+        """
+        # Standardizing drops unresolved APIs, so every list is standardized from its raw prefix
+        return {setting: cls.standardize_apis(raw_apis)
+                for setting, raw_apis in sweep_top_k_apis(statement, top_ks, question_cutoffs).items()}
+
+    @classmethod
+    @traced()
+    def standardize_apis(cls, raw_apis: Sequence[str]) -> list[API]:
+        resolver = cls.api_resolver()
+        similar_apis = [resolver.resolve(api) for api in raw_apis]
+        return [api for api in similar_apis if api is not None]
+
+    @classmethod
+    def api_resolver(cls) -> StandardAPIResolver:
+        # Built once per process, every method of the javadoc knowledge base is resolved as soon as it is loaded
+        if cls._api_resolver is None:
+            cls._api_resolver = StandardAPIResolver(API.get_standard_apis())
+        if not cls._api_resolver_kb and get_top_k.javadoc_dict_methods is not None:
+            cls._api_resolver.precompute(get_top_k.javadoc_dict_methods.values())
+            cls._api_resolver_kb = True
+        return cls._api_resolver
+
+    @classmethod
+    def retrieval_pool(cls,
+                       max_workers: int | None = None,
+                       wait_ready: bool = True) -> RetrievalPool:
+        # One warm pool per process, reused by every batch and dialog turn; max_workers is the size of a new pool
+        # (None for half of the cpus) and a lower bound for an existing one: a pool at least that large is reused,
+        # a smaller one is replaced, it finishes its running retrievals and cancels those still queued
+        if cls._retrieval_pool is not None and max_workers and cls._retrieval_pool.max_workers < max_workers:
+            logger.info(f"Resizing the retrieval pool from {cls._retrieval_pool.max_workers} to {max_workers} workers")
+            cls._retrieval_pool.collect_traces()  # Spans of the old workers would be lost
+            cls._retrieval_pool.shutdown()
+            cls._retrieval_pool = None
+        if cls._retrieval_pool is None:
+            cls._retrieval_pool = RetrievalPool(cls.get_similar_apis, max_workers, cls.get_similar_apis_batch)
+        return cls._retrieval_pool.start(wait_ready)
+
+    @classmethod
+    def existing_retrieval_pool(cls) -> RetrievalPool | None:
+        # The pool of retrieval_pool if one was started, e.g. for its stats, without starting one
+        return cls._retrieval_pool
 
     @classmethod
     async def batch_get_similar_apis(cls,
                                      statements: Sequence[str],
                                      top_k: int,
-                                     max_workers: int | None = (os.cpu_count() or 0)//2
+                                     max_workers: int | None = None,
+                                     on_result: Callable[[int, list[API]], None] | None = None
                                      ) -> list[list[API]]:
-        loop = asyncio.get_running_loop()
-        with ProcessPoolExecutor(max_workers=max_workers) as pool:
-            tasks = [
-                loop.run_in_executor(pool, cls.get_similar_apis, stmt, top_k)
-                for stmt in statements
-            ]
-
-            results: list[list[API]] = await asyncio.gather(*tasks)
+        pool = cls.retrieval_pool(max_workers)
+        results: list[list[API]] = await pool.map_batches(statements, top_k, on_result)
         return results
 
 
@@ -123,19 +262,24 @@ class CoderConfig(LLMConfig):
                               ["code", "apis", "add_info", "tokens"])
 
     @classmethod
+    @traced()
     async def code(cls,
                    clarifiers_res: Sequence[ClarifyConfig.ClarifyResponse],
-                   java_api_lists: Sequence[Sequence[API]]) -> list["CoderConfig.CodeResponse"]:
+                   java_api_lists: Sequence[Sequence[API]],
+                   tqdm_title='Coding') -> list["CoderConfig.CodeResponse"]:
         prompt_path = PathConfig.PROMPT_DIR / "coder.md"
         prompt = PromptUtils(prompt_path)
-        coder = LLMService(CoderConfig.MODEL_NAME,
-                           prompt.sys_prompt,
-                           CoderConfig.BASE_CONFIG)
+        coder = cls.llm_service(prompt.sys_prompt)
         qs = await asyncio.gather(*[cls.construct_prompt(prompt, c_res, java_api_list)
                                   for c_res, java_api_list
                                   in zip(clarifiers_res, java_api_lists)])
-        results = await coder.queries(qs, tqdm_title='Coding')
+        results = await coder.queries(qs, tqdm_title=tqdm_title)
         answers = await asyncio.gather(*[cls.parse_coder_response(r.answer) for r in results])
+        if isinstance(coder, CachedLLMService):
+            # Answers without code or APIs, e.g. cut off mid-stream, are asked again next time instead of being replayed
+            for q, ans in zip(qs, answers):
+                if ans[0] == '-' and not ans[1]:
+                    coder.invalidate(q)
         return [CoderConfig.CodeResponse(
                 code=ans[0],
                 apis=ans[1],
@@ -158,6 +302,7 @@ class CoderConfig(LLMConfig):
                                  java_api_list=api_list_format)
 
     @classmethod
+    @traced()
     async def parse_coder_response(cls, response: str) -> tuple[str, list[API], str]:
         info = [ch for ch in response.split('#') if ch]
         code = '-'
@@ -178,6 +323,20 @@ class CoderConfig(LLMConfig):
         return code, apis, add_info
 
 
+if os.getenv("LLM_CACHE", "").lower() in ("1", "true", "yes"):
+    LLMConfig.enable_cache(bypass=os.getenv("LLM_CACHE_BYPASS", "").lower() in ("1", "true", "yes"))
+if os.getenv("RETRIEVAL_CACHE", "").lower() in ("1", "true", "yes", "memory", "disk"):
+    get_top_k.enable_retrieval_cache(disk=os.getenv("RETRIEVAL_CACHE", "").lower() == "disk")
+if os.getenv("IOCAPI_TRACE"):
+    # Summary (and Chrome trace) of the spans are written when the process exits
+    TRACER.enable(chrome=bool(os.getenv("IOCAPI_CHROME_TRACE")))
+    atexit.register(TRACER.save, os.getenv("IOCAPI_TRACE"), os.getenv("IOCAPI_CHROME_TRACE") or None)
+if os.getenv("LLM_HEDGE_PERCENTILE"):
+    LLMConfig.enable_hedging(float(os.getenv("LLM_HEDGE_PERCENTILE")), float(os.getenv("LLM_TIMEOUT") or 120))
+if os.getenv("LLM_RPM") or os.getenv("LLM_TPM"):
+    LLMConfig.enable_rate_limit(int(os.getenv("LLM_RPM") or 0) or None, int(os.getenv("LLM_TPM") or 0) or None)
+
+
 async def test():
     LLMService.set_llm_client_config(**LLMConfig.CLIENT_CONFIG)
     # Tests
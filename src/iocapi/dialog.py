@@ -3,43 +3,27 @@ import asyncio
 from typing import Sequence
 
 from loguru import logger
-from get_top_k_q.get_top_k import get_top_k_apis
 from config import PathConfig, ClarifyConfig, CoderConfig, LLMConfig
+from llm_cache import CachedLLMService
 from utils import PromptUtils
 from apiutils import LLMService, API
+from tracing import traced
 
 LLMService.set_llm_client_config(**LLMConfig.CLIENT_CONFIG)
 
 
 async def get_similar_apis(statement: str,
                            top_k: int = CoderConfig.TOP_K) -> list[API]:
-    similar_apis = [API(api) for api in get_top_k_apis(statement, top_k)]
-
-    standard_apis = API.get_standard_apis()
-    for i in range(len(similar_apis)-1, -1, -1):
-        api = similar_apis[i]
-        if api.is_standard:
-            for standard_api in standard_apis:
-                if api.fullname == standard_api.fullname:
-                    similar_apis[i] = standard_api
-                    break
-        else:
-            doc_apis = api.get_possible_standard_apis(first=True)
-            if doc_apis:
-                similar_apis[i] = doc_apis[0]
-            else:
-                similar_apis.pop(i)
-
-    return similar_apis
+    # Whatever pool the process already has, a batch-sized one is not replaced by a smaller one
+    return await ClarifyConfig.retrieval_pool().submit(statement, top_k)
 
 
+@traced()
 async def code(clarifier_res: ClarifyConfig.ClarifyResponse,
                java_api_list: Sequence[API]) -> CoderConfig.CodeResponse:
     prompt_path = PathConfig.PROMPT_DIR / "coder.md"
     prompt = PromptUtils(prompt_path)
-    coder = LLMService(CoderConfig.MODEL_NAME,
-                       prompt.sys_prompt,
-                       CoderConfig.BASE_CONFIG)
+    coder = CoderConfig.llm_service(prompt.sys_prompt)
     api_list_format = ""
     for i, api in enumerate(java_api_list):
         api_list_format += f"API {i + 1}: {api.fullname}\n"
@@ -58,17 +42,21 @@ async def code(clarifier_res: ClarifyConfig.ClarifyResponse,
     )
 
 
+@traced()
 async def clarify(query: str) -> ClarifyConfig.ClarifyResponse:
     prompt_path = PathConfig.PROMPT_DIR / "clarifier.md"
     prompt = PromptUtils(prompt_path)
-    clarifier = LLMService(ClarifyConfig.MODEL_NAME,
-                           prompt.sys_prompt,
-                           ClarifyConfig.BASE_CONFIG)
+    clarifier = ClarifyConfig.llm_service(prompt.sys_prompt)
     q = prompt.get_prompt(query=query)
     tokens, retry = 0, 0
     demo_input, demo_output, statement = None, None, None
     ans = {}
     while retry < 3:
+        if retry > 0:
+            if isinstance(clarifier, CachedLLMService):
+                clarifier.invalidate(q)  # Do not replay the answer that failed
+            if LLMConfig.RETRY is not None:
+                await LLMConfig.RETRY.backoff(retry)
         res, t = await clarifier.query(q)
         tokens += t
         try:
@@ -97,6 +85,8 @@ async def clarify(query: str) -> ClarifyConfig.ClarifyResponse:
 
 
 async def dialog():
+    # Load the knowledge base in the background while the user is typing, one worker unless a pool is running already
+    ClarifyConfig.retrieval_pool(max_workers=1, wait_ready=False)
     q = input("Question: ")
     clarifier_res = await clarify(q)
     while True:
@@ -114,13 +104,17 @@ async def dialog():
     print("Demonstrate Code:")
     print(coder_res.code)
     print("APIs You Might Need:")
-    standard_apis = API.get_standard_apis()
+    resolver = ClarifyConfig.api_resolver()
     for api in coder_res.apis:
-        for a in standard_apis:
-            if a.fullname == api.fullname:
-                print(f" - {a.fullname}: {a.description}")
-                break
+        a = resolver.standard(api.fullname)
+        if a is not None:
+            print(f" - {a.fullname}: {a.description}")
     print(f"Tokens Used: {clarifier_res.tokens + coder_res.tokens}")
+    if LLMConfig.HEDGE is not None:
+        LLMConfig.HEDGE.log_stats()
+    retrieval_pool = ClarifyConfig.existing_retrieval_pool()
+    if retrieval_pool is not None:  # Spans of the workers, without starting a pool just for them
+        retrieval_pool.collect_traces()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,105 @@
+import numpy as np
+
+
+class QuestionFilter:
+
+    # the per-query filters of get_topk_questions, precomputed once for the whole knowledge base
+    # valid: whether the i-th question has an answer with a non-negative score, and is not removed
+    # alive: whether the i-th question is not removed, see remove
+    # parent: question id -> id of the first question with exactly the same title (duplicate clusters),
+    #     only ranked with get_top_k.exclude_duplicate_titles
+    # titles are indexed twice to find "the same question" as the query without scanning every title:
+    # a hash index for titles contained in the query, and a trigram index for titles containing the query
+
+    def __init__(self, questions):
+        self.ids = [question.id for question in questions]
+        self.titles = [question.title for question in questions]
+        self.valid = np.array([any(int(answer.score)>=0 for answer in question.answers) for question in questions],
+                              dtype=bool)
+        self.alive = np.ones(len(questions), dtype=bool)
+
+        self.title_index = dict()  # title -> indices of the questions with this title
+        self.parent = dict()
+        for i, title in enumerate(self.titles):
+            self.title_index.setdefault(title, []).append(i)
+            self.parent[self.ids[i]] = self.ids[self.title_index[title][0]]
+        self.title_lengths = sorted(set(len(title) for title in self.title_index))
+
+        grams = dict()
+        for i, title in enumerate(self.titles):
+            for gram in set(title[j:j+3] for j in range(len(title) - 2)):
+                grams.setdefault(gram, []).append(i)
+        self.grams = {gram: np.array(indices, dtype=np.int32) for gram, indices in grams.items()}
+
+    def titles_in_query(self, query):
+        # every substring of the query that has the length of some title is looked up
+        matches = list()
+        for length in self.title_lengths:
+            if length > len(query):
+                break
+            for i in range(len(query) - length + 1):
+                matches.extend(self.title_index.get(query[i:i+length], ()))
+        return matches
+
+    def titles_containing(self, query):
+        if len(query) < 3:
+            return [i for i, title in enumerate(self.titles) if query in title and self.alive[i]]
+
+        # the questions sharing the rarest trigram of the query are the only ones that can contain it
+        rarest = None
+        for gram in set(query[j:j+3] for j in range(len(query) - 2)):
+            if gram not in self.grams:
+                return []
+            if rarest is None or len(self.grams[gram]) < len(rarest):
+                rarest = self.grams[gram]
+        return [i for i in rarest.tolist() if query in self.titles[i] and self.alive[i]]
+
+    def same_question(self, query):
+        # id of the last question whose title equals, is part of or contains the query, '-1' if there is none
+        matches = self.titles_in_query(query) + self.titles_containing(query)
+        if not matches:
+            return '-1'
+        return self.ids[max(matches)]
+
+    def extend(self, questions):
+        # appends questions, the filter is the same as one built from all questions at once
+        start = len(self.ids)
+        self.ids.extend(question.id for question in questions)
+        self.titles.extend(question.title for question in questions)
+        self.valid = np.concatenate([self.valid, [any(int(answer.score)>=0 for answer in question.answers)
+                                                  for question in questions]]).astype(bool)
+        self.alive = np.concatenate([self.alive, np.ones(len(questions), dtype=bool)])
+
+        grams = dict()
+        for i in range(start, len(self.ids)):
+            title = self.titles[i]
+            self.title_index.setdefault(title, []).append(i)
+            self.parent[self.ids[i]] = self.ids[self.title_index[title][0]]
+            for gram in set(title[j:j+3] for j in range(len(title) - 2)):
+                grams.setdefault(gram, []).append(i)
+        for gram, indices in grams.items():
+            if gram in self.grams:
+                self.grams[gram] = np.concatenate([self.grams[gram], np.array(indices, dtype=np.int32)])
+            else:
+                self.grams[gram] = np.array(indices, dtype=np.int32)
+        self.title_lengths = sorted(set(len(title) for title in self.title_index))
+
+    def remove(self, indices):
+        # removed questions are never ranked nor matched as the same question as the query,
+        # and a duplicate cluster whose first question is removed gets the next one as its parent
+        titles = set()
+        for i in indices:
+            if not self.alive[i]:
+                continue
+            self.alive[i] = False
+            self.valid[i] = False
+            titles.add(self.titles[i])
+        for title in titles:
+            members = [i for i in self.title_index[title] if self.alive[i]]
+            if members:
+                self.title_index[title] = members
+                for i in members:
+                    self.parent[self.ids[i]] = self.ids[members[0]]
+            else:
+                del self.title_index[title]
+        self.title_lengths = sorted(set(len(title) for title in self.title_index))
@@ -0,0 +1,116 @@
+import numpy as np
+from get_top_k_q.algorithm import similarity
+
+
+# first stage of the two-stage question retrieval: an inverted file (IVF) index
+# every document is summarized by the idf-weighted mean of its word vectors, the summaries are
+# partitioned by spherical k-means, and a query only looks at the documents of its closest partitions
+
+
+def normalize_rows(matrix):
+    norm = np.linalg.norm(matrix, axis=1).reshape(-1, 1)
+    return np.divide(matrix, norm, out=np.zeros_like(matrix), where=norm!=0)
+
+
+def mean_embedding(matrix, idf_vector):
+    return normalize_rows(idf_vector.reshape(1, -1).dot(matrix))[0]
+
+
+def mean_embeddings(store, block_size=16384):
+    means = np.zeros((len(store), store.matrix.shape[1]))
+    for begin in range(0, len(store), block_size):
+        end = min(begin + block_size, len(store))
+        row_begin, row_end = store.offsets[begin], store.offsets[end]
+        weighted = store.rows(row_begin, row_end) * store.idf[row_begin:row_end].reshape(-1, 1)
+        means[begin:end] = np.add.reduceat(weighted, store.offsets[begin:end] - row_begin, axis=0)
+
+    return normalize_rows(means)
+
+
+def assign(points, centroids, block_size=16384):
+    labels = np.zeros(len(points), dtype=np.int64)
+    for begin in range(0, len(points), block_size):
+        labels[begin:begin + block_size] = points[begin:begin + block_size].dot(centroids.T).argmax(axis=1)
+    return labels
+
+
+def kmeans(points, n_lists, n_iter=10, seed=0):
+    # spherical k-means, i.e. on cosine similarity, empty lists are re-seeded with random points
+    rng = np.random.default_rng(seed)
+    centroids = points[rng.choice(len(points), n_lists, replace=False)]
+    for _ in range(n_iter):
+        labels = assign(points, centroids)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, labels, points)
+        empty = np.bincount(labels, minlength=n_lists) == 0
+        sums[empty] = points[rng.choice(len(points), empty.sum(), replace=False)]
+        centroids = normalize_rows(sums)
+
+    return centroids, assign(points, centroids)
+
+
+class CandidateIndex:
+
+    def __init__(self, centroids, list_offsets, list_members):
+        # the members of list i are list_members[list_offsets[i]:list_offsets[i+1]], ascending document indices
+        self.centroids = centroids
+        self.list_offsets = list_offsets
+        self.list_members = list_members
+
+    @classmethod
+    def build(cls, store, n_lists=None, n_iter=10, seed=0):
+        points = mean_embeddings(store)
+        if n_lists is None:
+            n_lists = int(np.sqrt(len(store)))  # about as many lists as documents per list
+        n_lists = max(1, min(n_lists, len(store)))
+
+        centroids, labels = kmeans(points, n_lists, n_iter, seed)
+        list_members = np.argsort(labels, kind='stable')
+        list_offsets = np.zeros(n_lists + 1, dtype=np.int64)
+        np.cumsum(np.bincount(labels, minlength=n_lists), out=list_offsets[1:])
+
+        return cls(centroids, list_offsets, list_members)
+
+    def extend(self, store, start):
+        # adds the documents start: of store to their closest lists, the centroids stay as they are,
+        # so the lists drift from a fresh build as more documents are added
+        labels = np.zeros(len(store), dtype=np.int64)
+        labels[self.list_members] = np.repeat(np.arange(len(self.centroids)), np.diff(self.list_offsets))
+        labels[start:] = assign(mean_embeddings(store.subset(np.arange(start, len(store)))), self.centroids)
+
+        self.list_members = np.argsort(labels, kind='stable')
+        self.list_offsets = np.zeros(len(self.centroids) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(labels, minlength=len(self.centroids)), out=self.list_offsets[1:])
+
+    def search(self, query_matrix, query_idf_vector, n_candidates):
+        # probes the closest lists until at least n_candidates documents are collected
+        # the result is sorted, so ties in the exact ranking keep the order of the knowledge base
+        query_vector = mean_embedding(query_matrix, query_idf_vector)
+        probes = np.argsort(-self.centroids.dot(query_vector), kind='stable')
+        sizes = np.diff(self.list_offsets)[probes]
+        n_probes = min(len(probes), int(np.searchsorted(np.cumsum(sizes), n_candidates)) + 1)
+
+        candidates = [self.list_members[self.list_offsets[i]:self.list_offsets[i + 1]] for i in probes[:n_probes]]
+        return np.sort(np.concatenate(candidates))
+
+
+def sim_doc_candidates(query_matrix, query_idf_vector, store, candidate_index, n_candidates):
+    # returns the candidate document indices and their exact sim_doc_pair scores
+    candidates = candidate_index.search(query_matrix, query_idf_vector, n_candidates)
+    return candidates, similarity.sim_doc_batch(query_matrix, query_idf_vector, store.subset(candidates))
+
+
+def measure_recall(queries, store, candidate_index, n_candidates, topk=50):
+    # mean share of the exhaustive top-k documents that the two-stage search also ranks in its top-k
+    # queries is a list of (query_matrix, query_idf_vector) pairs
+    recalls = list()
+    for query_matrix, query_idf_vector in queries:
+        sims = similarity.sim_doc_batch(query_matrix, query_idf_vector, store)
+        exact = set(np.argsort(-sims, kind='stable')[:topk].tolist())
+
+        candidates, candidate_sims = sim_doc_candidates(query_matrix, query_idf_vector, store,
+                                                        candidate_index, n_candidates)
+        approx = set(candidates[np.argsort(-candidate_sims, kind='stable')[:topk]].tolist())
+        recalls.append(len(exact & approx) / max(1, len(exact)))
+
+    return float(np.mean(recalls)) if recalls else 1.0
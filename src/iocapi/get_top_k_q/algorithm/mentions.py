@@ -0,0 +1,82 @@
+from collections import namedtuple
+from bs4 import BeautifulSoup
+import get_top_k_q.util as util
+
+
+# what the answers (with a non-negative score) of one question say about APIs
+# methods: deduplicated full method names, from javadoc links and <code> tags
+# classes: (full class name, number of mentions) pairs, from javadoc links and <code> tags
+# snippets: the first <pre> block of every answer, if it has at most 5 lines
+# position: index of the question in the knowledge base, keeps aggregation in knowledge base order
+Mentions = namedtuple('Mentions', ['methods', 'classes', 'snippets', 'position'])
+
+
+def is_javadoc_link(link):
+    return 'docs.oracle.com/javase/' in link and '/api/' in link and 'html' in link
+
+
+def code_name(code):
+    # <code>Integer.parseInt(s)</code> -> Integer.parseInt
+    pos = code.find('(')
+    if pos != -1:
+        code = code[:pos]
+    return code
+
+
+def extract_mentions(question, position, javadoc_dict_classes, javadoc_dict_methods):
+    methods = dict()  # used as an ordered set
+    classes = dict()
+    snippets = list()
+
+    for answer in question.answers:
+
+        if int(answer.score)<0:
+            continue
+
+        soup = BeautifulSoup(answer.body, 'html.parser')
+
+        for link in soup.find_all('a'):
+            link = link.get('href', '')
+            if not is_javadoc_link(link):
+                continue
+            try:
+                pair = util.parse_api_link(link)  # pair[0] is class name, pair[1] is method name
+            except (ValueError, IndexError):  # malformed links would otherwise break the whole build
+                continue
+            classes[pair[0]] = classes.get(pair[0], 0) + 1
+            if pair[1] != '':
+                methods[pair[0] + '.' + pair[1]] = None
+
+        for code in soup.find_all('code'):
+            code = code_name(code.get_text())
+            if code in javadoc_dict_methods:
+                methods[javadoc_dict_methods[code]] = None
+            if code in javadoc_dict_classes:
+                class_name = javadoc_dict_classes[code]
+                classes[class_name] = classes.get(class_name, 0) + 1
+
+        code_snippet = soup.find('pre')
+        if code_snippet is not None and code_snippet.get_text().count('\n') <= 5:
+            snippets.append(code_snippet.get_text())
+
+    if not methods and not classes and not snippets:
+        return None
+
+    return Mentions(tuple(methods), tuple(classes.items()), tuple(snippets), position)
+
+
+def build_mention_index(questions, javadoc_dict_classes, javadoc_dict_methods):
+    # parses every answer once, the key is question id, questions without any mention are left out
+    mention_index = dict()
+    for position, question in enumerate(questions):
+        mentions = extract_mentions(question, position, javadoc_dict_classes, javadoc_dict_methods)
+        if mentions is not None:
+            mention_index[question.id] = mentions
+
+    return mention_index
+
+
+def mentioned_questions(top_questions, mention_index):
+    # ids of the top questions that mention any API, in knowledge base order
+    question_ids = [question_id for question_id in top_questions if question_id in mention_index]
+    return sorted(question_ids, key=lambda question_id: mention_index[question_id].position)
@@ -0,0 +1,66 @@
+from functools import lru_cache
+from nltk.stem import SnowballStemmer
+from nltk.tokenize import WordPunctTokenizer
+import numpy as np
+
+
+# text normalization shared by the knowledge base build and the queries,
+# the tokenizer and the stemmer are created once instead of once per word
+
+tokenizer = WordPunctTokenizer()
+stemmer = SnowballStemmer('english')
+
+
+@lru_cache(maxsize=1 << 18)
+def stem(word):
+    return stemmer.stem(word)
+
+
+def tokenize(text):
+    return tokenizer.tokenize(text.lower())
+
+
+def clean_query(query):
+    return query.replace('"', '').replace("'", '').replace('.', '').replace('?', '')
+
+
+def stem_words(words):
+    return [stem(word) for word in words]
+
+
+class Vocabulary:
+
+    # every word of the w2v model or the idf file gets an id, ids index the rows of
+    # matrix (the l2 normalized word vectors) and idf (the idf values), unknown words map to a zero row
+    # doc_matrix and doc_idf_vector return the same arrays as similarity.init_doc_matrix and init_doc_idf_vector
+
+    def __init__(self, words, matrix, idf):
+        self.words = words
+        self.word_index = {word: i for i, word in enumerate(words)}
+        self.matrix = matrix
+        self.idf = idf
+        self.unknown = len(words)
+
+    @classmethod
+    def build(cls, w2v, idf):
+        words = list(w2v.wv.index_to_key)
+        words.extend(word for word in idf if word not in w2v.wv.key_to_index)
+
+        vectors = np.zeros((len(words) + 1, w2v.wv.vector_size))
+        vectors[:len(w2v.wv.index_to_key)] = w2v.wv.vectors
+        norm = np.linalg.norm(vectors, axis=1).reshape(-1, 1)
+        matrix = np.divide(vectors, norm, out=np.zeros_like(vectors), where=norm!=0)
+
+        vocabulary = cls(words, matrix, np.zeros(len(words) + 1))
+        for word, value in idf.items():
+            vocabulary.idf[vocabulary.word_index[word]] = value[1]
+        return vocabulary
+
+    def ids(self, words):
+        return np.array([self.word_index.get(word, self.unknown) for word in words], dtype=np.int64)
+
+    def doc_matrix(self, words):
+        return self.matrix[self.ids(words)]
+
+    def doc_idf_vector(self, words):
+        return self.idf[self.ids(words)].reshape(1, -1)
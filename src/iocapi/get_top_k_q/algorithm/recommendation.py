@@ -1,52 +1,77 @@
-from nltk.stem import SnowballStemmer
-from nltk.tokenize import WordPunctTokenizer
-from bs4 import BeautifulSoup
-from get_top_k_q.algorithm import similarity
-import get_top_k_q.util as util
+from get_top_k_q.algorithm import ivf, mentions, normalize, similarity
+from get_top_k_q.algorithm.store import pack_javadoc_methods
 import math
+import numpy as np
 
-def preprocess_all_questions(questions,idf,w2v):
+def preprocess_all_questions(questions,idf,w2v,vocabulary=None):
+    # vocabulary is an optional normalize.Vocabulary of w2v and idf, it is built here if not given
+    if vocabulary is None:
+        vocabulary = normalize.Vocabulary.build(w2v, idf)
     processed_questions = list()
     for question in questions:
-        title_words = WordPunctTokenizer().tokenize(question.title.lower())
+        title_words = normalize.tokenize(question.title)
         if title_words[-1] == '?':
             title_words = title_words[:-1]
         if len(title_words) <= 3:
             continue
-        title_words = [SnowballStemmer('english').stem(word) for word in title_words]
+        title_words = normalize.stem_words(title_words)
         question.title_words = title_words
-        question.matrix = similarity.init_doc_matrix(question.title_words, w2v)
-        question.idf_vector = similarity.init_doc_idf_vector(question.title_words, idf)
+        question.matrix = vocabulary.doc_matrix(question.title_words)
+        question.idf_vector = vocabulary.doc_idf_vector(question.title_words)
         processed_questions.append(question)
 
     return processed_questions
 
 
-def preprocess_javadoc(javadoc,javadoc_dict_classes,javadoc_dict_methods,idf,w2v):
+def preprocess_javadoc(javadoc,javadoc_dict_classes,javadoc_dict_methods,idf,w2v,vocabulary=None):
+    # returns the method store and the full name index of store.pack_javadoc_methods
+    if vocabulary is None:
+        vocabulary = normalize.Vocabulary.build(w2v, idf)
     for api in javadoc:
         javadoc_dict_classes[api.class_name] = api.package_name+'.'+api.class_name
 
-        description_words = [SnowballStemmer('english').stem(word) for word in api.class_description]
-        api.class_description_matrix = similarity.init_doc_matrix(description_words,w2v)
-        api.class_description_idf_vector = similarity.init_doc_idf_vector(description_words,idf)
         for api_method in api.methods_descriptions_stemmed:
-            api.methods_matrix.append(similarity.init_doc_matrix(api_method,w2v))
-            api.methods_idf_vector.append(similarity.init_doc_idf_vector(api_method,idf))
+            api.methods_matrix.append(vocabulary.doc_matrix(api_method))
+            api.methods_idf_vector.append(vocabulary.doc_idf_vector(api_method))
         for api_method in api.methods:
             javadoc_dict_methods[api.class_name+'.'+api_method] = api.package_name+'.'+api.class_name+'.'+api_method
 
+    return pack_javadoc_methods(javadoc)
 
-def get_topk_questions(origin_query, query_matrix, query_idf_vector, questions, topk, parent):
+
+def preprocess_class_descriptions(javadoc,vocabulary):
+    # the class description matrices, which no recommendation reads, so preprocess_javadoc leaves them out
+    for api in javadoc:
+        description_words = normalize.stem_words(api.class_description)
+        api.class_description_matrix = vocabulary.doc_matrix(description_words)
+        api.class_description_idf_vector = vocabulary.doc_idf_vector(description_words)
+
+
+def get_topk_questions(origin_query, query_matrix, query_idf_vector, questions, topk, parent, store=None,
+                       candidate_index=None, n_candidates=3000, question_filter=None, sims=None):
 
     # this function returns a dictionary of the top-k most relevant questions of the query
     # the key is question id, the value is the similarity between the question and the query
+    # store is an optional DocStore packed from questions (in the same order), which scores all questions at once
+    # candidate_index is an optional ivf.CandidateIndex of the store, then only about n_candidates questions are scored
+    # question_filter is an optional filters.QuestionFilter of questions, it replaces the scans over all questions
+    # sims are optional precomputed scores of every question of the store, e.g. from similarity.sim_doc_batch_multi
 
     query_id = '-1'
-    for question in questions:
-        if question.title == origin_query or question.title in origin_query or origin_query in question.title:  # the same question should not appear in the dataset
-            query_id = question.id
-            if query_id not in parent:
-                parent[query_id] = query_id
+    if question_filter is not None:
+        query_id = question_filter.same_question(origin_query)  # the same question should not appear in the dataset
+        if query_id != '-1' and query_id not in parent:
+            parent[query_id] = query_id
+    else:
+        for question in questions:
+            if question.title == origin_query or question.title in origin_query or origin_query in question.title:  # the same question should not appear in the dataset
+                query_id = question.id
+                if query_id not in parent:
+                    parent[query_id] = query_id
+
+    if store is not None:
+        return get_topk_questions_packed(query_id, query_matrix, query_idf_vector, questions, topk, parent, store,
+                                         candidate_index, n_candidates, question_filter, sims)
 
     relevant_questions = list()
     for question in questions:
@@ -75,64 +100,81 @@ def get_topk_questions(origin_query, query_matrix, query_idf_vector, questions,
 
     return top_questions
 
-def summarize_api_method(api_method, top_questions, questions, javadoc,javadoc_dict_methods):
-    for api in javadoc:
-        for i, method in enumerate(api.methods):
-            if api.package_name + '.' + api.class_name + '.' + method == api_method:
-                print('>>>JavaDoc<<<')
-                print(api.methods_descriptions_pure_text[i].replace('\n',' ').replace('  ',' ').split('.')[0]+'.')
-                break
 
-    titles = dict()
-    code_snippets = dict()
+def get_topk_questions_packed(query_id, query_matrix, query_idf_vector, questions, topk, parent, store,
+                              candidate_index=None, n_candidates=3000, question_filter=None, sims=None):
 
-    method_pure_name = api_method.split('.')[-1]
+    # same ranking as the loop in get_topk_questions, but every question is scored in one batch
+    # and the filters are only applied while walking down the ranking
 
-    for question in questions:
-        if question.id not in top_questions:
+    if sims is not None:
+        candidates = np.arange(len(store))
+    elif candidate_index is not None and n_candidates < len(store):
+        candidates, sims = ivf.sim_doc_candidates(query_matrix, query_idf_vector, store, candidate_index, n_candidates)
+    else:
+        candidates, sims = np.arange(len(store)), similarity.sim_doc_batch(query_matrix, query_idf_vector, store)
+    order = np.argsort(-sims, kind='stable')  # stable, so ties keep the order of the questions
+
+    top_questions = dict()
+    for j in order:
+        question = questions[candidates[j]]
+
+        if query_id in parent and question.id in parent and parent[query_id] == parent[question.id]: #duplicate questions
+            continue
+
+        if question_filter is not None:
+            valid = question_filter.valid[candidates[j]]
+        else:
+            valid = False
+            for answer in question.answers:
+                if int(answer.score)>=0:
+                    valid = True
+        if not valid:
             continue
 
-        contains_api = False
+        top_questions[question.id] = sims[j]
+        if len(top_questions) == topk:
+            break
 
-        for answer in question.answers:
+    if len(top_questions) < topk and len(candidates) < len(store):  # too few candidates survived the filters
+        return get_topk_questions_packed(query_id, query_matrix, query_idf_vector, questions, topk, parent, store,
+                                         question_filter=question_filter)
 
-            soup = BeautifulSoup(answer.body, 'html.parser')
+    return top_questions
 
 
+def summarize_api_method(api_method, top_questions, questions, javadoc,javadoc_dict_methods,mention_index=None,method_index=None):
+    if method_index is not None:
+        for _, api_i, i in method_index.get(api_method, ()):
+            print('>>>JavaDoc<<<')
+            print(javadoc[api_i].methods_descriptions_pure_text[i].replace('\n',' ').replace('  ',' ').split('.')[0]+'.')
+    else:
+        for api in javadoc:
+            for i, method in enumerate(api.methods):
+                if api.package_name + '.' + api.class_name + '.' + method == api_method:
+                    print('>>>JavaDoc<<<')
+                    print(api.methods_descriptions_pure_text[i].replace('\n',' ').replace('  ',' ').split('.')[0]+'.')
+                    break
 
-            links = soup.find_all('a')
-            for link in links:
-                link = link['href']
-                if 'docs.oracle.com/javase/' in link and '/api/' in link and 'html' in link:
-                    pair = util.parse_api_link(link)  # pair[0] is class name, pair[1] is method name
+    if mention_index is None:
+        mention_index = mentions.build_mention_index([question for question in questions if question.id in top_questions],
+                                                     dict(), javadoc_dict_methods)
 
-                    if pair[1] != '':
-                        method_name = pair[0] + '.' + pair[1]
-                        if method_name == api_method:
-                            titles[question.title] = top_questions[question.id]
-                            contains_api = True
+    titles = dict()
+    code_snippets = dict()
 
-            codes = soup.find_all('code')
-            for code in codes:
-                code = code.get_text()
-                pos = code.find('(')
-                if pos != -1:
-                    code = code[:pos]
-                if code in javadoc_dict_methods:
-                    method_name = javadoc_dict_methods[code]
-                    if method_name == api_method:
-                        titles[question.title] = top_questions[question.id]
-                        contains_api = True
+    method_pure_name = api_method.split('.')[-1]
 
-        if contains_api:
-            snippet_list = list()
-            for answer in question.answers:
-                soup = BeautifulSoup(answer.body, 'html.parser')
-                code_snippet = soup.find('pre')
-                if code_snippet is not None and code_snippet.get_text().count('\n') <= 5 \
-                        and '.'+method_pure_name+'(' in code_snippet.get_text():
-                    snippet_list.append(code_snippet.get_text())
-            code_snippets[question.title] = snippet_list
+    for question in questions:
+        if question.id not in top_questions or question.id not in mention_index:
+            continue
+
+        question_mentions = mention_index[question.id]
+
+        if api_method in question_mentions.methods:
+            titles[question.title] = top_questions[question.id]
+            code_snippets[question.title] = [code_snippet for code_snippet in question_mentions.snippets
+                                             if '.'+method_pure_name+'(' in code_snippet]
 
     titles = sorted(titles.items(), key=lambda item: item[1], reverse=True)
 
@@ -171,66 +213,31 @@ def summarize_api_method(api_method, top_questions, questions, javadoc,javadoc_d
         print('-----------------------------------------------\n')
 
 
-def recommend_api(query_matrix,query_idf_vector,top_questions,questions,javadoc,javadoc_dict_methods,topk):
+def recommend_api(query_matrix,query_idf_vector,top_questions,questions,javadoc,javadoc_dict_methods,topk,mention_index=None,
+                  method_store=None,method_index=None):
     # remember that top_questions is a dictionary of the top-k most relevant questions of the query
     # the key is question id, the value is the similarity between the question and the query
     # questions is a list including all questions (api related) in StackOverflow
     # javadoc is a list including all api classes
+    # mention_index is the index of mentions.build_mention_index, it is built for the top questions if missing
+    # method_store and method_index come from preprocess_javadoc, with them only the mentioned methods are scored
+
+    if mention_index is None:
+        mention_index = mentions.build_mention_index([question for question in questions if question.id in top_questions],
+                                                     dict(), javadoc_dict_methods)
 
     api_methods = dict() #stores the SO_sim of api method and the query
     api_methods_count = dict()
 
-    for question in questions:
-        if question.id not in top_questions:
-            continue
-
-        tmp_set = set()
-
-        for answer in question.answers:
-
-            if int(answer.score)<0:
-                continue
+    for question_id in mentions.mentioned_questions(top_questions, mention_index):
 
-            soup = BeautifulSoup(answer.body, 'html.parser')
-            links = soup.find_all('a')
-            for link in links:
-                link = link['href']
-                if 'docs.oracle.com/javase/' in link and '/api/' in link and 'html' in link:
-                    pair = util.parse_api_link(link)  # pair[0] is class name, pair[1] is method name
-
-                    if pair[1] != '':
-                        method_name = pair[0] + '.' + pair[1]
-                        if method_name in tmp_set:
-                            continue
-                        else:
-                            tmp_set.add(method_name)
-                            if method_name in api_methods:
-                                api_methods[method_name] += top_questions[question.id]
-                                api_methods_count[method_name] += 1
-                            else:
-                                api_methods[method_name] = top_questions[question.id]
-                                api_methods_count[method_name] = 1.0
-
-
-            codes = soup.find_all('code')
-            for code in codes:
-                code = code.get_text()
-                pos = code.find('(')
-                if pos != -1:
-                    code = code[:pos]
-
-                if code in javadoc_dict_methods:
-                    method_name = javadoc_dict_methods[code]
-                    if method_name in tmp_set:
-                        continue
-                    else:
-                        tmp_set.add(method_name)
-                        if method_name in api_methods:
-                            api_methods[method_name] += top_questions[question.id]
-                            api_methods_count[method_name] += 1
-                        else:
-                            api_methods[method_name] = top_questions[question.id]
-                            api_methods_count[method_name] = 1.0
+        for method_name in mention_index[question_id].methods:  # already deduplicated within the question
+            if method_name in api_methods:
+                api_methods[method_name] += top_questions[question_id]
+                api_methods_count[method_name] += 1
+            else:
+                api_methods[method_name] = top_questions[question_id]
+                api_methods_count[method_name] = 1.0
 
 
     for key,value in api_methods.items():
@@ -239,25 +246,38 @@ def recommend_api(query_matrix,query_idf_vector,top_questions,questions,javadoc,
 
     api_sim = {}
 
-    for api in javadoc:
-        class_name = api.package_name + '.' + api.class_name
-
-        for i, method in enumerate(api.methods):
+    if method_store is not None and method_index is not None:
+        # the doc_sim of every mentioned method at once, rows in javadoc order like the loop below
+        rows = sorted((row, method_name) for method_name in api_methods for row, _, _ in method_index.get(method_name, ()))
+        doc_sims = similarity.sim_doc_batch(query_matrix, query_idf_vector, method_store.subset([row for row, _ in rows]))
 
-            method_name = class_name + '.' + method
+        for (_, method_name), doc_sim in zip(rows, doc_sims):
+            so_sim = api_methods[method_name]
 
-            if method_name not in api_methods:
-                continue
+            if method_name in api_sim:
+                api_sim[method_name] = max(api_sim[method_name], 2 * doc_sim * so_sim / (doc_sim + so_sim))
             else:
-                doc_sim = similarity.sim_doc_pair(query_matrix,api.methods_matrix[i],query_idf_vector,api.methods_idf_vector[i])
-                so_sim = api_methods[method_name]
+                api_sim[method_name] = 2 * doc_sim * so_sim / (doc_sim + so_sim)
+    else:
+        for api in javadoc:
+            class_name = api.package_name + '.' + api.class_name
 
+            for i, method in enumerate(api.methods):
 
-                if method_name in api_sim:
-                    api_sim[method_name] = max(api_sim[method_name],
-                                                                 2 * doc_sim * so_sim / (doc_sim + so_sim))
+                method_name = class_name + '.' + method
+
+                if method_name not in api_methods:
+                    continue
                 else:
-                    api_sim[method_name] = 2 * doc_sim * so_sim / (doc_sim + so_sim)
+                    doc_sim = similarity.sim_doc_pair(query_matrix,api.methods_matrix[i],query_idf_vector,api.methods_idf_vector[i])
+                    so_sim = api_methods[method_name]
+
+
+                    if method_name in api_sim:
+                        api_sim[method_name] = max(api_sim[method_name],
+                                                                     2 * doc_sim * so_sim / (doc_sim + so_sim))
+                    else:
+                        api_sim[method_name] = 2 * doc_sim * so_sim / (doc_sim + so_sim)
 
 
     api_sim = sorted(api_sim.items(), key=lambda item: item[1], reverse=True)
@@ -273,75 +293,77 @@ def recommend_api(query_matrix,query_idf_vector,top_questions,questions,javadoc,
     return recommended_api
 
 
-def recommend_api_class(query_matrix,query_idf_vector,top_questions,questions,javadoc,javadoc_dict_classes,topk):
+def recommend_api_class(query_matrix,query_idf_vector,top_questions,questions,javadoc,javadoc_dict_classes,topk,mention_index=None,
+                        method_store=None,class_index=None,class_offsets=None):
     # remember that top_questions is a dictionary of the top-k most relevant questions of the query
     # the key is question id, the value is the similarity between the question and the query
     # questions is a list including all questions (api related) in StackOverflow
     # javadoc is a list including all api classes
+    # mention_index is the index of mentions.build_mention_index, it is built for the top questions if missing
+    # method_store comes from preprocess_javadoc, class_index and class_offsets from store.index_javadoc_classes,
+    # with them the methods of all mentioned classes are scored at once
+
+    if mention_index is None:
+        mention_index = mentions.build_mention_index([question for question in questions if question.id in top_questions],
+                                                     javadoc_dict_classes, dict())
 
     api_classes_count = dict()
     api_classes = dict() # stores the similarity between the question (whose answer contains the API class) and the query
 
-    for question in questions:
-        if question.id not in top_questions:
-            continue
-        for answer in question.answers:
-            if int(answer.score)<0:
-                continue
+    for question_id in mentions.mentioned_questions(top_questions, mention_index):
 
-            soup = BeautifulSoup(answer.body, 'html.parser')
-
-            links = soup.find_all('a')
-            for link in links:
-                link = link['href']
-                if 'docs.oracle.com/javase/' in link and '/api/' in link and 'html' in link:
-                    pair = util.parse_api_link(link)  # pair[0] is class name, pair[1] is method name
-                    class_name = pair[0] #note that this class_name already contains package name, i.e, java.util.Calendar
-                    if class_name in api_classes:
-                        api_classes[class_name] += top_questions[question.id]
-                        api_classes_count[class_name] += 1
-                    else:
-                        api_classes[class_name] = top_questions[question.id]
-                        api_classes_count[class_name] = 1
-
-            codes = soup.find_all('code')
-            for code in codes:
-                code = code.get_text()
-                pos = code.find('(')
-                if pos != -1:
-                    code = code[:pos]
-                #code = code.replace('()', '')
-                if code in javadoc_dict_classes:
-                    # print code,'!class'
-                    class_name = javadoc_dict_classes[code]
-                    if class_name in api_classes:
-                        api_classes[class_name] += top_questions[question.id]
-                        api_classes_count[class_name] += 1
-                    else:
-                        api_classes[class_name] = top_questions[question.id]
-                        api_classes_count[class_name] = 1
+        # note that this class_name already contains package name, i.e, java.util.Calendar
+        for class_name, count in mention_index[question_id].classes:
+            if class_name in api_classes:
+                api_classes[class_name] += count * top_questions[question_id]
+                api_classes_count[class_name] += count
+            else:
+                api_classes[class_name] = count * top_questions[question_id]
+                api_classes_count[class_name] = count
 
     for key,value in api_classes.items():
         api_classes[key] = min(1.0, value/api_classes_count[key] * (1.0 + math.log(api_classes_count[key],2)/10))
 
     api_sim = {}
 
-    for api in javadoc:
-        if api.package_name+'.'+api.class_name not in api_classes:
-            continue
+    if method_store is not None and class_index is not None and class_offsets is not None:
+        # the doc_sim of a class is that of its best method: the methods of every mentioned class are stacked
+        # and scored by one sim_doc_batch, then reduced to one maximum per class, in javadoc order like the loop below
+        classes = sorted((class_index[class_name], class_name) for class_name in api_classes if class_name in class_index)
+        begins = np.array([class_offsets[api_i] for (_, api_i), _ in classes], dtype=np.int64)
+        lengths = np.array([class_offsets[api_i + 1] - class_offsets[api_i] for (_, api_i), _ in classes], dtype=np.int64)
+        doc_sims = np.zeros(len(classes))
+
+        with_methods = np.flatnonzero(lengths > 0)
+        if with_methods.size > 0:
+            starts = np.zeros(with_methods.size, dtype=np.int64)
+            np.cumsum(lengths[with_methods][:-1], out=starts[1:])
+            rows = np.repeat(begins[with_methods] - starts, lengths[with_methods]) + np.arange(lengths.sum())
+            method_sims = similarity.sim_doc_batch(query_matrix, query_idf_vector, method_store.subset(rows))
+            # fmax skips the nan of methods without any known word, like max does in the loop below
+            doc_sims[with_methods] = np.fmax(np.fmax.reduceat(method_sims, starts), 0.0)
+
+        for (_, class_name), doc_sim in zip(classes, doc_sims.tolist()):
+            so_sim = api_classes[class_name]
+
+            api_sim[class_name] = 2 * doc_sim * so_sim / (doc_sim + so_sim)
+    else:
+        for api in javadoc:
+            if api.package_name+'.'+api.class_name not in api_classes:
+                continue
 
-        doc_sim = 0.0
+            doc_sim = 0.0
 
-        for i,method_matrix in enumerate(api.methods_matrix):
-            doc_sim = max(doc_sim,similarity.sim_doc_pair(query_matrix,method_matrix,query_idf_vector,api.methods_idf_vector[i]))
+            for i,method_matrix in enumerate(api.methods_matrix):
+                doc_sim = max(doc_sim,similarity.sim_doc_pair(query_matrix,method_matrix,query_idf_vector,api.methods_idf_vector[i]))
 
-        so_sim = api_classes[api.package_name+'.'+api.class_name]
+            so_sim = api_classes[api.package_name+'.'+api.class_name]
 
 
-        api_sim[api.package_name+'.'+api.class_name] = 2 * doc_sim * so_sim / (doc_sim + so_sim)
+            api_sim[api.package_name+'.'+api.class_name] = 2 * doc_sim * so_sim / (doc_sim + so_sim)
 
-        #the following code only considers SO similarity
-        #api_sim[api.package_name + '.' + api.class_name] = so_sim
+            #the following code only considers SO similarity
+            #api_sim[api.package_name + '.' + api.class_name] = so_sim
 
 
 
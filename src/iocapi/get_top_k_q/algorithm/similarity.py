@@ -44,6 +44,66 @@ def sim_doc_pair(matrix1, matrix2, idf1, idf2):
     #
 
 
+def sim_doc_batch(query_matrix, query_idf_vector, store, block_size=16384):
+    # sim_doc_pair of the query against every document of a DocStore
+    # each block of documents costs one matrix product plus segmented max/sum reductions
+
+    sims = np.zeros(len(store))
+    query_idf_sum = query_idf_vector.sum()
+
+    for begin in range(0, len(store), block_size):
+        end = min(begin + block_size, len(store))
+        row_begin, row_end = store.offsets[begin], store.offsets[end]
+        starts = store.offsets[begin:end] - row_begin
+
+        idf = store.idf[row_begin:row_end]
+        word_sim = store.word_sims(row_begin, row_end, query_matrix)  # (words of the block, words of the query)
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            # query -> document: best match of every query word within each document
+            sim12 = (query_idf_vector * np.maximum.reduceat(word_sim, starts, axis=0)).sum(axis=1) / query_idf_sum
+            # document -> query: best match of every document word within the query
+            sim21 = np.add.reduceat(idf * word_sim.max(axis=1), starts) / np.add.reduceat(idf, starts)
+            sims[begin:end] = 2 * sim12 * sim21 / (sim12 + sim21)
+
+    return sims
+
+
+def sim_doc_batch_multi(query_matrices, query_idf_vectors, store, max_block_elements=1 << 24):
+    # sim_doc_batch of many queries at once, returns a (number of queries, number of documents) array
+    # the query matrices are stacked, so every block of documents costs one matrix product for all queries;
+    # blocks are sized so that the word similarity matrix stays below max_block_elements entries
+
+    query_lengths = np.array([query_matrix.shape[0] for query_matrix in query_matrices])
+    query_starts = np.concatenate(([0], np.cumsum(query_lengths)[:-1]))
+    queries_matrix = np.concatenate(query_matrices)
+    queries_idf = np.concatenate([query_idf_vector.reshape(-1) for query_idf_vector in query_idf_vectors])
+    queries_idf_sum = np.add.reduceat(queries_idf, query_starts)
+
+    sims = np.zeros((len(query_matrices), len(store)))
+    mean_length = max(1.0, store.matrix.shape[0] / max(1, len(store)))
+    block_size = max(1, int(max_block_elements / (mean_length * queries_matrix.shape[0])))
+
+    for begin in range(0, len(store), block_size):
+        end = min(begin + block_size, len(store))
+        row_begin, row_end = store.offsets[begin], store.offsets[end]
+        starts = store.offsets[begin:end] - row_begin
+
+        idf = store.idf[row_begin:row_end].reshape(-1, 1)
+        word_sim = store.word_sims(row_begin, row_end, queries_matrix)  # (words of the block, words of all queries)
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            # query -> document, (documents, queries)
+            best_in_doc = np.maximum.reduceat(word_sim, starts, axis=0)
+            sim12 = np.add.reduceat(best_in_doc * queries_idf, query_starts, axis=1) / queries_idf_sum
+            # document -> query, (documents, queries)
+            best_in_query = np.maximum.reduceat(word_sim, query_starts, axis=1)
+            sim21 = np.add.reduceat(idf * best_in_query, starts, axis=0) / np.add.reduceat(idf, starts, axis=0)
+            sims[:, begin:end] = (2 * sim12 * sim21 / (sim12 + sim21)).T
+
+    return sims
+
+
 if __name__ == "__main__":
     w2v = gensim.models.Word2Vec.load('../data/w2v_model_stemmed')
 
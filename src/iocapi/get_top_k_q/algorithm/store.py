@@ -0,0 +1,180 @@
+import numpy as np
+
+
+PRECISIONS = ('float64', 'float32', 'int8')
+
+
+class DocStore:
+
+    # packs the word matrices of many documents into one contiguous array,
+    # rows offsets[i]:offsets[i+1] of matrix and idf belong to the i-th document
+    # an int8 store keeps one float32 scale per row, the word vector of a row is matrix[row] * scale[row]
+
+    def __init__(self, ids, matrix, idf, offsets, scale=None):
+        self.ids = ids
+        self.matrix = matrix
+        self.idf = idf
+        self.offsets = offsets
+        self.scale = scale
+        self.lengths = np.diff(offsets)
+
+    @classmethod
+    def from_docs(cls, ids, matrices, idf_vectors):
+        # an empty document becomes one zero word with zero idf, so its segment is never empty
+        # and it scores nan, like a document without any known word
+        matrices = [matrix if matrix.shape[0] > 0 else np.zeros((1, 100)) for matrix in matrices]
+        idf_vectors = [idf_vector if idf_vector.size > 0 else np.zeros((1, 1)) for idf_vector in idf_vectors]
+        lengths = np.array([matrix.shape[0] for matrix in matrices], dtype=np.int64)
+        offsets = np.zeros(len(lengths) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=offsets[1:])
+
+        if len(matrices) > 0:
+            matrix = np.ascontiguousarray(np.concatenate(matrices))
+            idf = np.concatenate([idf_vector.reshape(-1) for idf_vector in idf_vectors])
+        else:
+            matrix = np.zeros((0, 100))  # word embedding size is 100
+            idf = np.zeros(0)
+
+        return cls(list(ids), matrix, idf, offsets)
+
+    def __len__(self):
+        return len(self.ids)
+
+    @property
+    def precision(self):
+        return 'int8' if self.scale is not None else self.matrix.dtype.name
+
+    @property
+    def nbytes(self):
+        return sum(array.nbytes for array in (self.matrix, self.idf, self.offsets, self.scale) if array is not None)
+
+    def rows(self, begin, end):
+        # the word vectors of rows begin:end, a view unless the store is int8
+        if self.scale is None:
+            return self.matrix[begin:end]
+        return self.matrix[begin:end].astype(np.float32) * self.scale[begin:end].reshape(-1, 1)
+
+    def word_sims(self, begin, end, query_matrix):
+        # rows begin:end times query_matrix.T, computed in the precision of the store
+        if self.scale is None:
+            return self.matrix[begin:end].dot(query_matrix.T.astype(self.matrix.dtype, copy=False))
+        # the per-row scale is applied to the (rows, query words) product, which is smaller than the rows
+        word_sim = self.matrix[begin:end].astype(np.float32).dot(query_matrix.T.astype(np.float32))
+        return word_sim * self.scale[begin:end].reshape(-1, 1)
+
+    def doc_matrix(self, i):
+        return self.rows(self.offsets[i], self.offsets[i + 1])
+
+    def doc_idf_vector(self, i):
+        return self.idf[self.offsets[i]:self.offsets[i + 1]].reshape(1, -1)
+
+    def subset(self, indices):
+        # a new store with a copy of the documents at the given indices, in that order
+        lengths = self.lengths[indices]
+        offsets = np.zeros(len(indices) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=offsets[1:])
+        rows = np.repeat(self.offsets[indices] - offsets[:-1], lengths) + np.arange(offsets[-1])
+
+        return DocStore([self.ids[i] for i in indices], self.matrix[rows], self.idf[rows], offsets,
+                        self.scale[rows] if self.scale is not None else None)
+
+    def with_precision(self, precision):
+        # the store in another precision, see PRECISIONS
+        # float32 halves the memory of float64, int8 with a per-row scale takes about an eighth
+        if precision not in PRECISIONS:
+            raise ValueError(f'unknown precision {precision}, expected one of {PRECISIONS}')
+        if precision == self.precision:
+            return self
+        if precision == 'float64':
+            return DocStore(self.ids, np.asarray(self.rows(0, self.matrix.shape[0]), dtype=np.float64),
+                            self.idf.astype(np.float64), self.offsets)
+
+        matrix = np.asarray(self.rows(0, self.matrix.shape[0]), dtype=np.float32)
+        if precision == 'float32':
+            return DocStore(self.ids, matrix, self.idf.astype(np.float32), self.offsets)
+
+        scale = np.abs(matrix).max(axis=1, initial=0.0) / 127
+        quantized = np.divide(matrix, scale.reshape(-1, 1), out=np.zeros_like(matrix), where=scale.reshape(-1, 1)!=0)
+        return DocStore(self.ids, np.rint(quantized).astype(np.int8), self.idf.astype(np.float32), self.offsets,
+                        scale.astype(np.float32))
+
+
+def concat_stores(stores):
+    # one store with the documents of all stores in order, all of the same precision
+    offsets = [stores[0].offsets]
+    for doc_store in stores[1:]:
+        offsets.append(doc_store.offsets[1:] + offsets[-1][-1])
+    scale = None
+    if stores[0].scale is not None:
+        scale = np.concatenate([doc_store.scale for doc_store in stores])
+
+    return DocStore([doc_id for doc_store in stores for doc_id in doc_store.ids],
+                    np.concatenate([doc_store.matrix for doc_store in stores]),
+                    np.concatenate([doc_store.idf for doc_store in stores]),
+                    np.concatenate(offsets), scale)
+
+
+def pack_questions(questions):
+    # the questions keep working as before, but their matrices become views of the store
+    store = DocStore.from_docs([question.id for question in questions],
+                               [question.matrix for question in questions],
+                               [question.idf_vector for question in questions])
+    attach_questions(questions, store)
+
+    return store
+
+
+def attach_questions(questions, store):
+    # the matrices of the questions become views of the store
+    # an int8 store has no float rows to view, its documents are only scored through the store
+    for i, question in enumerate(questions):
+        question.matrix = store.doc_matrix(i) if store.scale is None else None
+        question.idf_vector = store.doc_idf_vector(i)
+
+
+def pack_javadoc_methods(javadoc):
+    # the description matrices of all javadoc methods in one store, the ids are (class index, method index)
+    # method_index maps a full method name to its (store row, class index, method index) entries,
+    # there is more than one entry for overloaded methods
+    ids = list()
+    matrices = list()
+    idf_vectors = list()
+    method_index = dict()
+    for api_i, api in enumerate(javadoc):
+        class_name = api.package_name + '.' + api.class_name
+        for method_i, method_matrix in enumerate(api.methods_matrix):
+            if method_i < len(api.methods):
+                method_index.setdefault(class_name + '.' + api.methods[method_i], []).append((len(ids), api_i, method_i))
+            ids.append((api_i, method_i))
+            matrices.append(method_matrix)
+            idf_vectors.append(api.methods_idf_vector[method_i])
+
+    method_store = DocStore.from_docs(ids, matrices, idf_vectors)
+    attach_javadoc_methods(javadoc, method_store)
+
+    return method_store, method_index
+
+
+def index_javadoc_classes(javadoc, method_store):
+    # rows class_offsets[i]:class_offsets[i+1] of the method store are the methods of the i-th javadoc class,
+    # the rows of a class are contiguous and in class order, see pack_javadoc_methods and segments.apply_segment
+    # class_index maps a full class name to its (order, class index): a class replaced by a segment keeps the order
+    # of the first class of that name and gets the index of the last one, which wins wherever classes are looked up
+    class_ids = np.fromiter((api_i for api_i, _ in method_store.ids), dtype=np.int64, count=len(method_store))
+    class_offsets = np.searchsorted(class_ids, np.arange(len(javadoc) + 1))
+    class_index = dict()
+    for api_i, api in enumerate(javadoc):
+        class_name = api.package_name + '.' + api.class_name
+        class_index[class_name] = (class_index[class_name][0] if class_name in class_index else api_i, api_i)
+
+    return class_index, class_offsets
+
+
+def attach_javadoc_methods(javadoc, method_store):
+    # the method matrices of the javadoc become views of the store, like attach_questions
+    for api in javadoc:
+        api.methods_matrix = list()
+        api.methods_idf_vector = list()
+    for row, (api_i, method_i) in enumerate(method_store.ids):
+        javadoc[api_i].methods_matrix.append(method_store.doc_matrix(row) if method_store.scale is None else None)
+        javadoc[api_i].methods_idf_vector.append(method_store.doc_idf_vector(row))
@@ -0,0 +1,186 @@
+import argparse
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+import _pickle as pickle
+from get_top_k_q import get_top_k, synthetic
+from get_top_k_q.algorithm import recommendation
+
+
+# times the stages of the retrieval on a knowledge base, by default a synthetic one (see synthetic.py),
+# and writes the timings as json, so that runs on different commits or machines can be compared
+
+
+def timings(seconds):
+    seconds = np.array(seconds)
+    return {
+        'count': len(seconds),
+        'total_s': float(seconds.sum()),
+        'mean_ms': float(seconds.mean() * 1000),
+        'p50_ms': float(np.percentile(seconds, 50) * 1000),
+        'p95_ms': float(np.percentile(seconds, 95) * 1000),
+        'max_ms': float(seconds.max() * 1000),
+    }
+
+
+def timed(function, *args):
+    start = time.perf_counter()
+    result = function(*args)
+    return result, time.perf_counter() - start
+
+
+def make_queries(questions, n_queries, seed=0):
+    # half are titles of the knowledge base with words dropped and shuffled, half are random word sequences
+    rng = random.Random(seed)
+    words = sorted(set(word for question in questions for word in question.title.split()))
+    queries = list()
+    for i in range(n_queries):
+        if i % 2 == 0:
+            title_words = rng.choice(questions).title.split()
+            title_words = rng.sample(title_words, max(1, len(title_words) - rng.randint(0, 2)))
+            queries.append(' '.join(title_words))
+        else:
+            queries.append('how to ' + ' '.join(rng.choices(words, k=rng.randint(2, 8))))
+    return queries
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True, timeout=10,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+
+def run(data_dir, n_queries=200, k=10, repeat=1, seed=0, candidates=None):
+    # returns the benchmark report of the knowledge base in data_dir
+    # candidates enables the two-stage question ranking, see get_top_k.enable_candidate_index
+    results = dict()
+
+    # a cold build from the input files, then a load of the snapshot that build leaves behind
+    get_top_k.set_data_dir(data_dir)
+    _, seconds = timed(get_top_k.load_data, False)
+    results['load_data'] = timings([seconds])
+    get_top_k.set_data_dir(data_dir)
+    get_top_k.prepare_shared_kb()
+    get_top_k.set_data_dir(data_dir)
+    _, seconds = timed(get_top_k.load_data, True, False, ('vocabulary', 'questions'))
+    results['load_data_snapshot_questions'] = timings([seconds])  # all that get_top_Q_A needs
+    get_top_k.set_data_dir(data_dir)
+    _, seconds = timed(get_top_k.load_data)
+    results['load_data_snapshot'] = timings([seconds])
+
+    with open(os.path.join(data_dir, 'api_questions_pickle_new'), 'rb') as f:
+        raw_questions = pickle.load(f)
+    _, seconds = timed(recommendation.preprocess_all_questions, raw_questions, None, None, get_top_k.vocabulary)
+    results['preprocess_all_questions'] = timings([seconds])
+    del raw_questions
+
+    if candidates is not None:
+        _, seconds = timed(get_top_k.enable_candidate_index, candidates)
+        results['enable_candidate_index'] = timings([seconds])
+
+    get_top_k.load_class_index()
+    queries = make_queries(get_top_k.questions, n_queries, seed)
+    prepared = [prepared_query for prepared_query in map(get_top_k.preprocess_query, queries)
+                if prepared_query[1].shape[0] > 0]
+
+    question_seconds = list()
+    api_seconds = list()
+    class_seconds = list()
+    end_to_end_seconds = list()
+    batch_seconds = list()
+    for _ in range(repeat):
+        for query, query_matrix, query_idf_vector in prepared:
+            top_questions, seconds = timed(recommendation.get_topk_questions, query, query_matrix, query_idf_vector,
+                                           get_top_k.questions, 50, get_top_k.question_parent(),
+                                           get_top_k.question_store, get_top_k.candidate_index,
+                                           get_top_k.n_candidates, get_top_k.question_filter)
+            question_seconds.append(seconds)
+            _, seconds = timed(recommendation.recommend_api, query_matrix, query_idf_vector, top_questions,
+                               get_top_k.questions, get_top_k.javadoc, get_top_k.javadoc_dict_methods, k,
+                               get_top_k.mention_index, get_top_k.method_store, get_top_k.method_index)
+            api_seconds.append(seconds)
+            _, seconds = timed(recommendation.recommend_api_class, query_matrix, query_idf_vector, top_questions,
+                               get_top_k.questions, get_top_k.javadoc, get_top_k.javadoc_dict_classes, k,
+                               get_top_k.mention_index, get_top_k.method_store, get_top_k.class_index,
+                               get_top_k.class_offsets)
+            class_seconds.append(seconds)
+        for query in queries:
+            _, seconds = timed(get_top_k.get_top_k_apis, query, k)
+            end_to_end_seconds.append(seconds)
+        _, seconds = timed(get_top_k.get_top_k_apis_batch, queries, k)
+        batch_seconds.append(seconds / len(queries))
+    results['get_topk_questions'] = timings(question_seconds)
+    results['recommend_api'] = timings(api_seconds)
+    results['recommend_api_class'] = timings(class_seconds)
+    results['get_top_k_apis'] = timings(end_to_end_seconds)
+    results['get_top_k_apis_batch_per_query'] = timings(batch_seconds)
+
+    return {
+        'created': time.strftime('%Y-%m-%d %H:%M:%S'),
+        'commit': git_commit(),
+        'python': sys.version.split()[0],
+        'numpy': np.__version__,
+        'machine': platform.machine(),
+        'cpus': os.cpu_count(),
+        'precision': get_top_k.precision,
+        'candidate_index': get_top_k.candidate_index is not None,
+        'knowledge_base': {
+            'data_dir': os.path.abspath(data_dir),
+            'questions': len(get_top_k.questions),
+            'question_words': int(get_top_k.question_store.matrix.shape[0]),
+            'javadoc_classes': len(get_top_k.javadoc),
+            'javadoc_methods': len(get_top_k.method_store),
+            'vocabulary': len(get_top_k.vocabulary.words),
+        },
+        'queries': len(queries),
+        'k': k,
+        'repeat': repeat,
+        'results': results,
+    }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the retrieval on a synthetic or a real knowledge base')
+    parser.add_argument('--data-dir', default=None,
+                        help='knowledge base to benchmark, a synthetic one is generated if not given')
+    parser.add_argument('--output', default=None, help='json file to write the report to, printed if not given')
+    parser.add_argument('--queries', type=int, default=200)
+    parser.add_argument('--k', type=int, default=10)
+    parser.add_argument('--repeat', type=int, default=1)
+    parser.add_argument('--precision', default=get_top_k.precision, choices=get_top_k.store.PRECISIONS)
+    parser.add_argument('--candidates', type=int, default=None,
+                        help='rank the questions in two stages, see get_top_k.enable_candidate_index')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--synthetic-questions', type=int, default=20000)
+    parser.add_argument('--synthetic-classes', type=int, default=500)
+    parser.add_argument('--synthetic-vocabulary', type=int, default=20000)
+    args = parser.parse_args()
+
+    get_top_k.set_precision(args.precision)
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        data_dir = args.data_dir
+        synthetic_kb = None
+        if data_dir is None:
+            data_dir = tmp_dir
+            synthetic_kb = synthetic.generate(data_dir, n_questions=args.synthetic_questions,
+                                              n_classes=args.synthetic_classes,
+                                              vocabulary_size=args.synthetic_vocabulary, seed=args.seed)
+        report = run(data_dir, args.queries, args.k, args.repeat, args.seed, args.candidates)
+        report['synthetic'] = synthetic_kb
+
+    if args.output is None:
+        print(json.dumps(report, indent=2))
+    else:
+        os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(report, f, indent=2)
+        print('Wrote', args.output)
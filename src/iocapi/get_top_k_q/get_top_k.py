@@ -1,70 +1,565 @@
 import operator
 import os
 import sys
+import threading
 
 import gensim
 import _pickle as pickle
-from get_top_k_q.algorithm import recommendation, similarity
-from nltk.stem import SnowballStemmer
-from nltk.tokenize import WordPunctTokenizer
+import tracing
+from get_top_k_q import segments, snapshot
+from get_top_k_q.retrieval_cache import RetrievalCache
+from get_top_k_q.algorithm import filters, ivf, mentions, normalize, recommendation, similarity, store
 
 
 w2v = None
 idf = None
+vocabulary = None  # normalize.Vocabulary of w2v and idf, the only part of them needed once the knowledge base is built
 questions = None
+question_store = None
+question_filter = None
 javadoc = None
 javadoc_dict_classes = None
 javadoc_dict_methods = None
+method_store = None
+method_index = None
+mention_index = None
+class_index = None  # full class name -> (order, class index) of the javadoc classes, see load_class_index
+class_offsets = None  # the method store rows of every javadoc class
+class_index_javadoc = None  # the javadoc class_index and class_offsets belong to
+candidate_index = None  # optional first retrieval stage, see enable_candidate_index
+n_candidates = 3000
+exclude_duplicate_titles = False  # also drop the exact-title duplicates of the question matching the query, see question_parent
+n_top_questions = 50  # the apis are aggregated from the answers of this many most similar questions
+precision = 'float32'  # precision of the question and method stores, see set_precision
+retrieval_cache = None  # optional cache of the api lists of earlier queries, see enable_retrieval_cache
+retrieval_cache_config = None
+kb_generation = 0  # number of segment entries applied to the knowledge base, see ingest
+kb_path = None  # snapshot the components of the knowledge base are loaded from, see load_data
+# directory of the input files, see set_data_dir; the IOCAPI_DATA_DIR environment variable overrides the default
+data_dir = os.environ.get('IOCAPI_DATA_DIR') or os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data')
 
 
-def load_data():
-    global w2v, idf, questions, javadoc, javadoc_dict_classes, javadoc_dict_methods
+# the components of the knowledge base, load_data only loads the requested ones that are missing:
+# vocabulary: word vectors and idf values of the stemmed words, all that preprocess_query needs
+# questions: questions, question_store and question_filter, all that get_top_Q_A needs besides the vocabulary
+# javadoc: javadoc, javadoc_dict_classes, javadoc_dict_methods, method_store and method_index
+# mentions: mention_index, the APIs mentioned by the answers of every question
+COMPONENTS = ('vocabulary', 'questions', 'javadoc', 'mentions')
+
+
+def missing_components(components=COMPONENTS):
+    loaded = {'vocabulary': vocabulary, 'questions': questions, 'javadoc': javadoc, 'mentions': mention_index}
+    return [component for component in components if loaded[component] is None]
+
+
+@tracing.traced()
+def load_data(use_snapshot=True, shared=False, components=COMPONENTS):
+    # shared=True attaches to the snapshot instead of loading a private copy:
+    # the vocabulary and the question matrices are memory-mapped read-only and html bodies are skipped
+    # the segments of ingest are applied on top, see segments.py; pending segments need every component at once
+    # without a snapshot every component is built from the input files, and saved as a snapshot for later runs
+    global w2v, idf, vocabulary, questions, question_store, question_filter, javadoc, javadoc_dict_classes, javadoc_dict_methods, \
+        method_store, method_index, mention_index, kb_generation
     current_dir = os.path.dirname(os.path.abspath(__file__))
 
     sys.path.append(current_dir)
 
-    w2v_path = os.path.join(current_dir, 'data', 'w2v_model_stemmed')
-    idf_path = os.path.join(current_dir, 'data', 'idf')
-    questions_path = os.path.join(current_dir, 'data', 'api_questions_pickle_new')
-    javadoc_path = os.path.join(current_dir, 'data', 'javadoc_pickle_wordsegmented')
+    missing = missing_components(components)
+    if not missing:
+        return
+
+    w2v_path = os.path.join(data_dir, 'w2v_model_stemmed')
+    idf_path = os.path.join(data_dir, 'idf')
+    questions_path = os.path.join(data_dir, 'api_questions_pickle_new')
+    javadoc_path = os.path.join(data_dir, 'javadoc_pickle_wordsegmented')
+
+    if use_snapshot:
+        with tracing.span('load_snapshot'):
+            loaded = load_components(missing, shared)  # the preprocessed knowledge base of an earlier run, if inputs are unchanged
+        if loaded:
+            return
+
+    kb_missing = bool(missing_components())
+    if vocabulary is None:
+        if w2v is None:
+            # only read to build the vocabulary, so large vector arrays saved next to the model are mapped, not copied
+            w2v = gensim.models.Word2Vec.load(w2v_path, mmap='r')  # pre-trained word embedding
+        if idf is None:
+            idf = pickle.load(open(idf_path, 'rb'))  # pre-trained idf value of all words in the w2v dictionary
+        vocabulary = normalize.Vocabulary.build(w2v, idf)  # normalized word vectors and idf values by word id
 
-    if w2v is None:
-        w2v = gensim.models.Word2Vec.load(w2v_path)  # pre-trained word embedding
-    if idf is None:
-        idf = pickle.load(open(idf_path, 'rb'))  # pre-trained idf value of all words in the w2v dictionary
     if questions is None:
         questions = pickle.load(open(questions_path, 'rb'))  # the pre-trained knowledge base of api-related questions (about 120K questions)
-        questions = recommendation.preprocess_all_questions(questions, idf, w2v)  # matrix transformation
+        with tracing.span('preprocess_all_questions'):
+            questions = recommendation.preprocess_all_questions(questions, idf, w2v, vocabulary)  # matrix transformation
+        question_store = store.pack_questions(questions)  # one contiguous matrix for all question titles
+        question_filter = filters.QuestionFilter(questions)  # valid answers, duplicate titles and title lookups
     if javadoc is None:
         javadoc = pickle.load(open(javadoc_path, 'rb'))  # the pre-trained knowledge base of javadoc
         javadoc_dict_classes = dict()
         javadoc_dict_methods = dict()
-        recommendation.preprocess_javadoc(javadoc, javadoc_dict_classes, javadoc_dict_methods, idf, w2v)  # matrix transformation
+        with tracing.span('preprocess_javadoc'):
+            method_store, method_index = recommendation.preprocess_javadoc(javadoc, javadoc_dict_classes, javadoc_dict_methods, idf, w2v, vocabulary)  # matrix transformation
+    if mention_index is None:
+        with tracing.span('build_mention_index'):
+            mention_index = mentions.build_mention_index(questions, javadoc_dict_classes, javadoc_dict_methods)  # parse all answers once
 
+    if kb_missing and use_snapshot:
+        try:
+            snapshot.save_snapshot(data_dir, snapshot.Snapshot(questions, question_store, question_filter, javadoc,
+                                                               javadoc_dict_classes, javadoc_dict_methods,
+                                                               method_store, method_index, mention_index, vocabulary))
+        except OSError as e:
+            print('Failed to save the knowledge base snapshot:', e)
 
-def get_top_Q_A(query):
+    if question_store.precision != precision:  # the snapshot above keeps the float64 reference
+        question_store = question_store.with_precision(precision)
+        method_store = method_store.with_precision(precision)
+        store.attach_questions(questions, question_store)
+        store.attach_javadoc_methods(javadoc, method_store)
+
+    if kb_missing:
+        kb, kb_generation = segments.apply_manifest(data_dir, current_kb(), bodies=not shared)
+        use_kb(kb)
+
+
+def load_components(components, shared=False):
+    # loads components from the snapshot, False if there is no snapshot
+    global vocabulary, questions, question_store, question_filter, javadoc, javadoc_dict_classes, javadoc_dict_methods, \
+        method_store, method_index, mention_index, kb_generation, kb_path
+    if kb_path is not None and not snapshot.has_snapshot(data_dir, segments.snapshot_variant(kb_path)):
+        # replaced by a compaction or a rebuild in another process, components of both must not be mixed
+        unload_data()
+        components = COMPONENTS
+    mmap_mode = 'r' if shared else None
+    if kb_path is None:
+        path, manifest = segments.find_kb(data_dir)
+        if path is None:
+            return False
+        if manifest['entries']:
+            kb, kb_generation = segments.load_kb(data_dir, mmap_mode, bodies=not shared, precision=precision)
+            if kb is None:
+                return False
+            use_kb(kb)
+            kb_path = path
+            return True
+        kb_path, kb_generation = path, manifest['generation']
+
+    if 'vocabulary' in components:
+        vocabulary = snapshot.load_vocabulary(kb_path, mmap_mode)
+    if 'questions' in components:
+        questions, question_store, question_filter = snapshot.load_questions(kb_path, mmap_mode, not shared, precision)
+    if 'javadoc' in components:
+        javadoc, javadoc_dict_classes, javadoc_dict_methods, method_store, method_index = snapshot.load_javadoc(kb_path, mmap_mode, precision)
+    if 'mentions' in components:
+        mention_index = snapshot.load_mentions(kb_path)
+    return True
+
+
+def unload_data():
+    # drops the knowledge base, the next load_data loads it again
+    global w2v, idf, vocabulary, questions, question_store, question_filter, javadoc, javadoc_dict_classes, \
+        javadoc_dict_methods, method_store, method_index, mention_index, candidate_index, class_index, class_offsets, \
+        class_index_javadoc, kb_generation, kb_path
+    w2v = idf = vocabulary = questions = question_store = question_filter = javadoc = None
+    javadoc_dict_classes = javadoc_dict_methods = method_store = method_index = mention_index = candidate_index = None
+    class_index = class_offsets = class_index_javadoc = None
+    kb_generation = 0
+    kb_path = None
+
+
+def load_class_descriptions():
+    # the class_description_matrix and class_description_idf_vector of every javadoc class, built on first use,
+    # since none of the recommendations reads them
+    load_data(components=('vocabulary', 'javadoc'))
+    recommendation.preprocess_class_descriptions([api for api in javadoc if api.class_description_matrix is None],
+                                                 vocabulary)
+
+
+def load_class_index():
+    # the class_index and class_offsets of store.index_javadoc_classes, which only class recommendation reads,
+    # built on first use and again once the javadoc was replaced, e.g. by ingest
+    global class_index, class_offsets, class_index_javadoc
     load_data()
-    query = query.replace('"', '').replace("'", '').replace('.', '').replace('?', '')
-    query_words = WordPunctTokenizer().tokenize(query.lower())
-    query_words = [SnowballStemmer('english').stem(word) for word in query_words]
-    query_matrix = similarity.init_doc_matrix(query_words, w2v)
-    query_idf_vector = similarity.init_doc_idf_vector(query_words, idf)
-    top_questions = recommendation.get_topk_questions(query, query_matrix, query_idf_vector, questions, 1, dict())
+    if class_index_javadoc is not javadoc:
+        class_index, class_offsets = store.index_javadoc_classes(javadoc, method_store)
+        class_index_javadoc = javadoc
+
+
+def current_kb():
+    # the loaded knowledge base as a snapshot.Snapshot
+    return snapshot.Snapshot(questions, question_store, question_filter, javadoc, javadoc_dict_classes,
+                             javadoc_dict_methods, method_store, method_index, mention_index, vocabulary)
+
+
+def use_kb(kb):
+    global questions, question_store, question_filter, javadoc, javadoc_dict_classes, javadoc_dict_methods, \
+        method_store, method_index, mention_index, vocabulary
+    (questions, question_store, question_filter, javadoc, javadoc_dict_classes, javadoc_dict_methods,
+     method_store, method_index, mention_index, vocabulary) = kb
+
+
+ingest_lock = threading.Lock()
+compaction = None  # thread of the running compact_kb(background=True)
+
+
+def ingest(new_questions=(), new_javadoc=(), deleted=()):
+    # adds domain.Question and domain.API objects (like those of the input files) to the knowledge base,
+    # and removes the questions with the ids in deleted, without rebuilding the rest; see segments.py
+    # the change is saved as a segment of data_dir and applied by every later load_data,
+    # processes that loaded the knowledge base before (e.g. retrieval workers) only see it once they load it again
+    # queries running in other threads meanwhile may see the knowledge base half updated
+    global kb_generation
+    load_data()
+    with ingest_lock:
+        start = len(question_store)
+        kb, kb_generation = segments.ingest(data_dir, current_kb(), new_questions, new_javadoc, deleted)
+        use_kb(kb)
+        if candidate_index is not None and len(question_store) > start:
+            candidate_index.extend(question_store, start)
+        if retrieval_cache is not None and retrieval_cache.pid == os.getpid():
+            retrieval_cache.clear()  # the keys of the old generation are never looked up again
+    return kb_generation
+
+
+def compact_kb(background=True):
+    # merges the segments into a variant of the snapshot, so that later loads do not apply them one by one,
+    # and drops the removed questions for good; the loaded knowledge base answers the same before and after
+    # background=True compacts in a thread and returns it, ingest keeps working meanwhile
+    global compaction
+    if compaction is not None and compaction.is_alive():
+        return compaction
+    if not background:
+        return segments.compact(data_dir)
+    compaction = threading.Thread(target=segments.compact, args=(data_dir,), name='kb-compaction', daemon=True)
+    compaction.start()
+    return compaction
+
+
+def set_data_dir(path):
+    # loads the knowledge base from the input files in path from now on, e.g. a synthetic one (see synthetic.py);
+    # whatever was loaded before is dropped, the snapshot of path is kept in path/snapshot
+    global data_dir
+    data_dir = os.path.abspath(path)
+    unload_data()
+    if retrieval_cache_config is not None:  # the disk tier belongs to the snapshot of the old directory
+        enable_retrieval_cache(*retrieval_cache_config)
+
+
+def prepare_shared_kb():
+    # makes sure a snapshot exists before worker processes attach to it with load_shared_kb
+    if not snapshot.has_snapshot(data_dir):
+        load_data()
+
+
+def set_precision(new_precision):
+    # 'float32' (the default) halves the memory of the question and method matrices, 'int8' keeps about an eighth,
+    # 'float64' is the reference precision of the original implementation; see precision_report for the drift
+    global precision, question_store, method_store
+    if new_precision not in store.PRECISIONS:
+        raise ValueError(f'unknown precision {new_precision}, expected one of {store.PRECISIONS}')
+    precision = new_precision
+    if question_store is None and method_store is None:
+        return
+    if question_store is None or method_store is None:  # only some components are loaded
+        if question_store is not None and question_store.precision != precision:
+            question_store = question_store.with_precision(precision)
+            store.attach_questions(questions, question_store)
+        if method_store is not None and method_store.precision != precision:
+            method_store = method_store.with_precision(precision)
+            store.attach_javadoc_methods(javadoc, method_store)
+        return
+    if question_store.precision == precision:
+        return
+
+    stores = reference_stores(precision)
+    question_store, method_store = stores if stores is not None else (question_store.with_precision(precision),
+                                                                       method_store.with_precision(precision))
+    store.attach_questions(questions, question_store)
+    store.attach_javadoc_methods(javadoc, method_store)
+
+
+def reference_stores(store_precision='float64'):
+    # the question and method stores converted from the float64 ones of the snapshot and the segments,
+    # None without a snapshot
+    return segments.load_stores(data_dir, question_store.ids, method_store.ids, store_precision)
+
+
+def precision_report(queries, k=10, precisions=store.PRECISIONS):
+    # memory of the question and method stores in every precision, and the ranking drift against float64:
+    # mean overlap of the top n_top_questions questions and of the top-k apis, and the share of identical top-k api lists
+    global question_store, method_store
+    load_data()
+    current_stores = question_store, method_store
+    reference = reference_stores() or current_stores  # without a snapshot the drift is measured against the loaded stores
+    prepared = [prepared_query for prepared_query in map(preprocess_query, queries) if prepared_query[1].shape[0] > 0]
+
+    report = dict()
+    try:
+        results = dict()
+        for store_precision in ('float64',) + tuple(p for p in precisions if p != 'float64'):
+            question_store = reference[0].with_precision(store_precision)
+            method_store = reference[1].with_precision(store_precision)
+            results[store_precision] = [retrieve(*prepared_query, k) for prepared_query in prepared]
+
+            question_overlap = list()
+            api_overlap = list()
+            identical = 0
+            for (top_questions, apis), (reference_questions, reference_apis) in zip(results[store_precision], results['float64']):
+                question_overlap.append(len(top_questions.keys() & reference_questions.keys()) / max(1, len(reference_questions)))
+                api_overlap.append(len(set(apis) & set(reference_apis)) / max(1, len(reference_apis)))
+                identical += apis == reference_apis
+
+            report[store_precision] = {
+                'bytes': question_store.nbytes + method_store.nbytes,
+                'memory_ratio': (question_store.nbytes + method_store.nbytes) / (reference[0].nbytes + reference[1].nbytes),
+                'question_overlap': sum(question_overlap) / max(1, len(prepared)),
+                'api_overlap': sum(api_overlap) / max(1, len(prepared)),
+                'identical_api_lists': identical / max(1, len(prepared)),
+            }
+    finally:
+        question_store, method_store = current_stores
+
+    return {store_precision: report[store_precision] for store_precision in precisions}
+
+
+def load_shared_kb():
+    # initializer of worker processes
+    load_data(shared=True)
+
+
+def enable_candidate_index(candidates=3000, n_lists=None):
+    # questions are then ranked in two stages: the ivf index picks about `candidates` questions,
+    # and only those are scored exactly; candidates=None goes back to scoring every question
+    global candidate_index, n_candidates
+    load_data(components=('vocabulary', 'questions'))
+    if candidates is None:
+        candidate_index = None
+        return
+    if candidate_index is None or n_lists is not None:
+        candidate_index = ivf.CandidateIndex.build(question_store, n_lists)
+    n_candidates = candidates
+
+
+def candidate_recall(queries, topk=50):
+    # how many of the exhaustive top-k questions the two-stage ranking keeps, averaged over the queries
+    load_data(components=('vocabulary', 'questions'))
+    if candidate_index is None:
+        return 1.0
+    query_pairs = [preprocess_query(query)[1:] for query in queries]
+    return ivf.measure_recall(query_pairs, question_store, candidate_index, n_candidates, topk)
+
+
+def enable_retrieval_cache(capacity=10000, disk=False):
+    # queries that normalize to the same stemmed words get their api lists from the cache;
+    # disk=True adds a sqlite tier inside the snapshot directory, shared by processes and kept across runs,
+    # it is dropped with the snapshot once the input files change; capacity=None disables the cache
+    # every process opens its own cache on first use, so forked retrieval workers inherit the setting
+    global retrieval_cache, retrieval_cache_config
+    if retrieval_cache is not None and retrieval_cache.pid == os.getpid():
+        retrieval_cache.close()
+    retrieval_cache = None
+    retrieval_cache_config = (capacity, disk) if capacity is not None else None
+
+
+def open_retrieval_cache():
+    # the retrieval cache of this process, None if it is disabled
+    global retrieval_cache
+    if retrieval_cache_config is None:
+        return None
+    if retrieval_cache is None or retrieval_cache.pid != os.getpid():
+        capacity, disk = retrieval_cache_config
+        disk_path = None
+        if disk:
+            path = snapshot.find_snapshot(data_dir)
+            if path is None:
+                print('No knowledge base snapshot, the retrieval cache stays in memory')
+            else:
+                disk_path = os.path.join(path, 'retrieval_cache.sqlite')
+        retrieval_cache = RetrievalCache(capacity, disk_path)
+    return retrieval_cache
+
+
+def retrieval_cache_stats():
+    # hits and misses of this process, None without a retrieval cache
+    return retrieval_cache.stats() if retrieval_cache is not None and retrieval_cache.pid == os.getpid() else None
+
+
+def retrieval_key(query, query_words, k):
+    # everything the api list depends on: the stemmed words, the question (or duplicate cluster) excluded by the
+    # exact-title match of the cleaned query, k, the settings of the question ranking and the segments applied to the knowledge base
+    query_id = question_filter.same_question(query)
+    cluster = question_parent().get(query_id, query_id) if query_id != '-1' else None
+    candidates = (len(candidate_index.centroids), n_candidates) if candidate_index is not None else None
+    return RetrievalCache.make_key(list(query_words), cluster, k, n_top_questions, precision, candidates, kb_generation,
+                                   exclude_duplicate_titles)
+
+
+def question_parent():
+    # the parent map of get_topk_questions: by default a fresh one, so only the question matching the query is dropped
+    # from the ranking, as always; with exclude_duplicate_titles the duplicate clusters of the question filter,
+    # which drop every question with exactly the same title as the matching one
+    return question_filter.parent if exclude_duplicate_titles else dict()
+
+
+@tracing.traced()
+def tokenize_query(query):
+    # returns the cleaned query and its stemmed words
+    query = normalize.clean_query(query)
+    return query, normalize.stem_words(normalize.tokenize(query))
+
+
+@tracing.traced()
+def preprocess_query(query):
+    # returns the cleaned query, its word matrix and its idf vector
+    query, query_words = tokenize_query(query)
+    query_matrix = vocabulary.doc_matrix(query_words)
+    query_idf_vector = vocabulary.doc_idf_vector(query_words)
+    return query, query_matrix, query_idf_vector
+
+
+def get_top_Q_A(query):
+    load_data(components=('vocabulary', 'questions'))
+    query, query_matrix, query_idf_vector = preprocess_query(query)
+    top_questions = recommendation.get_topk_questions(query, query_matrix, query_idf_vector, questions, 1, question_parent(), question_store,
+                                                      candidate_index, n_candidates, question_filter)
     top_q_id = max(top_questions.items(), key=operator.itemgetter(1))[0]
-    q = next((question for question in questions if question.id==top_q_id), None)
+    q = next((question for i, question in enumerate(questions) if question.id==top_q_id and question_filter.alive[i]), None)
     print(q)
     return (q.title)
 
+
+def retrieve(query, query_matrix, query_idf_vector, k, sims=None):
+    # the top n_top_questions questions and the top-k apis of the query
+    # sims are the precomputed similarities between the query and every question, if any
+    with tracing.span('get_topk_questions'):
+        top_questions = recommendation.get_topk_questions(query, query_matrix, query_idf_vector, questions, n_top_questions, question_parent(), question_store,
+                                                          candidate_index, n_candidates, question_filter, sims)
+    with tracing.span('recommend_api'):
+        return top_questions, recommendation.recommend_api(query_matrix, query_idf_vector,
+                                                           top_questions, questions, javadoc, javadoc_dict_methods, k, mention_index,
+                                                           method_store, method_index)
+
+
+def recommend_apis(query, query_matrix, query_idf_vector, k, sims=None):
+    return retrieve(query, query_matrix, query_idf_vector, k, sims)[1]
+
+
+def recommend_api_classes(query, query_matrix, query_idf_vector, k, sims=None):
+    # the top-k api classes of the query, from the same top n_top_questions questions as retrieve
+    with tracing.span('get_topk_questions'):
+        top_questions = recommendation.get_topk_questions(query, query_matrix, query_idf_vector, questions, n_top_questions, question_parent(), question_store,
+                                                          candidate_index, n_candidates, question_filter, sims)
+    with tracing.span('recommend_api_class'):
+        return recommendation.recommend_api_class(query_matrix, query_idf_vector, top_questions, questions, javadoc, javadoc_dict_classes, k, mention_index,
+                                                  method_store, class_index, class_offsets)
+
+
 def get_top_k_apis(query, k):
     load_data()
-    query = query.replace('"', '').replace("'", '').replace('.', '').replace('?', '')
-    query_words = WordPunctTokenizer().tokenize(query.lower())
-    query_words = [SnowballStemmer('english').stem(word) for word in query_words]
-    query_matrix = similarity.init_doc_matrix(query_words, w2v)
-    query_idf_vector = similarity.init_doc_idf_vector(query_words, idf)
-    top_questions = recommendation.get_topk_questions(query, query_matrix, query_idf_vector, questions, 50, dict())
-    return recommendation.recommend_api(query_matrix, query_idf_vector,
-                                        top_questions, questions, javadoc, javadoc_dict_methods,k)
+    cache = open_retrieval_cache()
+    if cache is None:
+        query, query_matrix, query_idf_vector = preprocess_query(query)
+        return recommend_apis(query, query_matrix, query_idf_vector, k)
+
+    query, query_words = tokenize_query(query)
+    key = retrieval_key(query, query_words, k)
+    apis = cache.get(key)
+    if apis is None:
+        apis = recommend_apis(query, vocabulary.doc_matrix(query_words), vocabulary.doc_idf_vector(query_words), k)
+        if apis:
+            cache.put(key, apis)
+    return list(apis)
+
+
+def sweep_top_k_apis(query, ks, question_cutoffs=None):
+    # the apis of get_top_k_apis for every k and every number of top questions, as {(cutoff, k): apis},
+    # from a single ranking of the questions: the top questions of a smaller cutoff are a prefix of those
+    # of the largest one, and the api list of a smaller k is a prefix of the list of the largest k;
+    # with the candidate index a smaller cutoff may differ where the largest one falls back to scoring every question
+    load_data()
+    question_cutoffs = question_cutoffs or (n_top_questions,)
+    query, query_matrix, query_idf_vector = preprocess_query(query)
+    if query_matrix.shape[0] == 0:
+        return {(cutoff, k): [] for cutoff in question_cutoffs for k in ks}
+
+    with tracing.span('get_topk_questions'):
+        top_questions = recommendation.get_topk_questions(query, query_matrix, query_idf_vector, questions, max(question_cutoffs), question_parent(), question_store,
+                                                          candidate_index, n_candidates, question_filter)
+    ranked = list(top_questions.items())  # in ranking order
+    results = dict()
+    for cutoff in question_cutoffs:
+        with tracing.span('recommend_api'):
+            apis = recommendation.recommend_api(query_matrix, query_idf_vector, dict(ranked[:cutoff]), questions, javadoc, javadoc_dict_methods, max(ks), mention_index,
+                                                method_store, method_index)
+        for k in ks:
+            results[(cutoff, k)] = apis[:k]
+    return results
+
+
+def get_top_k_api_classes(query, k):
+    # the full names of the k api classes that best match the query, e.g. java.util.Calendar
+    load_data()
+    load_class_index()
+    query, query_matrix, query_idf_vector = preprocess_query(query)
+    return recommend_api_classes(query, query_matrix, query_idf_vector, k)
+
+
+def get_top_k_api_classes_batch(queries, k):
+    # get_top_k_api_classes of every query, with the questions scored for all queries together like get_top_k_apis_batch
+    load_data()
+    load_class_index()
+    return score_top_k_apis_batch(queries, k, recommend_api_classes)
+
+
+def get_top_k_apis_batch(queries, k):
+    # the same lists as get_top_k_apis for every query, but all queries are scored against the questions together,
+    # so every block of question matrices is read once per batch instead of once per query;
+    # a query without any word gets an empty list instead of an error
+    load_data()
+    cache = open_retrieval_cache()
+    if cache is not None:
+        return cached_top_k_apis_batch(queries, k, cache)
+    return score_top_k_apis_batch(queries, k)
+
+
+def score_top_k_apis_batch(queries, k, recommend=recommend_apis):
+    prepared = [preprocess_query(query) for query in queries]
+    scored = [i for i, (_, query_matrix, _) in enumerate(prepared) if query_matrix.shape[0] > 0]
+
+    all_sims = [None] * len(prepared)
+    if candidate_index is None and scored:  # the two-stage ranking scores different questions for every query
+        with tracing.span('sim_doc_batch_multi'):
+            batch_sims = similarity.sim_doc_batch_multi([prepared[i][1] for i in scored], [prepared[i][2] for i in scored], question_store)
+        for i, sims in zip(scored, batch_sims):
+            all_sims[i] = sims
+
+    return [recommend(query, query_matrix, query_idf_vector, k, sims) if query_matrix.shape[0] > 0 else []
+            for (query, query_matrix, query_idf_vector), sims in zip(prepared, all_sims)]
+
+
+def cached_top_k_apis_batch(queries, k, cache):
+    # get_top_k_apis_batch with the retrieval cache: only the misses are scored, together,
+    # and a query repeated within the batch is scored once
+    keys = [retrieval_key(*tokenize_query(query), k) for query in queries]
+    results = dict()
+    misses = dict()
+    for query, key in zip(queries, keys):
+        if key in results or key in misses:
+            continue
+        apis = cache.get(key)
+        if apis is None:
+            misses[key] = query
+        else:
+            results[key] = apis
+
+    for key, apis in zip(misses, score_top_k_apis_batch(list(misses.values()), k)):
+        if apis:  # queries without any word are not cached
+            cache.put(key, apis)
+        results[key] = apis
+
+    return [list(results[key]) for key in keys]
+
 
 if __name__ == '__main__':
     apis = get_top_k_apis('How do I convert a String to an int in Java', 10)
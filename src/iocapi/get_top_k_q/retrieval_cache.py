@@ -0,0 +1,75 @@
+import hashlib
+import json
+import os
+import sqlite3
+from collections import OrderedDict
+
+
+class RetrievalCache:
+
+    # api lists of earlier queries: an in-process lru tier, and optionally a sqlite tier shared by processes
+    # the sqlite file lives in the snapshot directory, so it goes away with the snapshot when the inputs change
+    # keys are built by get_top_k.retrieval_key from the stemmed query words, not the raw query
+
+    def __init__(self, capacity=10000, disk_path=None):
+        self.capacity = capacity
+        self.pid = os.getpid()  # a connection must not be used by forked processes
+        self.entries = OrderedDict()
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.conn = None
+        if disk_path is not None:
+            self.conn = sqlite3.connect(disk_path, timeout=30)
+            self.conn.execute('PRAGMA journal_mode=WAL')  # the workers of a retrieval pool share the file
+            self.conn.execute('CREATE TABLE IF NOT EXISTS apis (key TEXT PRIMARY KEY, apis TEXT)')
+            self.conn.commit()
+
+    @staticmethod
+    def make_key(*parts):
+        return hashlib.sha1(json.dumps(parts).encode('utf-8')).hexdigest()
+
+    def get(self, key):
+        if key in self.entries:
+            self.entries.move_to_end(key)
+            self.memory_hits += 1
+            return self.entries[key]
+        if self.conn is not None:
+            row = self.conn.execute('SELECT apis FROM apis WHERE key = ?', (key,)).fetchone()
+            if row is not None:
+                self.disk_hits += 1
+                self.remember(key, json.loads(row[0]))
+                return self.entries[key]
+        self.misses += 1
+        return None
+
+    def remember(self, key, apis):
+        self.entries[key] = apis
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.capacity:
+            self.entries.popitem(last=False)
+
+    def put(self, key, apis):
+        self.remember(key, apis)
+        if self.conn is not None:
+            self.conn.execute('INSERT OR REPLACE INTO apis VALUES (?, ?)', (key, json.dumps(apis)))
+            self.conn.commit()
+
+    def clear(self):
+        self.entries.clear()
+
+    def stats(self):
+        lookups = self.memory_hits + self.disk_hits + self.misses
+        return {
+            'memory_hits': self.memory_hits,
+            'disk_hits': self.disk_hits,
+            'misses': self.misses,
+            'hit_rate': (self.memory_hits + self.disk_hits) / lookups if lookups else 0.0,
+            'entries': len(self.entries),
+            'pid': self.pid,
+        }
+
+    def close(self):
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
@@ -0,0 +1,403 @@
+import copy
+import json
+import os
+import shutil
+import threading
+import time
+from collections import namedtuple
+
+import _pickle as pickle
+import numpy as np
+from get_top_k_q import snapshot
+from get_top_k_q.algorithm import filters, mentions, recommendation, store
+
+
+# incremental updates of the knowledge base: an append-only log of changes on top of the snapshot of the input files,
+# so that new questions and javadoc classes are preprocessed on their own instead of rebuilding everything
+# data_dir/segments/manifest.json holds the pending entries, applied in order when the knowledge base is loaded:
+#   {"segment": name}: questions and javadoc classes preprocessed into data_dir/segments/<name>
+#   {"tombstones": [question ids]}: deleted or retagged questions
+# a question of a segment replaces the question with the same id, a javadoc class the class with the same full name;
+# compact merges the entries into a variant of the snapshot, which is loaded instead of the snapshot from then on
+# base is the snapshot key the segments were built against, they are ignored once the input files change
+
+FORMAT_VERSION = 1
+
+# one ingest, preprocessed like load_data preprocesses the input files
+Segment = namedtuple('Segment', ['questions', 'question_store', 'javadoc', 'javadoc_dict_classes',
+                                 'javadoc_dict_methods', 'method_store', 'method_index', 'mention_index'])
+
+manifest_lock = threading.Lock()  # ingest and compact of one process rewrite the manifest, other processes only read it
+
+
+def segments_root(data_dir):
+    return os.path.join(data_dir, 'segments')
+
+
+def empty_manifest():
+    # generation counts every entry ever appended, compacted or not, so it identifies the content of the knowledge base
+    return {'version': FORMAT_VERSION, 'base': None, 'generation': 0, 'compacted': None, 'entries': list()}
+
+
+def read_manifest(data_dir):
+    path = os.path.join(segments_root(data_dir), 'manifest.json')
+    if not os.path.exists(path):
+        return empty_manifest()
+    with open(path, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+
+def current_manifest(data_dir):
+    # the manifest, or an empty one if its segments belong to other input files
+    manifest = read_manifest(data_dir)
+    if manifest['base'] is None:
+        return manifest
+    try:
+        key = snapshot.snapshot_key(data_dir)
+    except OSError:
+        key = None
+    if manifest['version'] != FORMAT_VERSION or manifest['base'] != key:
+        print('The knowledge base segments belong to other input files, they are ignored')
+        return empty_manifest()
+    return manifest
+
+
+def write_manifest(data_dir, manifest):
+    # readers see either the old or the new manifest, never a partial one
+    root = segments_root(data_dir)
+    os.makedirs(root, exist_ok=True)
+    tmp_path = os.path.join(root, f'.manifest.{os.getpid()}.tmp')
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(tmp_path, os.path.join(root, 'manifest.json'))
+
+
+def build_segment(kb, new_questions=(), new_javadoc=()):
+    # preprocesses new questions and javadoc classes with the vocabulary of the knowledge base kb (a snapshot.Snapshot)
+    # the answers of the new questions are parsed with the javadoc of kb and the new javadoc together
+    javadoc_dict_classes = dict()
+    javadoc_dict_methods = dict()
+    questions = recommendation.preprocess_all_questions(list(new_questions), None, None, kb.vocabulary)
+    question_store = store.pack_questions(questions)
+    javadoc = list(new_javadoc)
+    method_store, method_index = recommendation.preprocess_javadoc(javadoc, javadoc_dict_classes, javadoc_dict_methods,
+                                                                   None, None, kb.vocabulary)
+    mention_index = mentions.build_mention_index(questions,
+                                                 {**kb.javadoc_dict_classes, **javadoc_dict_classes},
+                                                 {**kb.javadoc_dict_methods, **javadoc_dict_methods})
+
+    return Segment(questions, question_store, javadoc, javadoc_dict_classes, javadoc_dict_methods,
+                   method_store, method_index, mention_index)
+
+
+def save_segment(path, segment):
+    # the float64 stores go to .npy files like in a snapshot, the bodies stay in the pickle for compact
+    tmp_path = path + f'.{os.getpid()}.tmp'
+    os.makedirs(tmp_path, exist_ok=True)
+
+    questions = list()
+    for question in segment.questions:
+        question = copy.copy(question)
+        question.matrix = None
+        question.idf_vector = None
+        questions.append(question)
+    javadoc = list()
+    for api in segment.javadoc:
+        api = copy.copy(api)
+        api.methods_matrix = list()
+        api.methods_idf_vector = list()
+        javadoc.append(api)
+
+    snapshot.save_store(tmp_path, 'question', segment.question_store)
+    snapshot.save_store(tmp_path, 'method', segment.method_store)
+    with open(os.path.join(tmp_path, 'segment.pkl'), 'wb') as f:
+        pickle.dump((questions, javadoc, segment.javadoc_dict_classes, segment.javadoc_dict_methods,
+                     segment.method_store.ids, segment.method_index, segment.mention_index), f, protocol=-1)
+    with open(os.path.join(tmp_path, 'meta.json'), 'w', encoding='utf-8') as f:
+        json.dump({'version': FORMAT_VERSION, 'created': time.strftime('%Y-%m-%d %H:%M:%S'),
+                   'questions': len(questions), 'javadoc_classes': len(javadoc)}, f, indent=2)
+    shutil.rmtree(path, ignore_errors=True)  # a segment of a stale manifest, names restart with the generation
+    os.replace(tmp_path, path)
+
+
+def load_segment(path, bodies=True):
+    with open(os.path.join(path, 'segment.pkl'), 'rb') as f:
+        (questions, javadoc, javadoc_dict_classes, javadoc_dict_methods,
+         method_ids, method_index, mention_index) = pickle.load(f)
+    if not bodies:
+        for question in questions:
+            question.body = None
+            for answer in question.answers:
+                answer.body = None
+
+    question_store = snapshot.load_store(path, 'question', [question.id for question in questions])
+    method_store = snapshot.load_store(path, 'method', method_ids)
+    store.attach_questions(questions, question_store)
+    store.attach_javadoc_methods(javadoc, method_store)
+
+    return Segment(questions, question_store, javadoc, javadoc_dict_classes, javadoc_dict_methods,
+                   method_store, method_index, mention_index)
+
+
+def alive_indices(question_filter):
+    # question id -> index of the question with this id that is not removed
+    return {question_filter.ids[i]: i for i in np.flatnonzero(question_filter.alive).tolist()}
+
+
+def full_class_name(api):
+    return api.package_name + '.' + api.class_name
+
+
+def apply_segment(kb, segment):
+    # kb with the segment appended, the structures of kb are reused and must not be used afterwards
+    # the stores are copied into one, in the precision of kb; rows of a memory-mapped kb become private memory
+    n_questions = len(kb.questions)
+    alive = alive_indices(kb.question_filter)
+    replaced = [alive[question.id] for question in segment.questions if question.id in alive]
+
+    questions = kb.questions + segment.questions
+    question_store = kb.question_store
+    if len(segment.question_store) > 0:
+        question_store = store.concat_stores([kb.question_store,
+                                              segment.question_store.with_precision(kb.question_store.precision)])
+        store.attach_questions(questions, question_store)
+    question_filter = kb.question_filter
+    question_filter.extend(segment.questions)
+    question_filter.remove(replaced)
+
+    mention_index = kb.mention_index
+    for i in replaced:
+        mention_index.pop(kb.questions[i].id, None)
+    for question_id, question_mentions in segment.mention_index.items():
+        mention_index[question_id] = question_mentions._replace(position=question_mentions.position + n_questions)
+
+    # the methods of a replaced class are dropped from the method index, the class itself stays in javadoc,
+    # where the new class comes later and wins wherever classes are looked up by full name
+    n_classes = len(kb.javadoc)
+    n_rows = len(kb.method_store)
+    javadoc = kb.javadoc + segment.javadoc
+    method_store = kb.method_store
+    method_index = kb.method_index
+    names = set(full_class_name(api) for api in segment.javadoc)
+    for api_i, api in enumerate(kb.javadoc):
+        if full_class_name(api) not in names:
+            continue
+        for method in api.methods:
+            method_name = full_class_name(api) + '.' + method
+            entries = [entry for entry in method_index.get(method_name, ()) if entry[1] != api_i]
+            if entries:
+                method_index[method_name] = entries
+            else:
+                method_index.pop(method_name, None)
+    for method_name, entries in segment.method_index.items():
+        method_index.setdefault(method_name, []).extend((row + n_rows, api_i + n_classes, method_i)
+                                                        for row, api_i, method_i in entries)
+    if len(segment.method_store) > 0:
+        segment_store = segment.method_store.with_precision(kb.method_store.precision)
+        segment_store = store.DocStore([(api_i + n_classes, method_i) for api_i, method_i in segment_store.ids],
+                                       segment_store.matrix, segment_store.idf, segment_store.offsets,
+                                       segment_store.scale)
+        method_store = store.concat_stores([kb.method_store, segment_store])
+    store.attach_javadoc_methods(javadoc, method_store)
+    kb.javadoc_dict_classes.update(segment.javadoc_dict_classes)
+    kb.javadoc_dict_methods.update(segment.javadoc_dict_methods)
+
+    return kb._replace(questions=questions, question_store=question_store, question_filter=question_filter,
+                       javadoc=javadoc, method_store=method_store, method_index=method_index,
+                       mention_index=mention_index)
+
+
+def apply_tombstones(kb, question_ids):
+    # the questions stay in the stores, but they are never ranked nor matched as the same question again
+    alive = alive_indices(kb.question_filter)
+    removed = [alive[question_id] for question_id in question_ids if question_id in alive]
+    kb.question_filter.remove(removed)
+    for i in removed:
+        kb.mention_index.pop(kb.questions[i].id, None)
+    return kb
+
+
+def apply_entries(data_dir, kb, entries, bodies=True):
+    for entry in entries:
+        if 'segment' in entry:
+            kb = apply_segment(kb, load_segment(os.path.join(segments_root(data_dir), entry['segment']), bodies))
+        else:
+            kb = apply_tombstones(kb, entry['tombstones'])
+    return kb
+
+
+def find_kb(data_dir):
+    # the path of the snapshot the entries of the manifest apply to (None if there is none), and the manifest
+    manifest = current_manifest(data_dir)
+    if manifest['compacted'] is not None:
+        path = snapshot.find_snapshot(data_dir, manifest['compacted'])
+        if path is not None:
+            return path, manifest
+        print('The compacted knowledge base snapshot is missing, the compacted segments are left out')
+    return snapshot.find_snapshot(data_dir), manifest
+
+
+def load_kb(data_dir, mmap_mode=None, bodies=True, precision='float64'):
+    # the snapshot (see snapshot.load_snapshot) with the entries of the manifest applied and the generation
+    # of the manifest, None if there is no snapshot of the input files
+    path, manifest = find_kb(data_dir)
+    if path is None:
+        return None, manifest['generation']
+    kb = snapshot.load_snapshot(data_dir, mmap_mode, bodies, precision, snapshot_variant(path))
+    if kb is None:  # replaced by a compaction in another process meanwhile
+        return load_kb(data_dir, mmap_mode, bodies, precision)
+    return apply_entries(data_dir, kb, manifest['entries'], bodies), manifest['generation']
+
+
+def snapshot_variant(path):
+    name = os.path.basename(path)
+    return name.split('-', 1)[1] if '-' in name else None
+
+
+def load_stores(data_dir, question_ids, method_ids, precision='float64'):
+    # the question and method stores of load_kb in the given precision, converted from the float64 ones on disk,
+    # None without a snapshot or if the ids do not match the manifest any more
+    path, manifest = find_kb(data_dir)
+    if path is None:
+        return None
+
+    added = [load_segment(os.path.join(segments_root(data_dir), entry['segment']), bodies=False)
+             for entry in manifest['entries'] if 'segment' in entry]
+    n_questions = len(question_ids) - sum(len(segment.question_store) for segment in added)
+    n_methods = len(method_ids) - sum(len(segment.method_store) for segment in added)
+    if n_questions < 0 or n_methods < 0:
+        return None
+    question_store, method_store = snapshot.load_stores(path, question_ids[:n_questions], method_ids[:n_methods],
+                                                        precision=precision)
+    question_store = store.concat_stores([question_store] + [segment.question_store.with_precision(precision)
+                                                             for segment in added])
+    method_store = store.concat_stores([method_store] + [segment.method_store.with_precision(precision)
+                                                         for segment in added])
+    if len(question_store) != len(question_ids) or len(method_store) != len(method_ids):
+        return None
+    return (store.DocStore(question_ids, question_store.matrix, question_store.idf, question_store.offsets,
+                           question_store.scale),
+            store.DocStore(method_ids, method_store.matrix, method_store.idf, method_store.offsets,
+                           method_store.scale))
+
+
+def apply_manifest(data_dir, kb, bodies=True):
+    # the entries of the manifest applied to a knowledge base built from the input files, and the generation
+    manifest = current_manifest(data_dir)
+    if manifest['compacted'] is not None:
+        print('The knowledge base segments are compacted into the snapshot, load it to include them')
+    return apply_entries(data_dir, kb, manifest['entries'], bodies), manifest['generation']
+
+
+def ingest(data_dir, kb, new_questions=(), new_javadoc=(), deleted=()):
+    # appends a segment of the new questions and javadoc classes and tombstones of the deleted question ids
+    # to the manifest, and returns kb with them applied and the new generation
+    # a question both added and deleted ends up deleted
+    with manifest_lock:
+        manifest = current_manifest(data_dir)
+        manifest['base'] = snapshot.snapshot_key(data_dir)
+        new_entries = list()
+        segment = None
+        if new_questions or new_javadoc:
+            segment = build_segment(kb, new_questions, new_javadoc)
+            name = f'{manifest["generation"] + 1:08d}'
+            save_segment(os.path.join(segments_root(data_dir), name), segment)
+            new_entries.append({'segment': name})
+        if deleted:
+            new_entries.append({'tombstones': list(dict.fromkeys(deleted))})
+        manifest['entries'].extend(new_entries)
+        manifest['generation'] += len(new_entries)
+        write_manifest(data_dir, manifest)
+
+    if segment is not None:
+        kb = apply_segment(kb, segment)
+    if deleted:
+        kb = apply_tombstones(kb, new_entries[-1]['tombstones'])
+    return kb, manifest['generation']
+
+
+def merge(kb, parse_answers):
+    # a knowledge base without the removed questions and the replaced javadoc classes, like one built from scratch
+    # parse_answers=True extracts the mentions again, so that old answers see javadoc classes added by segments
+    keep = np.flatnonzero(kb.question_filter.alive)
+    questions = [kb.questions[i] for i in keep.tolist()]
+    question_store = kb.question_store.subset(keep)
+    store.attach_questions(questions, question_store)
+    question_filter = filters.QuestionFilter(questions)
+
+    latest = {full_class_name(api): api_i for api_i, api in enumerate(kb.javadoc)}
+    javadoc = [api for api_i, api in enumerate(kb.javadoc) if latest[full_class_name(api)] == api_i]
+    method_store, method_index = store.pack_javadoc_methods(javadoc)
+
+    if parse_answers:
+        mention_index = mentions.build_mention_index(questions, kb.javadoc_dict_classes, kb.javadoc_dict_methods)
+    else:
+        positions = {question.id: i for i, question in enumerate(questions)}
+        mention_index = {question_id: question_mentions._replace(position=positions[question_id])
+                         for question_id, question_mentions in kb.mention_index.items()}
+
+    return kb._replace(questions=questions, question_store=question_store, question_filter=question_filter,
+                       javadoc=javadoc, method_store=method_store, method_index=method_index,
+                       mention_index=mention_index)
+
+
+def compact(data_dir):
+    # merges the compacted snapshot (or the snapshot of the input files) and the pending entries into a new variant
+    # of the snapshot, returns its name, None if there was nothing to compact
+    # entries appended while compacting stay pending
+    path, manifest = find_kb(data_dir)
+    entries = manifest['entries']
+    if not entries:
+        return None
+    if path is None:
+        raise FileNotFoundError(f'no knowledge base snapshot in {snapshot.snapshot_root(data_dir)} to compact into')
+    kb = snapshot.load_snapshot(data_dir, variant=snapshot_variant(path))
+
+    parse_answers = False
+    for entry in entries:
+        if 'segment' in entry:
+            segment = load_segment(os.path.join(segments_root(data_dir), entry['segment']))
+            parse_answers = parse_answers or len(segment.javadoc) > 0
+            kb = apply_segment(kb, segment)
+        else:
+            kb = apply_tombstones(kb, entry['tombstones'])
+    kb = merge(kb, parse_answers)
+
+    variant = f'g{manifest["generation"]:08d}'
+    snapshot.save_snapshot(data_dir, kb, variant)
+
+    with manifest_lock:
+        latest = read_manifest(data_dir)
+        latest['entries'] = latest['entries'][len(entries):]
+        latest['compacted'] = variant
+        write_manifest(data_dir, latest)
+    for entry in entries:
+        if 'segment' in entry:
+            shutil.rmtree(os.path.join(segments_root(data_dir), entry['segment']), ignore_errors=True)
+
+    return variant
+
+
+if __name__ == '__main__':
+    import argparse
+    from get_top_k_q import get_top_k
+
+    parser = argparse.ArgumentParser(description='Add to or remove from the knowledge base without rebuilding it')
+    parser.add_argument('--data-dir', default=None, help='knowledge base to update, get_top_k.data_dir if not given')
+    parser.add_argument('--questions', default=None, help='pickle of new domain.Question objects')
+    parser.add_argument('--javadoc', default=None, help='pickle of new domain.API objects')
+    parser.add_argument('--delete', nargs='*', default=(), help='ids of questions to remove')
+    parser.add_argument('--compact', action='store_true', help='merge the segments into the snapshot afterwards')
+    args = parser.parse_args()
+
+    if args.data_dir is not None:
+        get_top_k.set_data_dir(args.data_dir)
+    get_top_k.load_data()  # also makes the domain module importable for the pickles
+    new_questions = pickle.load(open(args.questions, 'rb')) if args.questions else ()
+    new_javadoc = pickle.load(open(args.javadoc, 'rb')) if args.javadoc else ()
+    start = time.perf_counter()
+    generation = get_top_k.ingest(new_questions, new_javadoc, args.delete)
+    print(f'Generation {generation} after {time.perf_counter() - start:.2f}s:', len(new_questions), 'questions,',
+          len(new_javadoc), 'javadoc classes,', len(args.delete), 'deletions')
+    if args.compact:
+        print('Compacted into', get_top_k.compact_kb(background=False))
@@ -0,0 +1,257 @@
+import copy
+import glob
+import hashlib
+import json
+import os
+import shutil
+import time
+from collections import namedtuple
+
+import _pickle as pickle
+import numpy as np
+from get_top_k_q.algorithm import normalize, store
+
+
+# bump it whenever the content or the layout of a snapshot changes
+FORMAT_VERSION = 7
+
+INPUT_FILES = ['w2v_model_stemmed', 'idf', 'api_questions_pickle_new', 'javadoc_pickle_wordsegmented']
+
+# the preprocessed knowledge base, i.e. everything load_data derives from the input files
+Snapshot = namedtuple('Snapshot', ['questions', 'question_store', 'question_filter', 'javadoc',
+                                   'javadoc_dict_classes', 'javadoc_dict_methods', 'method_store', 'method_index',
+                                   'mention_index', 'vocabulary'])
+
+
+def input_paths(data_dir):
+    # gensim saves large arrays of the w2v model next to it, e.g. w2v_model_stemmed.wv.vectors.npy
+    paths = list()
+    for name in INPUT_FILES:
+        paths.append(os.path.join(data_dir, name))
+        paths.extend(sorted(glob.glob(os.path.join(data_dir, name + '.*'))))
+    return paths
+
+
+def snapshot_key(data_dir):
+    # size and modification time stand in for the content, hashing gigabytes of inputs would defeat the purpose
+    h = hashlib.sha256(str(FORMAT_VERSION).encode())
+    for path in input_paths(data_dir):
+        stat = os.stat(path)
+        h.update(f'{os.path.basename(path)}:{stat.st_size}:{stat.st_mtime_ns};'.encode())
+    return h.hexdigest()[:16]
+
+
+def snapshot_root(data_dir):
+    return os.path.join(data_dir, 'snapshot')
+
+
+def save_store(path, name, doc_store):
+    np.save(os.path.join(path, f'{name}_matrix.npy'), doc_store.matrix)
+    np.save(os.path.join(path, f'{name}_idf.npy'), doc_store.idf)
+    np.save(os.path.join(path, f'{name}_offsets.npy'), doc_store.offsets)
+    if doc_store.scale is not None:
+        np.save(os.path.join(path, f'{name}_scale.npy'), doc_store.scale)
+
+
+def load_store(path, name, ids, mmap_mode=None):
+    scale_path = os.path.join(path, f'{name}_scale.npy')
+    return store.DocStore(ids,
+                          np.load(os.path.join(path, f'{name}_matrix.npy'), mmap_mode=mmap_mode),
+                          np.load(os.path.join(path, f'{name}_idf.npy'), mmap_mode=mmap_mode),
+                          np.load(os.path.join(path, f'{name}_offsets.npy')),
+                          np.load(scale_path, mmap_mode=mmap_mode) if os.path.exists(scale_path) else None)
+
+
+def load_store_as(path, name, ids, mmap_mode=None, precision='float64'):
+    # the store name of the snapshot at path in the given precision (see store.PRECISIONS)
+    # the snapshot holds the float64 stores, other precisions are converted from them on first use
+    # and kept in a subdirectory, so that later processes can map them directly
+    variant = os.path.join(path, f'{precision}_{name}')
+    if precision != 'float64' and os.path.exists(variant):
+        return load_store(variant, name, ids, mmap_mode)
+
+    doc_store = load_store(path, name, ids, mmap_mode)
+    if precision == 'float64':
+        return doc_store
+
+    doc_store = doc_store.with_precision(precision)
+    tmp_path = os.path.join(path, f'.{precision}_{name}.{os.getpid()}.tmp')
+    try:
+        os.makedirs(tmp_path, exist_ok=True)
+        save_store(tmp_path, name, doc_store)
+        os.replace(tmp_path, variant)
+    except OSError:  # e.g. another process published it first
+        shutil.rmtree(tmp_path, ignore_errors=True)
+    else:
+        if mmap_mode is not None:
+            return load_store(variant, name, ids, mmap_mode)
+    return doc_store
+
+
+def load_stores(path, question_ids, method_ids, mmap_mode=None, precision='float64'):
+    return (load_store_as(path, 'question', question_ids, mmap_mode, precision),
+            load_store_as(path, 'method', method_ids, mmap_mode, precision))
+
+
+def snapshot_name(key, variant=None):
+    # a variant is a snapshot derived from the one of the input files, e.g. compacted with the segments (see segments.py)
+    return key if variant is None else f'{key}-{variant}'
+
+
+def find_snapshot(data_dir, variant=None):
+    # path of the snapshot of the current input files, None if there is none
+    try:
+        key = snapshot_key(data_dir)
+    except OSError:
+        return None
+    path = os.path.join(snapshot_root(data_dir), snapshot_name(key, variant))
+    try:
+        with open(os.path.join(path, 'meta.json'), 'r', encoding='utf-8') as f:
+            meta = json.load(f)
+    except OSError:
+        return None
+    if meta['version'] != FORMAT_VERSION or meta['key'] != os.path.basename(path):
+        return None
+    return path
+
+
+def has_snapshot(data_dir, variant=None):
+    return find_snapshot(data_dir, variant) is not None
+
+
+# the components of a snapshot can be loaded on their own, see get_top_k.load_data
+# mmap_mode='r' maps the matrices read-only, so processes loading the same snapshot share their pages
+# precision is the precision of the question and method stores, see load_store_as
+
+def load_vocabulary(path, mmap_mode=None):
+    # the vocabulary makes the w2v model and the idf file unnecessary for preprocessing queries
+    with open(os.path.join(path, 'vocabulary.pkl'), 'rb') as f:
+        words = pickle.load(f)
+    return normalize.Vocabulary(words,
+                                np.load(os.path.join(path, 'vocabulary_matrix.npy'), mmap_mode=mmap_mode),
+                                np.load(os.path.join(path, 'vocabulary_idf.npy'), mmap_mode=mmap_mode))
+
+
+def load_questions(path, mmap_mode=None, bodies=True, precision='float64'):
+    # returns the questions, their store and their filter
+    # bodies=False leaves the question and answer bodies out, the mention index already holds what is used of them
+    with open(os.path.join(path, 'questions.pkl'), 'rb') as f:
+        questions = pickle.load(f)
+    if bodies:
+        with open(os.path.join(path, 'bodies.pkl'), 'rb') as f:
+            for question, (question_body, answer_bodies) in zip(questions, pickle.load(f)):
+                question.body = question_body
+                for answer, answer_body in zip(question.answers, answer_bodies):
+                    answer.body = answer_body
+    with open(os.path.join(path, 'filters.pkl'), 'rb') as f:
+        question_filter = pickle.load(f)
+
+    question_store = load_store_as(path, 'question', [question.id for question in questions], mmap_mode, precision)
+    store.attach_questions(questions, question_store)
+    return questions, question_store, question_filter
+
+
+def load_javadoc(path, mmap_mode=None, precision='float64'):
+    # returns the javadoc, its class and method name dicts, the method store and the method index
+    with open(os.path.join(path, 'javadoc.pkl'), 'rb') as f:
+        javadoc, javadoc_dict_classes, javadoc_dict_methods, method_ids, method_index = pickle.load(f)
+    method_store = load_store_as(path, 'method', method_ids, mmap_mode, precision)
+    store.attach_javadoc_methods(javadoc, method_store)
+    return javadoc, javadoc_dict_classes, javadoc_dict_methods, method_store, method_index
+
+
+def load_mentions(path):
+    with open(os.path.join(path, 'mentions.pkl'), 'rb') as f:
+        return pickle.load(f)
+
+
+def load_snapshot(data_dir, mmap_mode=None, bodies=True, precision='float64', variant=None):
+    # every component of the snapshot of the current input files, None if there is none
+    path = find_snapshot(data_dir, variant)
+    if path is None:
+        return None
+
+    questions, question_store, question_filter = load_questions(path, mmap_mode, bodies, precision)
+    javadoc, javadoc_dict_classes, javadoc_dict_methods, method_store, method_index = load_javadoc(path, mmap_mode,
+                                                                                                   precision)
+    return Snapshot(questions, question_store, question_filter, javadoc, javadoc_dict_classes, javadoc_dict_methods,
+                    method_store, method_index, load_mentions(path), load_vocabulary(path, mmap_mode))
+
+
+def save_snapshot(data_dir, snapshot, variant=None):
+    key = snapshot_key(data_dir)
+    name = snapshot_name(key, variant)
+    root = snapshot_root(data_dir)
+    path = os.path.join(root, name)
+    tmp_path = os.path.join(root, f'.{name}.{os.getpid()}.tmp')
+    os.makedirs(tmp_path, exist_ok=True)
+
+    # the matrices are stored in the .npy files, not a second time in the pickle,
+    # and the html bodies are kept apart so that they can be skipped when loading
+    questions = list()
+    bodies = list()
+    for question in snapshot.questions:
+        bodies.append((question.body, [answer.body for answer in question.answers]))
+        question = copy.copy(question)
+        question.matrix = None
+        question.idf_vector = None
+        question.body = None
+        question.answers = [copy.copy(answer) for answer in question.answers]
+        for answer in question.answers:
+            answer.body = None
+        questions.append(question)
+
+    javadoc = list()
+    for api in snapshot.javadoc:
+        api = copy.copy(api)
+        api.methods_matrix = list()
+        api.methods_idf_vector = list()
+        javadoc.append(api)
+
+    save_store(tmp_path, 'question', snapshot.question_store)
+    save_store(tmp_path, 'method', snapshot.method_store)
+    with open(os.path.join(tmp_path, 'questions.pkl'), 'wb') as f:
+        pickle.dump(questions, f, protocol=-1)
+    with open(os.path.join(tmp_path, 'bodies.pkl'), 'wb') as f:
+        pickle.dump(bodies, f, protocol=-1)
+    with open(os.path.join(tmp_path, 'filters.pkl'), 'wb') as f:
+        pickle.dump(snapshot.question_filter, f, protocol=-1)
+    with open(os.path.join(tmp_path, 'javadoc.pkl'), 'wb') as f:
+        pickle.dump((javadoc, snapshot.javadoc_dict_classes, snapshot.javadoc_dict_methods,
+                     snapshot.method_store.ids, snapshot.method_index), f, protocol=-1)
+    with open(os.path.join(tmp_path, 'mentions.pkl'), 'wb') as f:
+        pickle.dump(snapshot.mention_index, f, protocol=-1)
+    with open(os.path.join(tmp_path, 'vocabulary.pkl'), 'wb') as f:
+        pickle.dump(snapshot.vocabulary.words, f, protocol=-1)
+    np.save(os.path.join(tmp_path, 'vocabulary_matrix.npy'), snapshot.vocabulary.matrix)
+    np.save(os.path.join(tmp_path, 'vocabulary_idf.npy'), snapshot.vocabulary.idf)
+
+    # meta.json is written last, a snapshot without it is never loaded
+    meta = {
+        'version': FORMAT_VERSION,
+        'key': name,
+        'created': time.strftime('%Y-%m-%d %H:%M:%S'),
+        'inputs': {os.path.basename(p): os.path.getsize(p) for p in input_paths(data_dir)},
+        'questions': len(questions),
+        'question_words': int(snapshot.question_store.matrix.shape[0]),
+        'javadoc_classes': len(javadoc),
+        'javadoc_methods': len(snapshot.method_store),
+        'vocabulary_words': len(snapshot.vocabulary.words),
+    }
+    with open(os.path.join(tmp_path, 'meta.json'), 'w', encoding='utf-8') as f:
+        json.dump(meta, f, indent=2)
+
+    # another process may have published the same snapshot in the meantime
+    try:
+        os.replace(tmp_path, path)
+    except OSError:
+        shutil.rmtree(tmp_path, ignore_errors=True)
+
+    # snapshots of older input files are stale now, and so are the other variants of a new variant
+    for stale in os.listdir(root):
+        if stale.startswith('.') or stale == name:
+            continue
+        if stale.split('-')[0] != key or (variant is not None and stale != key):
+            shutil.rmtree(os.path.join(root, stale), ignore_errors=True)
+
+    return path
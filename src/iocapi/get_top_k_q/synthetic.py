@@ -0,0 +1,186 @@
+import argparse
+import itertools
+import json
+import math
+import os
+import random
+import sys
+
+import gensim
+import _pickle as pickle
+from get_top_k_q.algorithm import normalize
+
+# the pickles refer to the classes as domain.Question etc., like the real input files
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+import domain
+
+
+# fake versions of the four input files of load_data, with the structure of the real ones:
+# w2v_model_stemmed: a gensim Word2Vec model over stemmed words
+# idf: stemmed word -> (document frequency, idf value)
+# api_questions_pickle_new: domain.Question objects with domain.Answer objects holding html bodies, which mention
+#     APIs through javadoc links, <code> tags and <pre> snippets
+# javadoc_pickle_wordsegmented: domain.API objects with segmented and stemmed method descriptions
+# the vectors are random, so rankings are meaningless, but sizes and code paths are those of a real knowledge base
+
+PACKAGES = ['java.lang', 'java.util', 'java.io', 'java.nio.file', 'java.net', 'java.text', 'java.time',
+            'java.util.concurrent', 'java.util.regex', 'java.util.stream', 'java.sql', 'java.math']
+SYLLABLES = ['ab', 'ac', 'al', 'an', 'ar', 'ba', 'be', 'ca', 'co', 'da', 'de', 'di', 'el', 'en', 'er', 'fa', 'fi',
+             'ga', 'ge', 'ha', 'in', 'is', 'ja', 'ka', 'la', 'le', 'li', 'lo', 'ma', 'me', 'mi', 'mo', 'na', 'ne',
+             'no', 'or', 'pa', 'pe', 'po', 'ra', 're', 'ri', 'ro', 'sa', 'se', 'si', 'so', 'ta', 'te', 'ti', 'to',
+             'un', 'va', 've', 'vi', 'wa', 'ya', 'za']
+TITLE_STARTS = ['how to', 'how do i', 'how can i', 'what is the best way to', 'why does', 'is it possible to']
+
+
+def make_words(n_words, rng):
+    # distinct lowercase pseudo-words, whose stems are distinct as well
+    words = list()
+    stems = set()
+    while len(words) < n_words:
+        word = ''.join(rng.choice(SYLLABLES) for _ in range(rng.randint(2, 4)))
+        stem = normalize.stem(word)
+        if stem not in stems:
+            stems.add(stem)
+            words.append(word)
+    return words
+
+
+def zipf_sampler(words, rng):
+    # word frequencies of natural text roughly follow Zipf's law
+    cum_weights = list(itertools.accumulate(1 / (rank + 1) for rank in range(len(words))))
+    return lambda n: rng.choices(words, cum_weights=cum_weights, k=n)
+
+
+def make_javadoc(n_classes, methods_per_class, sample, rng):
+    javadoc = list()
+    class_names = set()
+    while len(javadoc) < n_classes:
+        class_name = ''.join(word.capitalize() for word in sample(rng.randint(1, 2)))
+        if class_name in class_names:
+            continue
+        class_names.add(class_name)
+        api = domain.API(rng.choice(PACKAGES), class_name, sample(rng.randint(5, 40)))
+        for _ in range(max(1, int(rng.expovariate(1 / methods_per_class)))):
+            method_words = sample(rng.randint(1, 3))
+            method = method_words[0] + ''.join(word.capitalize() for word in method_words[1:])
+            description = sample(rng.randint(3, 25))
+            api.methods.append(method)
+            api.methods_descriptions_pure_text.append(' '.join(description).capitalize() + '. ' +
+                                                      ' '.join(sample(rng.randint(3, 15))) + '.')
+            api.methods_descriptions.append(description)
+            api.methods_descriptions_stemmed.append(normalize.stem_words(description))
+        javadoc.append(api)
+    return javadoc
+
+
+def make_answer_body(javadoc, mentions_per_answer, sample, rng):
+    parts = ['<p>' + ' '.join(sample(rng.randint(5, 30))) + '</p>']
+    for _ in range(rng.randint(0, 2 * mentions_per_answer)):
+        api = rng.choice(javadoc)
+        method = rng.choice(api.methods)
+        path = api.package_name.replace('.', '/') + '/' + api.class_name
+        kind = rng.random()
+        if kind < 0.35:
+            parts.append(f'<a href="https://docs.oracle.com/javase/8/docs/api/{path}.html#{method}(java.lang.String)">'
+                         f'{api.class_name}.{method}</a>')
+        elif kind < 0.5:
+            parts.append(f'<a href="https://docs.oracle.com/javase/8/docs/api/{path}.html">{api.class_name}</a>')
+        elif kind < 0.8:
+            parts.append(f'<code>{api.class_name}.{method}(value)</code>')
+        elif kind < 0.9:
+            parts.append(f'<code>{api.class_name}</code>')
+        else:
+            parts.append(f'<a href="https://example.com/{sample(1)[0]}">{sample(1)[0]}</a>')
+        parts.append('<p>' + ' '.join(sample(rng.randint(3, 15))) + '</p>')
+    if rng.random() < 0.6:
+        api = rng.choice(javadoc)
+        lines = [f'{api.class_name} x = new {api.class_name}();'] + \
+                [f'x.{rng.choice(api.methods)}({sample(1)[0]});' for _ in range(rng.randint(1, 8))]
+        parts.append('<pre><code>' + '\n'.join(lines) + '\n</code></pre>')
+    return '\n'.join(parts)
+
+
+def make_questions(n_questions, answers_per_question, mentions_per_answer, duplicate_rate, javadoc, sample, rng):
+    questions = list()
+    for i in range(n_questions):
+        question_id = str(1000000 + i)
+        if questions and rng.random() < duplicate_rate:
+            title = rng.choice(questions).title
+        else:
+            title = rng.choice(TITLE_STARTS) + ' ' + ' '.join(sample(rng.randint(1, 9)))
+            if rng.random() < 0.7:
+                title += '?'
+        question = domain.Question(question_id, title, '<p>' + ' '.join(sample(rng.randint(10, 60))) + '</p>',
+                                   rng.randint(-2, 200), rng.randint(10, 100000), None)
+        for j in range(rng.randint(0, 2 * answers_per_question)):
+            answer = domain.Answer(f'{question_id}{j:02d}', question_id,
+                                   make_answer_body(javadoc, mentions_per_answer, sample, rng),
+                                   rng.choice([-3, -1, 0, 0, 1, 2, 5, 20, 100]))
+            question.answers.append(answer)
+        if question.answers and rng.random() < 0.5:
+            question.accepted_answer_id = rng.choice(question.answers).id
+        questions.append(question)
+    return questions
+
+
+def make_idf(questions, javadoc, vocabulary):
+    # document frequency over question titles and javadoc descriptions, unused words get the largest idf
+    frequency = dict.fromkeys(vocabulary, 0)
+    documents = [normalize.stem_words(normalize.tokenize(question.title)) for question in questions]
+    documents.extend(api_method for api in javadoc for api_method in api.methods_descriptions_stemmed)
+    for document in documents:
+        for word in set(document):
+            if word in frequency:
+                frequency[word] += 1
+    return {word: (df, math.log((len(documents) + 1) / (df + 1))) for word, df in frequency.items()}
+
+
+def generate(out_dir, n_questions=20000, answers_per_question=2, mentions_per_answer=2, n_classes=500,
+             methods_per_class=10, vocabulary_size=20000, vector_size=100, duplicate_rate=0.02, seed=0):
+    # writes the four input files into out_dir and returns a summary of what was written
+    rng = random.Random(seed)
+    words = make_words(vocabulary_size, rng)
+    sample = zipf_sampler(words, rng)
+
+    javadoc = make_javadoc(n_classes, methods_per_class, sample, rng)
+    questions = make_questions(n_questions, answers_per_question, mentions_per_answer, duplicate_rate, javadoc,
+                               sample, rng)
+
+    # every stemmed word gets a random vector, training would only change the values
+    vocabulary = sorted(set(normalize.stem_words(words)))
+    w2v = gensim.models.Word2Vec(vector_size=vector_size, min_count=1, seed=seed, workers=1)
+    w2v.build_vocab([vocabulary])
+
+    os.makedirs(out_dir, exist_ok=True)
+    w2v.save(os.path.join(out_dir, 'w2v_model_stemmed'))
+    with open(os.path.join(out_dir, 'idf'), 'wb') as f:
+        pickle.dump(make_idf(questions, javadoc, vocabulary), f, protocol=-1)
+    with open(os.path.join(out_dir, 'api_questions_pickle_new'), 'wb') as f:
+        pickle.dump(questions, f, protocol=-1)
+    with open(os.path.join(out_dir, 'javadoc_pickle_wordsegmented'), 'wb') as f:
+        pickle.dump(javadoc, f, protocol=-1)
+
+    return {
+        'questions': len(questions),
+        'answers': sum(len(question.answers) for question in questions),
+        'javadoc_classes': len(javadoc),
+        'javadoc_methods': sum(len(api.methods) for api in javadoc),
+        'vocabulary': len(vocabulary),
+        'seed': seed,
+    }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Write a synthetic knowledge base with the structure of the real one')
+    parser.add_argument('out_dir')
+    parser.add_argument('--questions', type=int, default=20000)
+    parser.add_argument('--answers', type=int, default=2, help='mean number of answers per question')
+    parser.add_argument('--mentions', type=int, default=2, help='mean number of API mentions per answer')
+    parser.add_argument('--classes', type=int, default=500)
+    parser.add_argument('--methods', type=int, default=10, help='mean number of methods per class')
+    parser.add_argument('--vocabulary', type=int, default=20000)
+    parser.add_argument('--vector-size', type=int, default=100)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    print(json.dumps(generate(args.out_dir, args.questions, args.answers, args.mentions, args.classes, args.methods,
+                              args.vocabulary, args.vector_size, seed=args.seed), indent=2))
@@ -0,0 +1,189 @@
+import json
+import time
+import pathlib
+import sqlite3
+import hashlib
+from typing import Any
+
+from loguru import logger
+from llm_hedge import HedgePolicy
+from llm_limits import LimitedLLMService, TokenBucketLimiter, RetryPolicy
+
+# Generation parameters that do not change the answer
+_IGNORED_CONFIGS = ("stream_options",)
+
+
+class LLMCache:
+
+    def __init__(self,
+                 path: pathlib.Path,
+                 max_entries: int = 100_000,
+                 max_age_days: float = 30.0,
+                 bypass: bool = False):
+        """
+        On-disk cache of LLM answers, keyed by model, system prompt, user prompt and generation config
+
+        Args:
+            path (pathlib.Path): Path to the SQLite database, created if missing
+            max_entries (int): Least recently used answers beyond this number are evicted
+            max_age_days (float): Answers older than this are evicted
+            bypass (bool): Never read from the cache, fresh answers still replace the cached ones
+        """
+        self.path: pathlib.Path = pathlib.Path(path)
+        self.max_entries: int = max_entries
+        self.max_age: float = max_age_days * 24 * 3600
+        self.bypass: bool = bypass
+        self.hits: int = 0
+        self.misses: int = 0
+        self.saved_tokens: int = 0
+        self._writes: int = 0
+
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._conn = sqlite3.connect(str(self.path), timeout=30)
+        self._conn.execute("PRAGMA journal_mode=WAL")  # several processes may share the cache
+        self._conn.execute("CREATE TABLE IF NOT EXISTS responses ("
+                           "key TEXT PRIMARY KEY, model TEXT, answer TEXT, tokens INTEGER, "
+                           "created REAL, accessed REAL)")
+        self._conn.commit()
+        self.evict()
+
+    @staticmethod
+    def make_key(model: str, system_prompt: str, prompt: str, configs: dict[str, Any]) -> str:
+        """
+        Content address of a request
+
+        Args:
+            model (str): Model name
+            system_prompt (str): System prompt
+            prompt (str): Rendered user prompt
+            configs (dict[str, Any]): Generation config, e.g. temperature and seed
+        """
+        configs = {k: v for k, v in configs.items() if k not in _IGNORED_CONFIGS}
+        request = json.dumps([model, system_prompt, prompt, configs], sort_keys=True, ensure_ascii=False, default=str)
+        return hashlib.sha256(request.encode("utf-8")).hexdigest()
+
+    def get(self, key: str) -> tuple[str, int] | None:
+        """
+        Cached (answer, tokens) of a request, None on a miss
+
+        Args:
+            key (str): Key of make_key
+        """
+        if self.bypass:
+            self.misses += 1
+            return None
+        row = self._conn.execute("SELECT answer, tokens, created FROM responses WHERE key = ?", (key,)).fetchone()
+        now = time.time()
+        if row is None or now - row[2] > self.max_age:
+            self.misses += 1
+            return None
+        self._conn.execute("UPDATE responses SET accessed = ? WHERE key = ?", (now, key))
+        self._conn.commit()
+        self.hits += 1
+        self.saved_tokens += row[1]
+        return row[0], row[1]
+
+    def put(self, key: str, model: str, answer: str, tokens: int) -> None:
+        """
+        Store the answer of a request
+
+        Args:
+            key (str): Key of make_key
+            model (str): Model name, kept for inspection
+            answer (str): Answer of the LLM
+            tokens (int): Tokens used by the request
+        """
+        now = time.time()
+        self._conn.execute("INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?)",
+                           (key, model, answer, tokens, now, now))
+        self._conn.commit()
+        self._writes += 1
+        if self._writes % 1000 == 0:
+            self.evict()
+
+    def delete(self, key: str) -> None:
+        """
+        Forget the answer of a request, e.g. because it could not be parsed
+
+        Args:
+            key (str): Key of make_key
+        """
+        self._conn.execute("DELETE FROM responses WHERE key = ?", (key,))
+        self._conn.commit()
+
+    def evict(self) -> None:
+        """
+        Drop expired answers, then the least recently used ones beyond max_entries
+        """
+        self._conn.execute("DELETE FROM responses WHERE created < ?", (time.time() - self.max_age,))
+        self._conn.execute("DELETE FROM responses WHERE key IN "
+                           "(SELECT key FROM responses ORDER BY accessed DESC LIMIT -1 OFFSET ?)", (self.max_entries,))
+        self._conn.commit()
+
+    def stats(self) -> dict[str, Any]:
+        """
+        Hit and miss counters of this process, and the number of cached answers
+        """
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "saved_tokens": self.saved_tokens,
+            "entries": self._conn.execute("SELECT COUNT(*) FROM responses").fetchone()[0],
+        }
+
+    def close(self) -> None:
+        self._conn.close()
+
+
+class CachedLLMService(LimitedLLMService):
+
+    def __init__(self,
+                 model: str,
+                 system_prompt: str,
+                 configs: dict[str, Any] | None,
+                 cache: LLMCache,
+                 limiter: TokenBucketLimiter | None = None,
+                 retry: RetryPolicy | None = None,
+                 hedge: HedgePolicy | None = None,
+                 name: str | None = None):
+        """
+        LLMService answering repeated single-turn queries from an LLMCache, cache hits skip the rate limiter
+
+        Args:
+            model (str): Model name
+            system_prompt (str): System prompt
+            configs (dict[str, Any] | None): Generation config
+            cache (LLMCache): Cache shared by every service
+            limiter (TokenBucketLimiter | None): See LimitedLLMService
+            retry (RetryPolicy | None): See LimitedLLMService
+            hedge (HedgePolicy | None): See LimitedLLMService
+            name (str | None): See LimitedLLMService
+        """
+        super().__init__(model, system_prompt, configs, limiter, retry, hedge, name)
+        self.cache: LLMCache = cache
+
+    def cache_key(self, question: str, configs: dict[str, Any] | None = None) -> str:
+        return self.cache.make_key(self.model, self.system_prompt, question, configs or self.configs)
+
+    async def query(self, question: str, configs: dict[str, Any] | None = None) -> tuple[str, int]:
+        key = self.cache_key(question, configs)
+        cached = self.cache.get(key)
+        if cached is not None:
+            return cached
+        answer, tokens, complete = await self.query_complete(question, configs)
+        if answer and complete:  # failed requests and answers cut off by a timeout are not cached
+            self.cache.put(key, self.model, answer, tokens)
+        return answer, tokens
+
+    def invalidate(self, question: str, configs: dict[str, Any] | None = None) -> None:
+        """
+        Forget the cached answer of a question, so that it is asked again
+
+        Args:
+            question (str): User prompt
+            configs (dict[str, Any] | None): Generation config, defaults to the config of the service
+        """
+        self.cache.delete(self.cache_key(question, configs))
+        logger.debug(f"Dropped cached answer: {question[:30]}...")
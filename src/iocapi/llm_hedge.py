@@ -0,0 +1,165 @@
+import time
+import asyncio
+from collections import deque
+from typing import Any, Awaitable, Callable
+
+from loguru import logger
+
+
+class LatencyTracker:
+
+    def __init__(self, window: int = 500):
+        """
+        Latency percentiles over a sliding window of the most recent calls
+
+        Args:
+            window (int): Number of recent latencies kept
+        """
+        self.latencies: deque[float] = deque(maxlen=window)
+
+    def add(self, latency: float) -> None:
+        self.latencies.append(latency)
+
+    def percentile(self, q: float) -> float | None:
+        """
+        Latency below which q percent of the recent calls finished, None without any call
+
+        Args:
+            q (float): Percentile between 0 and 100
+        """
+        if not self.latencies:
+            return None
+        ordered = sorted(self.latencies)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * q / 100))]
+
+    def __len__(self) -> int:
+        return len(self.latencies)
+
+
+class HedgePolicy:
+
+    def __init__(self,
+                 percentile: float = 95.0,
+                 timeout: float | None = 120.0,
+                 min_samples: int = 20,
+                 max_hedges: int = 1,
+                 window: int = 500):
+        """
+        Hedged LLM requests: once a call is slower than the given latency percentile of recent calls,
+        a duplicate request is sent and whichever answers first is used
+
+        Args:
+            percentile (float): Latency percentile after which a call is hedged
+            timeout (float | None): Deadline of a call including its hedges, in seconds, None for no deadline
+            min_samples (int): Calls observed before hedging starts
+            max_hedges (int): Duplicate requests per call at most
+            window (int): Number of recent latencies the percentiles are computed from
+        """
+        self.percentile: float = percentile
+        self.timeout: float | None = timeout
+        self.min_samples: int = min_samples
+        self.max_hedges: int = max_hedges
+        self.window: int = window
+        self.trackers: dict[str, LatencyTracker] = {}
+        self.calls: dict[str, int] = {}
+        self.hedges: dict[str, int] = {}
+        self.hedge_wins: dict[str, int] = {}
+        self.timeouts: dict[str, int] = {}
+
+    def tracker(self, name: str) -> LatencyTracker:
+        if name not in self.trackers:
+            self.trackers[name] = LatencyTracker(self.window)
+            for counter in (self.calls, self.hedges, self.hedge_wins, self.timeouts):
+                counter[name] = 0
+        return self.trackers[name]
+
+    def hedge_delay(self, name: str) -> float | None:
+        tracker = self.tracker(name)
+        if len(tracker) < self.min_samples or self.max_hedges < 1:
+            return None
+        return tracker.percentile(self.percentile)
+
+    async def run(self, name: str, request: Callable[[], Awaitable[tuple[str, int]]]) -> tuple[str, int]:
+        """
+        Run request() with hedging and a deadline, raises TimeoutError once the deadline passes
+
+        Args:
+            name (str): Kind of request, e.g. the config sending it; latencies are tracked per kind
+            request (Callable[[], Awaitable[tuple[str, int]]]): Sends one request, returns (answer, tokens)
+        """
+        tracker = self.tracker(name)
+        self.calls[name] += 1
+        start = time.monotonic()
+        hedge_delay = self.hedge_delay(name)
+
+        async def timed(hedge: int) -> tuple[int, tuple[str, int]]:
+            request_start = time.monotonic()
+            try:
+                result = await request()
+            finally:
+                # A cancelled request counts with the time it ran, otherwise the slow tail would
+                # disappear from the window and the hedge delay would keep shrinking
+                tracker.add(time.monotonic() - request_start)
+            return hedge, result
+
+        pending = {asyncio.ensure_future(timed(0))}
+        hedges, error = 0, None
+        try:
+            while pending:
+                elapsed = time.monotonic() - start
+                deadlines = []
+                if self.timeout is not None:
+                    deadlines.append(self.timeout - elapsed)
+                if hedge_delay is not None and hedges < self.max_hedges:
+                    deadlines.append(hedge_delay * (hedges + 1) - elapsed)
+                done, pending = await asyncio.wait(pending,
+                                                   timeout=max(0.0, min(deadlines)) if deadlines else None,
+                                                   return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is not None:
+                        error = task.exception()
+                        continue
+                    hedge, (answer, tokens) = task.result()
+                    if answer:
+                        self.hedge_wins[name] += hedge > 0
+                        return answer, tokens
+
+                elapsed = time.monotonic() - start
+                if self.timeout is not None and elapsed >= self.timeout:
+                    self.timeouts[name] += 1
+                    raise TimeoutError(f"LLM request exceeded its {self.timeout}s deadline")
+                if pending and hedge_delay is not None and hedges < self.max_hedges \
+                        and elapsed >= hedge_delay * (hedges + 1):
+                    hedges += 1
+                    self.hedges[name] += 1
+                    pending.add(asyncio.ensure_future(timed(hedges)))
+        finally:
+            for task in pending:
+                task.cancel()
+
+        if error is not None:
+            raise error
+        return '', 0
+
+    def stats(self) -> dict[str, dict[str, Any]]:
+        """
+        p50/p95/p99 latency, hedge rate and deadline misses per kind of request
+        """
+        report = {}
+        for name, tracker in self.trackers.items():
+            p50, p95, p99 = (tracker.percentile(q) for q in (50, 95, 99))
+            report[name] = {
+                "calls": self.calls[name],
+                "p50": round(p50, 3) if p50 is not None else None,
+                "p95": round(p95, 3) if p95 is not None else None,
+                "p99": round(p99, 3) if p99 is not None else None,
+                "hedges": self.hedges[name],
+                "hedge_rate": self.hedges[name] / self.calls[name] if self.calls[name] else 0.0,
+                "hedge_wins": self.hedge_wins[name],
+                "timeouts": self.timeouts[name],
+            }
+        return report
+
+    def log_stats(self) -> None:
+        for name, stats in self.stats().items():
+            logger.info(f"LLM latency of {name}: {stats}")
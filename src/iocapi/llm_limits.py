@@ -0,0 +1,280 @@
+import time
+import random
+import asyncio
+from typing import Any
+
+from loguru import logger
+from apiutils import LLMService
+from llm_hedge import HedgePolicy
+from tracing import TRACER
+
+
+class TokenBucketLimiter:
+
+    def __init__(self,
+                 rpm: int | None = None,
+                 tpm: int | None = None,
+                 initial_estimate: int = 1000):
+        """
+        Paces LLM requests to the requests-per-minute and tokens-per-minute quotas of the provider
+
+        Both budgets are token buckets that refill continuously and hold at most one minute of quota.
+        A request reserves the current estimate of its tokens, the estimate follows the tokens reported
+        by recent responses, and the difference is settled once the response is in.
+
+        Args:
+            rpm (int | None): Requests per minute, None for no limit
+            tpm (int | None): Tokens per minute, None for no limit
+            initial_estimate (int): Tokens reserved per request before any response was seen
+        """
+        self.rpm: int | None = rpm
+        self.tpm: int | None = tpm
+        self.estimate: float = float(initial_estimate)
+        self.requests: int = 0
+        self.tokens: int = 0
+        self.waited: float = 0.0
+        self._request_budget: float = float(rpm or 0)
+        self._token_budget: float = float(tpm or 0)
+        self._updated: float = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        elapsed, self._updated = now - self._updated, now
+        if self.rpm:
+            self._request_budget = min(self.rpm, self._request_budget + elapsed * self.rpm / 60)
+        if self.tpm:
+            self._token_budget = min(self.tpm, self._token_budget + elapsed * self.tpm / 60)
+
+    async def acquire(self) -> int:
+        """
+        Wait until a request fits into both budgets, returns the number of tokens reserved for it
+        """
+        async with self._lock:  # First come, first served
+            reserved = int(min(self.estimate, self.tpm)) if self.tpm else 0
+            while True:
+                self._refill()
+                wait = 0.0
+                if self.rpm and self._request_budget < 1:
+                    wait = (1 - self._request_budget) * 60 / self.rpm
+                if self.tpm and self._token_budget < reserved:
+                    wait = max(wait, (reserved - self._token_budget) * 60 / self.tpm)
+                if wait <= 0:
+                    break
+                self.waited += wait
+                await asyncio.sleep(wait)
+            if self.rpm:
+                self._request_budget -= 1
+            self._token_budget -= reserved
+            return reserved
+
+    def record(self, reserved: int, tokens: int) -> None:
+        """
+        Settle a finished request
+
+        Args:
+            reserved (int): Tokens returned by acquire
+            tokens (int): Tokens the response actually used
+        """
+        self._refill()
+        if self.tpm:
+            self._token_budget -= tokens - reserved
+        self.requests += 1
+        self.tokens += tokens
+        if tokens > 0:
+            self.estimate = 0.9 * self.estimate + 0.1 * tokens
+
+    def stats(self) -> dict[str, Any]:
+        return {
+            "requests": self.requests,
+            "tokens": self.tokens,
+            "token_estimate": round(self.estimate),
+            "waited_seconds": round(self.waited, 2),
+        }
+
+
+class RetryPolicy:
+
+    def __init__(self,
+                 max_retries: int = 3,
+                 base_delay: float = 1.0,
+                 max_delay: float = 60.0,
+                 jitter: float = 0.25):
+        """
+        Exponential backoff for failed LLM requests and unusable answers
+
+        Args:
+            max_retries (int): Retries after the first attempt
+            base_delay (float): Delay before the first retry, in seconds, doubled for every further retry
+            max_delay (float): Upper bound of a delay
+            jitter (float): Random extra share of a delay, so that concurrent retries spread out
+        """
+        self.max_retries: int = max_retries
+        self.base_delay: float = base_delay
+        self.max_delay: float = max_delay
+        self.jitter: float = jitter
+        self.retries: int = 0
+
+    def delay(self, retry: int) -> float:
+        """
+        Delay before the given retry, counted from 1
+
+        Args:
+            retry (int): Number of the retry
+        """
+        delay = min(self.max_delay, self.base_delay * 2 ** (retry - 1))
+        return delay * (1 + random.uniform(0, self.jitter))
+
+    async def backoff(self, retry: int) -> None:
+        self.retries += 1
+        await asyncio.sleep(self.delay(retry))
+
+
+class IncompleteAnswer(Exception):
+
+    def __init__(self, answer: str, tokens: int, reason: str):
+        """
+        Raised for a streamed answer that did not finish normally, e.g. cut off by a stream timeout
+
+        Args:
+            answer (str): The part of the answer received
+            tokens (int): Tokens reported so far
+            reason (str): Why the stream ended
+        """
+        super().__init__(f"incomplete answer: {reason}")
+        self.answer: str = answer
+        self.tokens: int = tokens
+
+
+class LimitedLLMService(LLMService):
+
+    # Same limits as LLMService.query: the whole stream, and the wait for each chunk of it
+    STREAM_TIMEOUT: float = 60.0
+    CHUNK_TIMEOUT: float = 20.0
+
+    def __init__(self,
+                 model: str,
+                 system_prompt: str,
+                 configs: dict[str, Any] | None,
+                 limiter: TokenBucketLimiter | None = None,
+                 retry: RetryPolicy | None = None,
+                 hedge: HedgePolicy | None = None,
+                 name: str | None = None):
+        """
+        LLMService whose requests wait for the rate limiter, may be hedged and are retried with backoff
+
+        Args:
+            model (str): Model name
+            system_prompt (str): System prompt
+            configs (dict[str, Any] | None): Generation config
+            limiter (TokenBucketLimiter | None): Limiter shared by every service, None for no pacing
+            retry (RetryPolicy | None): Retries of transport errors and empty answers, None for no retries
+            hedge (HedgePolicy | None): Deadlines and hedged duplicates of slow requests, None to send each request once
+            name (str | None): Kind of request the latencies are tracked under, defaults to the model name
+        """
+        super().__init__(model, system_prompt, configs)
+        self.limiter: TokenBucketLimiter | None = limiter
+        self.retry: RetryPolicy | None = retry
+        self.hedge: HedgePolicy | None = hedge
+        self.name: str = name or model
+
+    async def _request(self, question: str, configs: dict[str, Any] | None) -> tuple[str, int]:
+        # One request to the provider, hedged duplicates count against the quota as well
+        with TRACER.span("llm_request"):
+            waiting = time.monotonic()
+            reserved = await self.limiter.acquire() if self.limiter is not None else 0
+            TRACER.record(queue_wait=time.monotonic() - waiting)
+            try:
+                answer, tokens = await self._stream(question, configs)
+            except IncompleteAnswer as e:
+                if self.limiter is not None:
+                    self.limiter.record(reserved, e.tokens)
+                raise
+            except BaseException:  # Including the cancellation of a hedged duplicate
+                if self.limiter is not None:
+                    self.limiter.record(reserved, 0)
+                raise
+            if self.limiter is not None:
+                self.limiter.record(reserved, tokens)
+            TRACER.record(tokens=tokens)
+            return answer, tokens
+
+    async def _stream(self, question: str, configs: dict[str, Any] | None) -> tuple[str, int]:
+        # LLMService.query, except that an answer cut off by a timeout, an error or the token limit
+        # raises IncompleteAnswer instead of being returned like a complete one
+        completion = await self._create_completion(
+            messages=[{"role": "user", "content": question}],
+            stream=True,
+            configs=configs or self.configs,
+        )
+        tokens = 0
+        buffer: list[str] = []
+        finish_reason: str | None = None
+        iterator = aiter(completion)
+        start = time.monotonic()
+        while True:
+            if time.monotonic() - start > self.STREAM_TIMEOUT:
+                raise IncompleteAnswer("".join(buffer), tokens, f"stream took longer than {self.STREAM_TIMEOUT:g}s")
+            try:
+                chunk = await asyncio.wait_for(anext(iterator), timeout=self.CHUNK_TIMEOUT)
+            except asyncio.TimeoutError:
+                raise IncompleteAnswer("".join(buffer), tokens, f"no chunk within {self.CHUNK_TIMEOUT:g}s")
+            except StopAsyncIteration:
+                break
+            except Exception as e:
+                raise IncompleteAnswer("".join(buffer), tokens, f"stream failed: {e}")
+            if chunk.choices:
+                if chunk.choices[0].delta.content:
+                    buffer.append(chunk.choices[0].delta.content)
+                finish_reason = chunk.choices[0].finish_reason or finish_reason
+            if getattr(chunk, "usage", None):
+                tokens += getattr(chunk.usage, "total_tokens", 0) or 0
+        if finish_reason == "length":
+            raise IncompleteAnswer("".join(buffer), tokens, "cut off by the token limit")
+        return "".join(buffer), tokens
+
+    async def query(self, question: str, configs: dict[str, Any] | None = None) -> tuple[str, int]:
+        answer, tokens, _ = await self.query_complete(question, configs)
+        return answer, tokens
+
+    async def query_complete(self, question: str, configs: dict[str, Any] | None = None) -> tuple[str, int, bool]:
+        """
+        query, and whether the answer finished normally; once the retries are spent,
+        the longest incomplete answer is returned like LLMService.query does, but flagged
+
+        Args:
+            question (str): User prompt
+            configs (dict[str, Any] | None): Generation config, defaults to the config of the service
+        """
+        max_retries = self.retry.max_retries if self.retry is not None else 0
+        error: Exception | None = None
+        partial: IncompleteAnswer | None = None
+        for attempt in range(max_retries + 1):
+            if attempt > 0:
+                logger.warning(f"LLM request failed ({error}), retry {attempt}/{max_retries}")
+                await self.retry.backoff(attempt)
+            try:
+                if self.hedge is not None:
+                    answer, tokens = await self.hedge.run(self.name, lambda: self._request(question, configs))
+                else:
+                    answer, tokens = await self._request(question, configs)
+            except IncompleteAnswer as e:
+                error = e
+                if partial is None or len(e.answer) > len(partial.answer):
+                    partial = e
+                continue
+            except Exception as e:  # Rate limits, timeouts and connection errors of the client, missed deadlines
+                error = e
+                continue
+            if answer:
+                return answer, tokens, True
+            error = ValueError("Empty response")
+        logger.error(f"LLM request failed after {max_retries} retries: {error}")
+        if partial is not None and partial.answer:
+            return partial.answer, partial.tokens, False
+        return '', 0, False
+
+    async def queries(self, questions: list[str], tqdm_title: str | None = 'Processing', **kwargs: Any) -> list:
+        if self.retry is not None:
+            kwargs["max_retries"] = 0  # query retries already
+        return await super().queries(questions, tqdm_title=tqdm_title, **kwargs)
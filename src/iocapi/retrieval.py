@@ -0,0 +1,248 @@
+import os
+import atexit
+import asyncio
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, wait
+from typing import Any, Callable, Sequence
+
+from loguru import logger
+from get_top_k_q import get_top_k
+from get_top_k_q.get_top_k import prepare_shared_kb, load_shared_kb
+from tracing import TRACER
+
+_warm_up_barrier = None
+
+# Seconds a worker waits for the others in cache_stats and collect_traces, a busy or dead worker is left out after it
+STATS_TIMEOUT = 30.0
+
+
+def _init_worker(barrier, cache_config, data_dir, trace) -> None:
+    global _warm_up_barrier
+    _warm_up_barrier = barrier
+    if trace is not None:  # Records of the parent are not carried over by fork
+        TRACER.enable(chrome=trace)
+    else:
+        TRACER.disable()
+    if data_dir != get_top_k.data_dir:
+        get_top_k.set_data_dir(data_dir)
+    if cache_config is not None:  # Not inherited by spawned workers
+        get_top_k.enable_retrieval_cache(*cache_config)
+    load_shared_kb()
+
+
+def _warm_up() -> int:
+    # Blocks until every worker has loaded the knowledge base, so each worker takes exactly one of these
+    _warm_up_barrier.wait()
+    return os.getpid()
+
+
+def _sync(timeout: float) -> None:
+    # Same barrier as _warm_up, so each worker takes one task; if a worker is stuck in a long retrieval or gone,
+    # the barrier breaks after timeout and the others go on, the task left over may run twice in one worker
+    try:
+        _warm_up_barrier.wait(timeout)
+    except threading.BrokenBarrierError:
+        pass
+
+
+def _cache_stats(timeout: float) -> tuple[int, dict[str, Any] | None]:
+    _sync(timeout)
+    return os.getpid(), get_top_k.retrieval_cache_stats()
+
+
+def _trace_records(timeout: float) -> tuple[int, dict[str, Any]]:
+    _sync(timeout)
+    records = TRACER.export()
+    TRACER.reset()  # Collected once, a second task of the same worker gets nothing
+    return os.getpid(), records
+
+
+class RetrievalPool:
+
+    def __init__(self,
+                 worker_fn: Callable[[str, int], Any],
+                 max_workers: int | None = None,
+                 batch_fn: Callable[[Sequence[str], int], list[Any]] | None = None):
+        """
+        Long-lived pool of retrieval worker processes, every worker loads the knowledge base once
+
+        Args:
+            worker_fn (Callable[[str, int], Any]): Picklable function called as worker_fn(statement, top_k)
+            max_workers (int | None): Number of worker processes, defaults to half of the cpu count
+            batch_fn (Callable[[Sequence[str], int], list[Any]] | None): Optional picklable batched worker_fn,
+                called as batch_fn(statements, top_k)
+        """
+        self.worker_fn = worker_fn
+        self.batch_fn = batch_fn
+        self.max_workers: int = max_workers or max(1, (os.cpu_count() or 2) // 2)
+        self._executor: ProcessPoolExecutor | None = None
+        self._barrier = None
+
+    def start(self, wait_ready: bool = True) -> "RetrievalPool":
+        """
+        Start the workers and load the knowledge base in each of them
+
+        Args:
+            wait_ready (bool): Block until every worker is warm, otherwise warm up in the background
+        """
+        if self._executor is not None:
+            return self
+        prepare_shared_kb()
+        ctx = multiprocessing.get_context()
+        self._barrier = ctx.Barrier(self.max_workers)
+        self._executor = ProcessPoolExecutor(max_workers=self.max_workers,
+                                             mp_context=ctx,
+                                             initializer=_init_worker,
+                                             initargs=(self._barrier, get_top_k.retrieval_cache_config, get_top_k.data_dir,
+                                                       TRACER.chrome if TRACER.enabled else None))
+        warm_ups = [self._executor.submit(_warm_up) for _ in range(self.max_workers)]
+        atexit.register(self.shutdown)
+        if wait_ready:
+            wait(warm_ups)
+            logger.info(f"Retrieval pool ready with {self.max_workers} workers")
+        return self
+
+    async def submit(self, statement: str, top_k: int) -> Any:
+        """
+        Run worker_fn(statement, top_k) in one of the workers
+
+        Args:
+            statement (str): Query statement
+            top_k (int): Number of APIs to retrieve
+        """
+        if self._executor is None:
+            self.start()
+        loop = asyncio.get_running_loop()
+        with TRACER.span("retrieval_pool"):  # Round trip including the wait for a free worker
+            return await loop.run_in_executor(self._executor, self.worker_fn, statement, top_k)
+
+    async def map(self,
+                  statements: Sequence[str],
+                  top_k: int,
+                  on_result: Callable[[int, Any], None] | None = None) -> list[Any]:
+        """
+        Run worker_fn for every statement, results keep the order of statements
+
+        Args:
+            statements (Sequence[str]): Query statements
+            top_k (int): Number of APIs to retrieve
+            on_result (Callable[[int, Any], None] | None): Called as on_result(index, result) as soon as the
+                statement at index is retrieved, e.g. to checkpoint it
+        """
+        async def retrieve(i: int, statement: str) -> Any:
+            result = await self.submit(statement, top_k)
+            if on_result is not None:
+                on_result(i, result)
+            return result
+
+        return list(await asyncio.gather(*[retrieve(i, stmt) for i, stmt in enumerate(statements)]))
+
+    async def map_batches(self,
+                          statements: Sequence[str],
+                          top_k: int,
+                          on_result: Callable[[int, Any], None] | None = None) -> list[Any]:
+        """
+        Like map, but every worker gets one contiguous chunk of statements for batch_fn
+
+        Args:
+            statements (Sequence[str]): Query statements
+            top_k (int): Number of APIs to retrieve
+            on_result (Callable[[int, Any], None] | None): See map, called for every statement of a chunk
+                as soon as that chunk is retrieved
+        """
+        if self.batch_fn is None:
+            return await self.map(statements, top_k, on_result)
+        if self._executor is None:
+            self.start()
+        n_chunks = min(self.max_workers, len(statements))
+        if n_chunks == 0:
+            return []
+        chunk_size = -(-len(statements) // n_chunks)
+        chunks = [list(statements[i:i + chunk_size]) for i in range(0, len(statements), chunk_size)]
+        loop = asyncio.get_running_loop()
+
+        async def retrieve(start: int, chunk: list[str]) -> list[Any]:
+            results = await loop.run_in_executor(self._executor, self.batch_fn, chunk, top_k)
+            if on_result is not None:
+                for i, result in enumerate(results, start):
+                    on_result(i, result)
+            return results
+
+        with TRACER.span("retrieval_pool_batches"):
+            results = await asyncio.gather(*[retrieve(i * chunk_size, chunk) for i, chunk in enumerate(chunks)])
+        return [result for chunk_results in results for result in chunk_results]
+
+    def _each_worker(self, fn: Callable[[float], tuple[int, Any]], timeout: float) -> list[tuple[int, Any]]:
+        # (pid, result) of fn in every worker that answers within about timeout seconds, in no particular order
+        if self._barrier.broken:  # Left broken by an earlier call that timed out
+            self._barrier.reset()
+        futures = [self._executor.submit(fn, timeout) for _ in range(self.max_workers)]
+        done, pending = wait(futures, timeout=2 * timeout)  # A worker may wait for the barrier, then take a second task
+        for future in pending:
+            future.cancel()
+        results = []
+        for future in done:
+            try:
+                results.append(future.result())
+            except Exception as e:  # A worker died, the pool is broken
+                logger.warning(f"Retrieval worker failed to report: {e!r}")
+        missing = self.max_workers - len(set(pid for pid, _ in results))
+        if missing > 0:
+            logger.warning(f"{missing} of {self.max_workers} retrieval workers did not report within {timeout:.0f}s")
+        return results
+
+    def cache_stats(self, timeout: float = STATS_TIMEOUT) -> dict[str, Any] | None:
+        """
+        Retrieval cache hits and misses summed over the workers, None without a retrieval cache
+
+        Args:
+            timeout (float): Seconds to wait for busy workers, those that do not report in time are left out
+        """
+        if self._executor is None or get_top_k.retrieval_cache_config is None:
+            return None
+        try:
+            reports = dict(self._each_worker(_cache_stats, timeout))  # One report per worker
+        except RuntimeError as e:  # The pool is broken or shut down
+            logger.warning(f"Retrieval cache stats of the workers are lost: {e!r}")
+            return None
+        reports = [report for report in reports.values() if report is not None]
+        total = {key: sum(report[key] for report in reports) for key in ("memory_hits", "disk_hits", "misses", "entries")}
+        lookups = total["memory_hits"] + total["disk_hits"] + total["misses"]
+        total["hit_rate"] = (total["memory_hits"] + total["disk_hits"]) / lookups if lookups else 0.0
+        total["workers"] = len(reports)
+        return total
+
+    def collect_traces(self, timeout: float = STATS_TIMEOUT) -> None:
+        """
+        Merge the spans recorded by the workers into the tracer of this process, before it exits
+
+        Args:
+            timeout (float): Seconds to wait for busy workers, the spans of those that do not report in time stay there
+        """
+        if self._executor is None or not TRACER.enabled:
+            return
+        try:
+            reports = self._each_worker(_trace_records, timeout)
+        except RuntimeError:  # The interpreter is exiting or the pool is broken, the executor takes no more tasks
+            logger.warning("Spans of the retrieval workers are lost, call collect_traces before exiting")
+            return
+        for _, records in reports:
+            TRACER.merge(records)
+
+    def shutdown(self) -> None:
+        """
+        Stop the workers, pending tasks are cancelled
+        """
+        if self._executor is None:
+            return
+        self._executor.shutdown(wait=True, cancel_futures=True)
+        self._executor = None
+        self._barrier = None
+        atexit.unregister(self.shutdown)
+
+    def __enter__(self) -> "RetrievalPool":
+        return self.start()
+
+    def __exit__(self, *exc) -> None:
+        self.shutdown()
@@ -0,0 +1,298 @@
+import os
+import json
+import time
+import queue
+import socket
+import argparse
+import threading
+import http.client
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from socketserver import ThreadingMixIn, UnixStreamServer
+from typing import Any, Sequence
+
+from loguru import logger
+from config import ClarifyConfig, CoderConfig
+from get_top_k_q import get_top_k
+
+
+class MicroBatcher:
+
+    def __init__(self, max_wait_ms: float = 5.0, max_batch: int = 64):
+        """
+        Collects the statements of concurrent requests and scores them in one get_similar_apis_batch call
+
+        The first statement of a batch waits at most max_wait_ms for others to join it, statements
+        arriving while a batch is scored form the next batch.
+
+        Args:
+            max_wait_ms (float): Time the first statement of a batch waits for more, in milliseconds
+            max_batch (int): Statements per batch at most
+        """
+        self.max_wait: float = max_wait_ms / 1000
+        self.max_batch: int = max_batch
+        self.batches: int = 0
+        self.statements: int = 0
+        self._queue: queue.Queue = queue.Queue()
+        self._thread = threading.Thread(target=self._run, name="micro-batcher", daemon=True)
+        self._thread.start()
+
+    def submit(self, statement: str, top_k: int) -> Future:
+        """
+        Future of (APIs, timings) for one statement, timings holds queue_ms, compute_ms and batch_size
+
+        Args:
+            statement (str): Query statement
+            top_k (int): Number of APIs to retrieve
+        """
+        future: Future = Future()
+        self._queue.put((statement, top_k, time.monotonic(), future))
+        return future
+
+    def _collect(self) -> list[tuple[str, int, float, Future]]:
+        batch = [self._queue.get()]
+        deadline = time.monotonic() + self.max_wait
+        while len(batch) < self.max_batch:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(self._queue.get(timeout=timeout))
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self) -> None:
+        while True:
+            batch = self._collect()
+            started = time.monotonic()
+            by_top_k: dict[int, list[tuple[str, int, float, Future]]] = {}
+            for item in batch:
+                by_top_k.setdefault(item[1], []).append(item)
+            for top_k, items in by_top_k.items():
+                try:
+                    results = ClarifyConfig.get_similar_apis_batch([item[0] for item in items], top_k)
+                except Exception as e:
+                    # One bad statement must not fail the requests batched with it, each is scored on its own
+                    logger.warning(f"Retrieval of a batch of {len(items)} failed ({e!r}), retrying one by one")
+                    for item in items:
+                        self._score([item], top_k, started, len(batch))
+                    continue
+                self._finish(items, results, started, len(batch))
+            self.batches += 1
+            self.statements += len(batch)
+
+    def _score(self, items: list[tuple[str, int, float, Future]], top_k: int, started: float, batch_size: int) -> None:
+        try:
+            results = ClarifyConfig.get_similar_apis_batch([item[0] for item in items], top_k)
+        except Exception as e:  # Fails these requests only, the server keeps running
+            for item in items:
+                item[3].set_exception(e)
+            return
+        self._finish(items, results, started, batch_size)
+
+    @staticmethod
+    def _finish(items: list[tuple[str, int, float, Future]], results: list, started: float, batch_size: int) -> None:
+        finished = time.monotonic()
+        for (_, _, enqueued, future), apis in zip(items, results):
+            future.set_result(([api.fullname for api in apis], {
+                "queue_ms": (started - enqueued) * 1000,
+                "compute_ms": (finished - started) * 1000,
+                "batch_size": batch_size,
+            }))
+
+    def stats(self) -> dict[str, Any]:
+        return {
+            "batches": self.batches,
+            "statements": self.statements,
+            "mean_batch_size": self.statements / self.batches if self.batches else 0.0,
+        }
+
+
+class RetrievalHandler(BaseHTTPRequestHandler):
+    """
+    POST /apis with {"statement": str, "top_k": int} or {"statements": [str], "top_k": int}
+    returns {"apis": [str]} or {"apis": [[str]]}, the fullnames of the standard APIs of get_similar_apis;
+    GET /stats returns the batching and retrieval cache statistics
+
+    Every response carries X-Queue-Ms, X-Compute-Ms, X-Batch-Size and X-Total-Ms headers
+    """
+    protocol_version = "HTTP/1.1"  # Keep-alive, clients reuse their connection
+    batcher: MicroBatcher
+
+    def do_POST(self) -> None:
+        received = time.monotonic()
+        if self.path != "/apis":
+            self._send(404, {"error": f"unknown path {self.path}"})
+            return
+        try:
+            request = json.loads(self.rfile.read(int(self.headers.get("Content-Length") or 0)))
+            top_k = int(request.get("top_k", CoderConfig.TOP_K))
+            single = "statement" in request
+            statements = [request["statement"]] if single else request["statements"]
+            # Checked here, a malformed statement would otherwise fail the batch it is scored in
+            if not isinstance(statements, list) or not all(isinstance(statement, str) for statement in statements):
+                raise TypeError('"statement" must be a string and "statements" a list of strings')
+        except (ValueError, KeyError, TypeError, AttributeError) as e:
+            self._send(400, {"error": f"bad request: {e}"})
+            return
+
+        futures = [self.batcher.submit(statement, top_k) for statement in statements]
+        try:
+            results = [future.result() for future in futures]
+        except Exception as e:
+            logger.exception(f"Retrieval failed: {e}")
+            self._send(500, {"error": str(e)})
+            return
+        apis = [result[0] for result in results]
+        timings = [result[1] for result in results]
+        self._send(200, {"apis": apis[0] if single else apis}, {
+            "X-Queue-Ms": f"{max(t['queue_ms'] for t in timings):.2f}" if timings else "0",
+            "X-Compute-Ms": f"{max(t['compute_ms'] for t in timings):.2f}" if timings else "0",
+            "X-Batch-Size": str(max(t['batch_size'] for t in timings)) if timings else "0",
+            "X-Total-Ms": f"{(time.monotonic() - received) * 1000:.2f}",
+        })
+
+    def do_GET(self) -> None:
+        if self.path != "/stats":
+            self._send(404, {"error": f"unknown path {self.path}"})
+            return
+        self._send(200, {"batching": self.batcher.stats(), "retrieval_cache": get_top_k.retrieval_cache_stats()})
+
+    def _send(self, status: int, body: dict[str, Any], headers: dict[str, str] | None = None) -> None:
+        payload = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def address_string(self) -> str:
+        return str(self.client_address[0]) if self.client_address else "unix"
+
+    def log_message(self, format: str, *args: Any) -> None:
+        logger.debug(f"{self.address_string()} {format % args}")
+
+
+class UnixHTTPServer(ThreadingMixIn, UnixStreamServer):
+    daemon_threads = True
+    request_queue_size = 128  # Connects beyond the backlog fail right away on Unix sockets
+
+
+class TCPHTTPServer(ThreadingHTTPServer):
+    request_queue_size = 128
+
+
+def serve(host: str = "127.0.0.1",
+          port: int = 8765,
+          unix_socket: str | None = None,
+          max_wait_ms: float = 5.0,
+          max_batch: int = 64) -> None:
+    """
+    Load the knowledge base once and answer retrieval requests until interrupted
+
+    Args:
+        host (str): Address to listen on, ignored with unix_socket
+        port (int): Port to listen on, ignored with unix_socket
+        unix_socket (str | None): Path of a Unix socket to listen on instead of TCP
+        max_wait_ms (float): See MicroBatcher
+        max_batch (int): See MicroBatcher
+    """
+    get_top_k.load_data()
+    ClarifyConfig.api_resolver()
+    handler = type("Handler", (RetrievalHandler,), {"batcher": MicroBatcher(max_wait_ms, max_batch)})
+    if unix_socket is not None:
+        if os.path.exists(unix_socket):
+            os.remove(unix_socket)
+        server = UnixHTTPServer(unix_socket, handler)
+        logger.info(f"Retrieval server listening on {unix_socket}")
+    else:
+        server = TCPHTTPServer((host, port), handler)
+        logger.info(f"Retrieval server listening on http://{host}:{port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        if unix_socket is not None and os.path.exists(unix_socket):
+            os.remove(unix_socket)
+
+
+class _UnixHTTPConnection(http.client.HTTPConnection):
+
+    def __init__(self, path: str, timeout: float):
+        super().__init__("localhost", timeout=timeout)
+        self.unix_path: str = path
+
+    def connect(self) -> None:
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(self.timeout)
+        self.sock.connect(self.unix_path)
+
+
+class RetrievalClient:
+
+    def __init__(self,
+                 host: str = "127.0.0.1",
+                 port: int = 8765,
+                 unix_socket: str | None = None,
+                 timeout: float = 60.0):
+        """
+        Client of a retrieval server, one connection per client, so use one client per thread
+
+        Args:
+            host (str): Address of the server, ignored with unix_socket
+            port (int): Port of the server, ignored with unix_socket
+            unix_socket (str | None): Path of the Unix socket of the server
+            timeout (float): Socket timeout in seconds
+        """
+        if unix_socket is not None:
+            self._conn: http.client.HTTPConnection = _UnixHTTPConnection(unix_socket, timeout)
+        else:
+            self._conn = http.client.HTTPConnection(host, port, timeout=timeout)
+        self.last_timings: dict[str, str] = {}
+
+    def _post(self, body: dict[str, Any]) -> Any:
+        self._conn.request("POST", "/apis", json.dumps(body), {"Content-Type": "application/json"})
+        response = self._conn.getresponse()
+        result = json.loads(response.read())
+        if response.status != 200:
+            raise RuntimeError(f"Retrieval server answered {response.status}: {result.get('error')}")
+        self.last_timings = {name: response.getheader(name)
+                             for name in ("X-Queue-Ms", "X-Compute-Ms", "X-Batch-Size", "X-Total-Ms")}
+        return result["apis"]
+
+    def get_similar_apis(self, statement: str, top_k: int) -> list[str]:
+        """
+        Fullnames of the standard APIs ClarifyConfig.get_similar_apis returns for the statement
+
+        Args:
+            statement (str): Query statement
+            top_k (int): Number of APIs to retrieve
+        """
+        return self._post({"statement": statement, "top_k": top_k})
+
+    def get_similar_apis_batch(self, statements: Sequence[str], top_k: int) -> list[list[str]]:
+        return self._post({"statements": list(statements), "top_k": top_k})
+
+    def close(self) -> None:
+        self._conn.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Serve API retrieval from one loaded knowledge base")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--socket", default=None, help="listen on this Unix socket instead of TCP")
+    parser.add_argument("--max-wait-ms", type=float, default=5.0,
+                        help="time a request waits for concurrent ones to join its batch")
+    parser.add_argument("--max-batch", type=int, default=64, help="statements scored together at most")
+    parser.add_argument("--retrieval-cache", choices=["memory", "disk"], default=None,
+                        help="reuse the APIs of statements with the same stemmed words")
+    args = parser.parse_args()
+    if args.retrieval_cache is not None:
+        get_top_k.enable_retrieval_cache(disk=args.retrieval_cache == "disk")
+    serve(args.host, args.port, args.socket, args.max_wait_ms, args.max_batch)
@@ -1,43 +1,131 @@
+import time
+import atexit
 import asyncio
+import argparse
 
 import pandas as pd
+from loguru import logger
 from apiutils import dataset as dt
-from apiutils import Calculator, LLMService
+from apiutils import Calculator, LLMService, API
+from checkpoint import CheckpointLog
 from config import PathConfig, ClarifyConfig, CoderConfig, LLMConfig
+from get_top_k_q import get_top_k
+from tracing import TRACER
 
 LLMService.set_llm_client_config(**LLMConfig.CLIENT_CONFIG)
 
+# LLM requests in flight at once when every query is checkpointed on its own, like the batches of LLMService.queries
+BATCH_CONCURRENCY = 50
+
+
 async def save_to_csv(data, filename):
     df = pd.DataFrame(data)
     df.index.name = "idx"
     df.to_csv(filename, index=True, encoding="utf-8")
 
 
-async def batch_clarify(queries, dataset, save_to_file=True):
-    clarifier_res = await ClarifyConfig.clarifies(queries)
+async def each(indices, handle, concurrency=BATCH_CONCURRENCY):
+    # handle(i) for every index, all issued at once with at most `concurrency` running;
+    # handle checkpoints its own query as soon as it is done, so a slow request holds up nothing but itself
+    inbox = asyncio.Queue()
+    for i in indices:
+        inbox.put_nowait(i)
+    inbox.put_nowait(None)
+    await run_stage(inbox, None, handle, concurrency)
+
+
+async def clarify_queries(queries, log=None):
+    clarifier_res = [None] * len(queries)
+    todo = []
+    for i in range(len(queries)):
+        done = log.get(i, 'clarify') if log is not None else None
+        if done is not None:
+            clarifier_res[i] = ClarifyConfig.ClarifyResponse(**done)
+        else:
+            todo.append(i)
+    if log is None:  # Nothing to checkpoint, one batch as before
+        for i, c_res in zip(todo, await ClarifyConfig.clarifies([queries[i] for i in todo])):
+            clarifier_res[i] = c_res
+        return clarifier_res
+
+    async def clarify(i):
+        clarifier_res[i] = (await ClarifyConfig.clarifies([queries[i]], tqdm_title=None))[0]
+        log.record(i, 'clarify', clarifier_res[i]._asdict(), ok=clarify_ok(clarifier_res[i]))
+
+    await each(todo, clarify)
+    return clarifier_res
+
+
+async def batch_clarify(queries, dataset, save_to_file=True, log=None):
+    clarifier_res = await clarify_queries(queries, log)
+
+    similar_apis = [None] * len(queries)
+    todo = []
+    for i in range(len(queries)):
+        done = log.get(i, 'retrieve') if log is not None else None
+        if done is not None:
+            similar_apis[i] = ClarifyConfig.standardize_apis(done['apis'])
+        else:
+            todo.append(i)
+
+    def retrieved(j, s_apis):
+        # Called as soon as the chunk of the j-th pending query is retrieved
+        similar_apis[todo[j]] = s_apis
+        if log is not None:
+            log.record(todo[j], 'retrieve', {'apis': [api.fullname for api in s_apis]})
+
+    if todo:
+        await ClarifyConfig.batch_get_similar_apis(
+            [clarifier_res[i].statement or queries[i] for i in todo],
+            top_k=CoderConfig.TOP_K,
+            on_result=retrieved,
+        )
 
-    similar_apis = await ClarifyConfig.batch_get_similar_apis(
-        [res.statement or queries[i] for i, res in enumerate(clarifier_res)],
-        top_k=CoderConfig.TOP_K,
-    )
     if save_to_file:
-        results = []
-        for q, c_res, s_apis in zip(queries, clarifier_res, similar_apis):
-            results.append({
-                "title": q,
-                "clarify_input": c_res.demo_input,
-                "clarify_output": c_res.demo_output,
-                "clarify_statement": c_res.statement,
-                "similar_apis": ", ".join(f"{api.fullname}" for api in s_apis),
-                "clarify_tokens": c_res.tokens,
-            })
-        await save_to_csv(results,
-                          PathConfig.DATA_DIR / 'clarifier' / f'{dataset.name}_clarify.csv')
+        await save_clarify_results(queries, clarifier_res, similar_apis, dataset)
     return clarifier_res, similar_apis
 
 
-async def batch_code(clarifier_res, similar_apis, queries, answers, dataset):
-    coder_res = await CoderConfig.code(clarifier_res, similar_apis)
+async def save_clarify_results(queries, clarifier_res, similar_apis, dataset):
+    results = []
+    for q, c_res, s_apis in zip(queries, clarifier_res, similar_apis):
+        results.append({
+            "title": q,
+            "clarify_input": c_res.demo_input,
+            "clarify_output": c_res.demo_output,
+            "clarify_statement": c_res.statement,
+            "similar_apis": ", ".join(f"{api.fullname}" for api in s_apis),
+            "clarify_tokens": c_res.tokens,
+        })
+    await save_to_csv(results,
+                      PathConfig.DATA_DIR / 'clarifier' / f'{dataset.name}_clarify.csv')
+
+
+async def batch_code(clarifier_res, similar_apis, queries, answers, dataset, log=None):
+    coder_res = [None] * len(queries)
+    todo = []
+    for i in range(len(queries)):
+        done = log.get(i, 'code') if log is not None else None
+        if done is not None:
+            coder_res[i] = code_from_record(done)
+        else:
+            todo.append(i)
+    if log is None:  # Nothing to checkpoint, one batch as before
+        results = await CoderConfig.code([clarifier_res[i] for i in todo], [similar_apis[i] for i in todo])
+        for i, c_res in zip(todo, results):
+            coder_res[i] = c_res
+    else:
+        async def code(i):
+            coder_res[i] = (await CoderConfig.code([clarifier_res[i]], [similar_apis[i]], tqdm_title=None))[0]
+            log.record(i, 'code', code_record(coder_res[i]), ok=code_ok(coder_res[i]))
+
+        await each(todo, code)
+
+    await save_coder_results(coder_res, queries, answers, dataset)
+    return coder_res
+
+
+async def save_coder_results(coder_res, queries, answers, dataset):
     # Save answer
     results = []
     for i, c_res in enumerate(coder_res):
@@ -50,17 +138,169 @@ async def batch_code(clarifier_res, similar_apis, queries, answers, dataset):
             "tokens": c_res.tokens,
         })
     await save_to_csv(results, PathConfig.DATA_DIR / 'answer' / f"{dataset.name}_coder_results.csv")
-    return coder_res
 
 
-async def main():
+def clarify_ok(c_res):
+    return c_res.statement is not None
+
+
+def code_ok(c_res):
+    return c_res.code != '-' or bool(c_res.apis)
+
+
+def code_record(c_res):
+    return {**c_res._asdict(), 'apis': [api.fullname for api in c_res.apis]}
+
+
+def code_from_record(done):
+    return CoderConfig.CodeResponse(**{**done, 'apis': [API(api) for api in done['apis']]})
+
+
+async def run_stage(inbox, outbox, handle, concurrency):
+    # `concurrency` workers take query indices from inbox, handle them and pass them on to outbox;
+    # None marks the end of the inbox, every worker puts it back for the others before leaving
+    async def worker():
+        while (i := await inbox.get()) is not None:
+            await handle(i)
+            if outbox is not None:
+                outbox.put_nowait(i)
+        inbox.put_nowait(None)
+
+    await asyncio.gather(*[worker() for _ in range(concurrency)])
+    if outbox is not None:
+        outbox.put_nowait(None)
+
+
+async def pipeline(queries, answers, dataset, log=None,
+                   clarify_concurrency=50, retrieve_concurrency=4, code_concurrency=50):
+    # Streams every query through clarify -> retrieve -> code, so that the stages overlap
+    # instead of waiting for each other; each stage has its own concurrency limit
+    clarifier_res = [None] * len(queries)
+    similar_apis = [None] * len(queries)
+    coder_res = [None] * len(queries)
+    busy = {'clarify': 0.0, 'retrieve': 0.0, 'code': 0.0}
+    pool = ClarifyConfig.retrieval_pool(retrieve_concurrency, wait_ready=False)
+    clarify_queue, retrieve_queue, code_queue = asyncio.Queue(), asyncio.Queue(), asyncio.Queue()
+
+    # Queries resumed from the log enter at their first unfinished stage
+    for i in range(len(queries)):
+        done = {stage: log.get(i, stage) if log is not None else None for stage in ('clarify', 'retrieve', 'code')}
+        if done['clarify'] is None:
+            clarify_queue.put_nowait(i)
+            continue
+        clarifier_res[i] = ClarifyConfig.ClarifyResponse(**done['clarify'])
+        if done['retrieve'] is None:
+            retrieve_queue.put_nowait(i)
+            continue
+        similar_apis[i] = ClarifyConfig.standardize_apis(done['retrieve']['apis'])
+        if done['code'] is None:
+            code_queue.put_nowait(i)
+            continue
+        coder_res[i] = code_from_record(done['code'])
+    clarify_queue.put_nowait(None)
+
+    async def clarify(i):
+        start = time.perf_counter()
+        clarifier_res[i] = (await ClarifyConfig.clarifies([queries[i]], tqdm_title=None))[0]
+        busy['clarify'] += time.perf_counter() - start
+        if log is not None:
+            log.record(i, 'clarify', clarifier_res[i]._asdict(), ok=clarify_ok(clarifier_res[i]))
+
+    async def retrieve(i):
+        start = time.perf_counter()
+        similar_apis[i] = await pool.submit(clarifier_res[i].statement or queries[i], CoderConfig.TOP_K)
+        busy['retrieve'] += time.perf_counter() - start
+        if log is not None:
+            log.record(i, 'retrieve', {'apis': [api.fullname for api in similar_apis[i]]})
+
+    async def code(i):
+        start = time.perf_counter()
+        coder_res[i] = (await CoderConfig.code([clarifier_res[i]], [similar_apis[i]], tqdm_title=None))[0]
+        busy['code'] += time.perf_counter() - start
+        if log is not None:
+            log.record(i, 'code', code_record(coder_res[i]), ok=code_ok(coder_res[i]))
+
+    start = time.perf_counter()
+    await asyncio.gather(run_stage(clarify_queue, retrieve_queue, clarify, clarify_concurrency),
+                         run_stage(retrieve_queue, code_queue, retrieve, retrieve_concurrency),
+                         run_stage(code_queue, None, code, code_concurrency))
+    logger.info(f"Pipeline finished {len(queries)} queries in {time.perf_counter() - start:.1f}s, busy time per stage: "
+                + ", ".join(f"{stage} {seconds:.1f}s" for stage, seconds in busy.items()))
+
+    await save_clarify_results(queries, clarifier_res, similar_apis, dataset)
+    await save_coder_results(coder_res, queries, answers, dataset)
+    return clarifier_res, similar_apis, coder_res
+
+
+async def sweep(queries, answers, dataset, top_ks, question_cutoffs, metric_ks, log=None):
+    # Evaluates every (question cutoff, TOP_K) pair of the grid from one clarification and one retrieval per query:
+    # the API lists of all pairs are derived from the ranking of the largest cutoff (see get_top_k.sweep_top_k_apis),
+    # and the coder is asked once per query and distinct API list, most pairs of a query share their list
+    clarifier_res = await clarify_queries(queries, log)
+
+    start = time.perf_counter()
+    similar_apis = [ClarifyConfig.get_similar_apis_sweep(c_res.statement or q, top_ks, question_cutoffs)
+                    for q, c_res in zip(queries, clarifier_res)]
+    logger.info(f"Retrieved {len(question_cutoffs) * len(top_ks)} settings of {len(queries)} queries "
+                f"in {time.perf_counter() - start:.1f}s")
+
+    def job(i, apis):
+        return i, tuple(api.fullname for api in apis)
+
+    jobs = {}  # (query index, API fullnames) -> APIs given to the coder
+    for i, settings in enumerate(similar_apis):
+        for apis in settings.values():
+            jobs.setdefault(job(i, apis), apis)
+    logger.info(f"Coding {len(jobs)} distinct API lists instead of {len(queries) * len(question_cutoffs) * len(top_ks)}")
+    results = await CoderConfig.code([clarifier_res[i] for i, _ in jobs], list(jobs.values()))
+    coder_res = dict(zip(jobs, results))
+
+    ans_lists = [[api.fullname for api in answer] for answer in answers]
+    results = []
+    for cutoff in question_cutoffs:
+        for top_k in top_ks:
+            seq_lists = [[api.fullname for api in coder_res[job(i, settings[(cutoff, top_k)])].apis]
+                         for i, settings in enumerate(similar_apis)]
+            metrics = Calculator(seq_lists, ans_lists).calculate_metrics_for_multiple_k(list(metric_ks))
+            results.append({
+                "NAME": dataset.name,
+                "N_TOP_QUESTIONS": cutoff,
+                "TOP_K": top_k,
+                "MRR": metrics.mrr,
+                "MAP": metrics.map,
+                **{f"SuccessRate@{k}": value for k, value in zip(metric_ks, metrics.successrate_at_ks)},
+                **{f"Precision@{k}": value for k, value in zip(metric_ks, metrics.precision_at_ks)},
+                **{f"Recall@{k}": value for k, value in zip(metric_ks, metrics.recall_at_ks)},
+                **{f"NDCG@{k}": value for k, value in zip(metric_ks, metrics.ndcg_at_ks)},
+            })
+    pd.DataFrame(results).to_csv(
+        PathConfig.DATA_DIR / 'result' / f"{dataset.name}_sweep.csv",
+        index=False, encoding="utf-8"
+    )
+    return results
+
+
+async def main(resume=False, streaming=False, concurrency=(50, 4, 50), sweep_grid=None):
     dataset = dt.Dataset(dt.DatasetName.BIKER, 'test', 'filtered')
     queries = dataset.titles
     answers = dataset.answers
 
-    clarifier_res, similar_apis = await batch_clarify(queries, dataset)
+    if sweep_grid is not None:
+        # Its own log, the clarifications of a sweep are resumed but its API lists differ from a normal run
+        with CheckpointLog(PathConfig.DATA_DIR / 'checkpoint' / f'{dataset.name}_sweep.jsonl',
+                           dataset.name, resume) as log:
+            await sweep(queries, answers, dataset, *sweep_grid, log=log)
+        log_stats(pool=False)
+        return
 
-    coder_res = await batch_code(clarifier_res, similar_apis, queries, answers, dataset)
+    # Every finished stage of every query is logged, so an interrupted run can be resumed
+    with CheckpointLog(PathConfig.DATA_DIR / 'checkpoint' / f'{dataset.name}.jsonl', dataset.name, resume) as log:
+        if streaming:
+            _, _, coder_res = await pipeline(queries, answers, dataset, log, *concurrency)
+        else:
+            clarifier_res, similar_apis = await batch_clarify(queries, dataset, log=log)
+
+            coder_res = await batch_code(clarifier_res, similar_apis, queries, answers, dataset, log=log)
 
     # Calculate metrics
     seq_lists = [res.apis for res in coder_res]
@@ -83,7 +323,67 @@ async def main():
         PathConfig.DATA_DIR / 'result' / "result.csv",
         index=False, encoding="utf-8"
     )
+    log_stats()
+
+
+def log_stats(pool=True):
+    if LLMConfig.CACHE is not None:
+        logger.info(f"LLM cache: {LLMConfig.CACHE.stats()}")
+    retrieval_pool = ClarifyConfig.existing_retrieval_pool()
+    if pool and retrieval_pool is not None:
+        retrieval_pool.collect_traces()
+        retrieval_cache_stats = retrieval_pool.cache_stats()
+    elif pool:  # Nothing was retrieved, e.g. every query was resumed from the checkpoints
+        retrieval_cache_stats = None
+    else:  # Retrieved in this process
+        retrieval_cache_stats = get_top_k.retrieval_cache_stats()
+    if retrieval_cache_stats is not None:
+        logger.info(f"Retrieval cache: {retrieval_cache_stats}")
+    if LLMConfig.LIMITER is not None:
+        logger.info(f"LLM rate limiter: {LLMConfig.LIMITER.stats()}")
+    if LLMConfig.HEDGE is not None:
+        LLMConfig.HEDGE.log_stats()
 
 
 if __name__ == "__main__":
-    asyncio.run(main())
+    parser = argparse.ArgumentParser(description="Run the RQ evaluation")
+    parser.add_argument("--resume", action="store_true",
+                        help="skip the queries finished by an interrupted run and rebuild the results")
+    parser.add_argument("--pipeline", action="store_true",
+                        help="stream every query through clarify, retrieval and coding instead of stage by stage")
+    parser.add_argument("--concurrency", type=int, nargs=3, default=[50, 4, 50],
+                        metavar=("CLARIFY", "RETRIEVE", "CODE"),
+                        help="concurrent queries per stage in pipeline mode, retrieval uses one worker process each")
+    parser.add_argument("--rpm", type=int, default=None, help="requests per minute allowed by the LLM provider")
+    parser.add_argument("--tpm", type=int, default=None, help="tokens per minute allowed by the LLM provider")
+    parser.add_argument("--hedge", type=float, default=None, metavar="PERCENTILE",
+                        help="send a duplicate of LLM requests slower than this latency percentile, e.g. 95")
+    parser.add_argument("--timeout", type=float, default=120.0, help="deadline of an LLM request in seconds")
+    parser.add_argument("--retrieval-cache", choices=["memory", "disk"], default=None,
+                        help="reuse the APIs of statements with the same stemmed words, "
+                             "disk keeps them next to the knowledge base snapshot across runs")
+    parser.add_argument("--trace", default=None, metavar="PATH",
+                        help="write wall time, calls, tokens and queue wait per span as JSON to PATH")
+    parser.add_argument("--chrome-trace", default=None, metavar="PATH",
+                        help="with --trace, also write every span as a Chrome trace to PATH")
+    parser.add_argument("--sweep", action="store_true",
+                        help="evaluate a grid of TOP_K values and question cutoffs from one retrieval per query, "
+                             "the metrics of every grid point go to result/<dataset>_sweep.csv")
+    parser.add_argument("--sweep-top-k", type=int, nargs="+", default=[CoderConfig.TOP_K], metavar="K",
+                        help="TOP_K values of the sweep, the number of APIs given to the coder")
+    parser.add_argument("--sweep-questions", type=int, nargs="+", default=[get_top_k.n_top_questions], metavar="N",
+                        help="question cutoffs of the sweep, the number of similar questions the APIs come from")
+    parser.add_argument("--sweep-metric-k", type=int, nargs="+", default=[1, 3, 5], metavar="K",
+                        help="k values of SuccessRate@k, Precision@k, Recall@k and NDCG@k in the sweep")
+    args = parser.parse_args()
+    if args.trace is not None:
+        TRACER.enable(chrome=args.chrome_trace is not None)
+        atexit.register(TRACER.save, args.trace, args.chrome_trace)  # After the retrieval pool collected its spans
+    if args.retrieval_cache is not None:
+        get_top_k.enable_retrieval_cache(disk=args.retrieval_cache == "disk")
+    if args.rpm or args.tpm:
+        LLMConfig.enable_rate_limit(args.rpm, args.tpm)
+    if args.hedge is not None:
+        LLMConfig.enable_hedging(args.hedge, args.timeout)
+    sweep_grid = (args.sweep_top_k, args.sweep_questions, args.sweep_metric_k) if args.sweep else None
+    asyncio.run(main(resume=args.resume, streaming=args.pipeline, concurrency=args.concurrency, sweep_grid=sweep_grid))
@@ -0,0 +1,241 @@
+import os
+import json
+import time
+import pathlib
+import asyncio
+import threading
+import functools
+import contextvars
+from contextlib import contextmanager, nullcontext
+from typing import Any, Callable, Iterator
+
+import numpy as np
+
+# Spans open in the current thread or asyncio task, innermost last
+_open_spans: contextvars.ContextVar[tuple["Span", ...]] = contextvars.ContextVar("open_spans", default=())
+_NO_SPAN = nullcontext()
+
+
+class Span:
+
+    __slots__ = ("name", "start", "tokens", "queue_wait")
+
+    def __init__(self, name: str):
+        self.name: str = name
+        self.start: float = time.perf_counter()
+        self.tokens: int = 0
+        self.queue_wait: float = 0.0
+
+
+class Tracer:
+
+    def __init__(self):
+        """
+        Wall time, call counts, tokens and queue wait of named spans, e.g. pipeline stages or LLM round trips
+
+        Disabled by default, a disabled tracer costs one attribute lookup per span.
+        Tokens and queue wait recorded inside a span count for every span enclosing it,
+        so clarifies includes the tokens of its LLM requests.
+        """
+        self.enabled: bool = False
+        self.chrome: bool = False
+        self.started: float = time.perf_counter()
+        self.durations: dict[str, list[float]] = {}
+        self.tokens: dict[str, int] = {}
+        self.queue_waits: dict[str, float] = {}
+        self.events: list[dict[str, Any]] = []
+        self._lock = threading.Lock()
+
+    def enable(self, chrome: bool = False) -> None:
+        """
+        Start recording, earlier records are dropped
+
+        Args:
+            chrome (bool): Also keep every single span for a Chrome trace, see save
+        """
+        self.reset()
+        self.chrome = chrome
+        self.enabled = True
+
+    def disable(self) -> None:
+        self.enabled = False
+
+    def reset(self) -> None:
+        with self._lock:
+            self.started = time.perf_counter()
+            self.durations, self.tokens, self.queue_waits, self.events = {}, {}, {}, []
+
+    def span(self, name: str):
+        """
+        Context manager timing the enclosed code as one call of the span name
+
+        Args:
+            name (str): Span name, calls of the same name are aggregated
+        """
+        if not self.enabled:
+            return _NO_SPAN
+        return self._span(name)
+
+    @contextmanager
+    def _span(self, name: str) -> Iterator[Span]:
+        span = Span(name)
+        token = _open_spans.set(_open_spans.get() + (span,))
+        try:
+            yield span
+        finally:
+            _open_spans.reset(token)
+            self._finish(span, time.perf_counter())
+
+    def _finish(self, span: Span, end: float) -> None:
+        with self._lock:
+            self.durations.setdefault(span.name, []).append(end - span.start)
+            self.tokens[span.name] = self.tokens.get(span.name, 0) + span.tokens
+            self.queue_waits[span.name] = self.queue_waits.get(span.name, 0.0) + span.queue_wait
+            if self.chrome:
+                self.events.append({
+                    "name": span.name,
+                    "ph": "X",
+                    "ts": span.start * 1e6,  # perf_counter is the same clock in every process
+                    "dur": (end - span.start) * 1e6,
+                    "pid": os.getpid(),
+                    "tid": self._lane(),
+                    "args": {"tokens": span.tokens, "queue_wait_ms": span.queue_wait * 1000},
+                })
+
+    @staticmethod
+    def _lane() -> int:
+        # Concurrent asyncio tasks get lanes of their own, otherwise their spans would overlap in one row
+        try:
+            task = asyncio.current_task()
+        except RuntimeError:
+            task = None
+        return id(task) if task is not None else threading.get_ident()
+
+    def record(self, tokens: int = 0, queue_wait: float = 0.0) -> None:
+        """
+        Add tokens and queue wait to the open spans
+
+        Args:
+            tokens (int): LLM tokens used
+            queue_wait (float): Seconds spent waiting for a queue, a rate limit or a worker
+        """
+        if not self.enabled:
+            return
+        for span in _open_spans.get():
+            span.tokens += tokens
+            span.queue_wait += queue_wait
+
+    def summary(self) -> dict[str, Any]:
+        """
+        Calls, wall time percentiles, throughput, tokens and queue wait per span name
+        """
+        elapsed = time.perf_counter() - self.started
+        spans = {}
+        with self._lock:
+            for name, durations in self.durations.items():
+                seconds = np.array(durations)
+                spans[name] = {
+                    "calls": len(durations),
+                    "total_s": round(float(seconds.sum()), 6),
+                    "mean_ms": round(float(seconds.mean()) * 1000, 3),
+                    "p50_ms": round(float(np.percentile(seconds, 50)) * 1000, 3),
+                    "p95_ms": round(float(np.percentile(seconds, 95)) * 1000, 3),
+                    "max_ms": round(float(seconds.max()) * 1000, 3),
+                    "calls_per_s": round(len(durations) / elapsed, 3) if elapsed > 0 else None,
+                    "tokens": self.tokens[name],
+                    "queue_wait_s": round(self.queue_waits[name], 6),
+                }
+        return {"elapsed_s": round(elapsed, 6), "pid": os.getpid(), "spans": spans}
+
+    def export(self) -> dict[str, Any]:
+        """
+        Raw records of this process, for merging them into the tracer of another process
+        """
+        with self._lock:
+            return {"durations": dict(self.durations), "tokens": dict(self.tokens),
+                    "queue_waits": dict(self.queue_waits), "events": list(self.events)}
+
+    def merge(self, exported: dict[str, Any]) -> None:
+        """
+        Add the records of another process, e.g. a retrieval worker
+
+        Args:
+            exported (dict[str, Any]): Result of export in the other process
+        """
+        with self._lock:
+            for name, durations in exported["durations"].items():
+                self.durations.setdefault(name, []).extend(durations)
+                self.tokens[name] = self.tokens.get(name, 0) + exported["tokens"][name]
+                self.queue_waits[name] = self.queue_waits.get(name, 0.0) + exported["queue_waits"][name]
+            self.events.extend(exported["events"])
+
+    def save(self, path: pathlib.Path, chrome_path: pathlib.Path | None = None) -> None:
+        """
+        Write the summary as JSON, and the spans as a Chrome trace (chrome://tracing, Perfetto) if chrome_path is given
+
+        Args:
+            path (pathlib.Path): Path of the JSON summary
+            chrome_path (pathlib.Path | None): Path of the Chrome trace, needs enable(chrome=True)
+        """
+        path = pathlib.Path(path)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(self.summary(), f, indent=2)
+        if chrome_path is not None:
+            chrome_path = pathlib.Path(chrome_path)
+            chrome_path.parent.mkdir(parents=True, exist_ok=True)
+            with self._lock, open(chrome_path, "w", encoding="utf-8") as f:
+                json.dump({"traceEvents": self.events, "displayTimeUnit": "ms"}, f)
+
+
+TRACER = Tracer()
+
+
+def span(name: str):
+    """
+    Context manager of the shared tracer, see Tracer.span
+
+    Args:
+        name (str): Span name
+    """
+    return TRACER.span(name) if TRACER.enabled else _NO_SPAN
+
+
+def record(tokens: int = 0, queue_wait: float = 0.0) -> None:
+    """
+    See Tracer.record
+
+    Args:
+        tokens (int): LLM tokens used
+        queue_wait (float): Seconds spent waiting
+    """
+    if TRACER.enabled:
+        TRACER.record(tokens, queue_wait)
+
+
+def traced(name: str | None = None) -> Callable[[Callable], Callable]:
+    """
+    Decorator recording every call of a function or coroutine function as a span of the shared tracer
+
+    Args:
+        name (str | None): Span name, defaults to the function name
+    """
+    def decorator(fn: Callable) -> Callable:
+        span_name = name or fn.__name__
+        if asyncio.iscoroutinefunction(fn):
+            @functools.wraps(fn)
+            async def async_wrapper(*args, **kwargs):
+                if not TRACER.enabled:
+                    return await fn(*args, **kwargs)
+                with TRACER._span(span_name):
+                    return await fn(*args, **kwargs)
+            return async_wrapper
+
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            if not TRACER.enabled:
+                return fn(*args, **kwargs)
+            with TRACER._span(span_name):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorator